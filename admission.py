@@ -0,0 +1,214 @@
+"""
+Admission control for chat turns
+Token buckets limit how fast one session or client may send messages, and a
+concurrency gate caps the turns waiting on Perplexity at once.  Requests over
+a limit are turned away immediately (or after a short, bounded wait for a
+slot) with how long to wait before retrying, so overload shows up as fast
+429s instead of ever-growing latency.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class Overloaded(Exception):
+    """Raised when a request can't be admitted; `retry_after` is in seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason}: retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token bucket per key: `rate` requests/second sustained, bursts of up to `burst`
+
+    A rate of 0 disables the limiter.  At most `max_keys` buckets are kept,
+    least recently used first out; an evicted key starts again with a full
+    bucket.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+        self.stats = {"allowed": 0, "limited": 0}
+
+    def acquire(self, key):
+        """Take a token for `key`; returns 0 if allowed, else seconds until a token is available"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = self._clock()
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+                self.stats["allowed"] += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.stats["limited"] += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def snapshot(self):
+        with self._lock:
+            total = self.stats["allowed"] + self.stats["limited"]
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "keys": len(self._buckets),
+                "limited_ratio": round(self.stats["limited"] / total, 3) if total else 0.0,
+                **self.stats,
+            }
+
+
+class AdmissionGate:
+    """Allow at most `limit` holders at once across threads
+
+    When every slot is taken, up to `max_queue` callers wait up to `timeout`
+    seconds for one; anyone beyond that, or still waiting at the deadline,
+    gets Overloaded.  A limit of 0 admits everyone.  The suggested retry
+    delay scales the average hold time by how far over capacity the gate is.
+    """
+
+    def __init__(self, limit, max_queue=0, timeout=1.0, clock=time.monotonic):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._hold = 1.0  # moving average of seconds a slot is held
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed; returns a ticket for release()"""
+        if not self.limit:
+            return self._clock()
+        with self._condition:
+            if self._in_flight >= self.limit or self._waiting:
+                if self._waiting >= self.max_queue:
+                    self.stats["rejected_queue_full"] += 1
+                    raise Overloaded('queue_full', self._retry_after())
+                self.stats["queued"] += 1
+                self._waiting += 1
+                deadline = self._clock() + self.timeout
+                try:
+                    while self._in_flight >= self.limit:
+                        remaining = deadline - self._clock()
+                        if remaining <= 0:
+                            self.stats["rejected_timeout"] += 1
+                            raise Overloaded('queue_timeout', self._retry_after())
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_flight += 1
+            self.stats["admitted"] += 1
+        return self._clock()
+
+    def release(self, ticket):
+        """Give back the slot taken when acquire() returned `ticket`"""
+        if not self.limit:
+            return
+        with self._condition:
+            self._in_flight -= 1
+            self._hold += 0.1 * ((self._clock() - ticket) - self._hold)
+            self._condition.notify()
+
+    def _retry_after(self):
+        return self._hold * (1 + self._waiting) / self.limit
+
+    def snapshot(self):
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "max_queue": self.max_queue,
+                "avg_hold_s": round(self._hold, 3),
+                **self.stats,
+            }
+
+
+class AsyncAdmissionGate:
+    """asyncio counterpart of AdmissionGate
+
+    Waiters are served first come, first served: a released slot is handed
+    straight to the oldest waiter.
+    """
+
+    def __init__(self, limit, max_queue=0, timeout=1.0, clock=time.monotonic):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._clock = clock
+        self._in_flight = 0
+        self._waiters = deque()  # futures resolved when handed a slot
+        self._hold = 1.0
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    async def acquire(self):
+        if not self.limit:
+            return self._clock()
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self.stats["rejected_queue_full"] += 1
+                raise Overloaded('queue_full', self._retry_after())
+            self.stats["queued"] += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, self.timeout)
+            except asyncio.TimeoutError:
+                self.stats["rejected_timeout"] += 1
+                raise Overloaded('queue_timeout', self._retry_after())
+            except asyncio.CancelledError:
+                # Handed a slot just as the caller went away: pass it on
+                if waiter.done() and not waiter.cancelled():
+                    self._release_slot()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.stats["admitted"] += 1
+        return self._clock()
+
+    def release(self, ticket):
+        if not self.limit:
+            return
+        self._hold += 0.1 * ((self._clock() - ticket) - self._hold)
+        self._release_slot()
+
+    def _release_slot(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot moves to the waiter; in_flight is unchanged
+                waiter.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def _retry_after(self):
+        return self._hold * (1 + len(self._waiters)) / self.limit
+
+    def snapshot(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "waiting": len(self._waiters),
+            "max_queue": self.max_queue,
+            "avg_hold_s": round(self._hold, 3),
+            **self.stats,
+        }
@@ -3,34 +3,131 @@ Perplexity AI + PayPal Instant Checkout POC
 Similar to OpenAI + Stripe implementation
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from flask import Blueprint, Flask, Response, request, jsonify
 import os
 import json
 from datetime import datetime
-import requests
-from dotenv import load_dotenv
+import uuid
+import time
+import logging
+import contextvars
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from token_cache import SQLiteTokenStore, TokenCache
+from catalog import Catalog
+from upstream import UpstreamClient, create_breaker, failed_status, upstream_settings
+from circuit_breaker import CircuitOpen
+from hedging import HedgePolicy, Hedger
+from session_store import create_session_store
+from context_window import ContextWindow
+from intent_router import Intent, IntentRouter
+from order_pool import OrderPool
+from reply_cache import ReplyCache
+from job_queue import DeferJob, JobQueue, PermanentJobError
+from structured_logging import bind_log_context, clear_log_context, configure_logging
+from metrics import Metrics
+from payload_builder import PayloadBuilder
+from admission import AdmissionGate, Overloaded, RateLimiter
+from config_snapshot import load_environment
 
-# Load environment variables from .env file
-load_dotenv()
+# Load environment variables from CONFIG_SNAPSHOT, else the .env file
+load_environment()
 
-app = Flask(__name__)
-CORS(app)
+# Routes and request hooks; create_app() builds the Flask app around them
+api = Blueprint('giftcards', __name__)
+
+# Structured JSON logs, written by a background thread so requests never block on stdout.
+# DEBUG upstream dumps are kept for LOG_DEBUG_SAMPLE_RATE of requests.
+configure_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    fmt=os.getenv('LOG_FORMAT', 'json'),
+    use_queue=os.getenv('LOG_QUEUE', 'on') != 'off',
+    debug_sample_rate=float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '0.01'))
+)
+paypal_log = logging.getLogger('giftcards.paypal')
+chat_log = logging.getLogger('giftcards.chat')
+
+# Per-stage latency histograms, exported on GET /metrics. Requests slower than
+# SLOW_REQUEST_SECONDS are logged with their span breakdown (0 disables it).
+metrics = Metrics(slow_request_seconds=float(os.getenv('SLOW_REQUEST_SECONDS', '0')))
+
+@api.before_app_request
+def bind_request_id():
+    """Correlate every log record of this request, honouring an incoming X-Request-ID"""
+    request.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+    clear_log_context(request_id=request.request_id)
+    # Route templates, not paths, so order IDs don't become label values
+    metrics.start_trace(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@api.after_app_request
+def add_request_id(response):
+    response.headers['X-Request-ID'] = request.request_id
+    # Streamed responses finish their trace when the stream ends
+    if not response.is_streamed:
+        metrics.finish_trace(response.status_code)
+    return response
 
 # API Configuration
 PERPLEXITY_API_KEY = os.getenv('PERPLEXITY_API_KEY')
 PAYPAL_CLIENT_ID = os.getenv('PAYPAL_CLIENT_ID')
 PAYPAL_CLIENT_SECRET = os.getenv('PAYPAL_CLIENT_SECRET')
 PAYPAL_MODE = os.getenv('PAYPAL_MODE', 'sandbox')  # 'sandbox' or 'live'
+# Refresh the cached PayPal token this many seconds before it expires
+PAYPAL_TOKEN_REFRESH_MARGIN = int(os.getenv('PAYPAL_TOKEN_REFRESH_MARGIN', '300'))
+# SQLite file through which worker processes share one PayPal token (unset: per process)
+PAYPAL_TOKEN_CACHE_PATH = os.getenv('PAYPAL_TOKEN_CACHE_PATH')
+
+# Settings the app can't serve a request without
+REQUIRED_SETTINGS = ('PERPLEXITY_API_KEY', 'PAYPAL_CLIENT_ID', 'PAYPAL_CLIENT_SECRET')
+
+PERPLEXITY_API_URL = os.getenv('PERPLEXITY_API_URL', 'https://api.perplexity.ai/chat/completions')
 
 # PayPal API Base URLs
 PAYPAL_API_BASE = {
     'sandbox': 'https://api-m.sandbox.paypal.com',
     'live': 'https://api-m.paypal.com'
 }
+# Optional override, e.g. to point the app at a local PayPal stub
+if os.getenv('PAYPAL_API_URL'):
+    PAYPAL_API_BASE[PAYPAL_MODE] = os.getenv('PAYPAL_API_URL')
 
-# Product Catalog
-PRODUCTS = {
+# Circuit breakers: calls to an upstream that keeps failing or stalling fail
+# fast until probes show it has recovered (shared with the async app)
+perplexity_breaker = create_breaker('PERPLEXITY', 'perplexity')
+paypal_breaker = create_breaker('PAYPAL', 'paypal')
+
+# Hedged completions (off by default): a completion still running after the
+# PERPLEXITY_HEDGE_QUANTILE latency of recent ones gets a backup request, and
+# at most PERPLEXITY_HEDGE_BUDGET of completions are sent twice
+PERPLEXITY_HEDGE = os.getenv('PERPLEXITY_HEDGE', 'off') != 'off'
+hedge_policy = HedgePolicy(
+    quantile=float(os.getenv('PERPLEXITY_HEDGE_QUANTILE', '0.95')),
+    min_delay=float(os.getenv('PERPLEXITY_HEDGE_MIN_DELAY', '0.05')),
+    max_ratio=float(os.getenv('PERPLEXITY_HEDGE_BUDGET', '0.1'))
+)
+
+# Pooled keep-alive sessions, one per upstream host.
+# PayPal POSTs are retried safely because they carry a PayPal-Request-Id.
+perplexity_client = UpstreamClient(
+    'perplexity',
+    observer=metrics.observe_upstream,
+    breaker=perplexity_breaker,
+    hedger=Hedger(
+        hedge_policy,
+        accept=lambda response: not failed_status(response.status_code),
+        name='perplexity-hedge'
+    ) if PERPLEXITY_HEDGE else None,
+    **upstream_settings('PERPLEXITY')
+)
+paypal_client = UpstreamClient(
+    'paypal', retry_post=True, observer=metrics.observe_upstream, breaker=paypal_breaker,
+    **upstream_settings('PAYPAL')
+)
+
+# Product Catalog: these built-in cards, or CATALOG_PATH (a .json file or a
+# SQLite database with a products table), re-read when the file changes
+DEFAULT_PRODUCTS = {
     'gc_25': {
         'id': 'gc_25',
         'name': '$25 Gift Card',
@@ -54,53 +151,149 @@ PRODUCTS = {
     }
 }
 
-# Store conversation history per session
-conversations = {}
-
-# Tool definitions for Perplexity function calling
-TOOLS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "list_gift_cards",
-            "description": "Get a list of available gift cards with prices and descriptions. Call this when user asks what gift cards are available.",
-            "parameters": {
-                "type": "object",
-                "properties": {},
-                "required": []
+catalog = Catalog(
+    DEFAULT_PRODUCTS.values(),
+    source=os.getenv('CATALOG_PATH') or None,
+    # Seconds between checks of the file for changes (0 disables reloading)
+    reload_interval=float(os.getenv('CATALOG_RELOAD_INTERVAL', '5'))
+)
+
+# Catalogs up to this many products are spelled out in the system prompt and
+# the tool schema; larger ones are only reachable through list_gift_cards
+CATALOG_INLINE_LIMIT = int(os.getenv('CATALOG_INLINE_LIMIT', '25'))
+# Products per list_gift_cards page, unless the AI asks for up to CATALOG_MAX_PAGE_SIZE
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '10'))
+CATALOG_MAX_PAGE_SIZE = int(os.getenv('CATALOG_MAX_PAGE_SIZE', '50'))
+
+@api.before_app_request
+def refresh_catalog():
+    """Pick up catalog edits; at most one stat call per CATALOG_RELOAD_INTERVAL"""
+    catalog.refresh()
+
+# Conversation history per session, bounded by LRU + TTL eviction and per-session caps.
+# 'memory' keeps it in-process; 'sqlite' shares it between worker processes.
+session_store = create_session_store(
+    os.getenv('SESSION_BACKEND', 'memory'),
+    path=os.getenv('SESSION_DB_PATH', 'sessions.db'),
+    max_sessions=int(os.getenv('SESSION_MAX_SESSIONS', '10000')),
+    ttl=int(os.getenv('SESSION_TTL', '3600')),
+    max_turns=int(os.getenv('SESSION_MAX_TURNS', '20')),
+    max_tokens=int(os.getenv('SESSION_MAX_TOKENS', '4000'))
+)
+
+# What each Perplexity call sees of the history: the last CONTEXT_KEEP_TURNS turns
+# within CONTEXT_MAX_TOKENS, plus a cached summary of older turns (0 sends everything)
+context_window = ContextWindow(
+    keep_turns=int(os.getenv('CONTEXT_KEEP_TURNS', '6')),
+    max_tokens=int(os.getenv('CONTEXT_MAX_TOKENS', '1500')),
+    summary_max_chars=int(os.getenv('CONTEXT_SUMMARY_MAX_CHARS', '800'))
+)
+
+def build_tools(catalog):
+    """Tool definitions for Perplexity function calling, generated from the catalog
+    
+    Small catalogs are enumerated in the schema so the AI can only pick real
+    product IDs; for large ones it has to find them with list_gift_cards.
+    """
+    product_id = {"type": "string"}
+    if len(catalog) <= CATALOG_INLINE_LIMIT:
+        product_ids = list(catalog)
+        product_id["enum"] = product_ids
+        product_id_help = "Available product IDs are: " + ", ".join(
+            f"{pid} (for {catalog[pid]['name']})" for pid in product_ids
+        ) + "."
+        product_id["description"] = "The product ID - must be exactly one of: " + ", ".join(
+            f"'{pid}'" for pid in product_ids
+        )
+    else:
+        product_id_help = "Product IDs come from list_gift_cards; never guess one."
+        product_id["description"] = "A product ID returned by list_gift_cards"
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": "list_gift_cards",
+                "description": "Get available gift cards with prices and descriptions, one page at a time. Call this when user asks what gift cards are available, and filter by query, price range or currency to find specific cards.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "Words the card name or description must contain, e.g. an occasion or a brand"
+                        },
+                        "min_price": {
+                            "type": "number",
+                            "description": "Lowest price to include"
+                        },
+                        "max_price": {
+                            "type": "number",
+                            "description": "Highest price to include"
+                        },
+                        "currency": {
+                            "type": "string",
+                            "enum": catalog.currencies
+                        },
+                        "page": {
+                            "type": "integer",
+                            "description": "Page of results, starting at 1",
+                            "minimum": 1
+                        },
+                        "page_size": {
+                            "type": "integer",
+                            "description": "Gift cards per page",
+                            "minimum": 1,
+                            "maximum": CATALOG_MAX_PAGE_SIZE
+                        }
+                    },
+                    "required": []
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "create_paypal_checkout",
-            "description": "Create a PayPal checkout session for purchasing a gift card. ONLY use the product_id parameter. Available product IDs are: gc_25 (for $25 card), gc_50 (for $50 card), gc_100 (for $100 card). Do NOT invent other parameters.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "product_id": {
-                        "type": "string",
-                        "description": "The product ID - must be exactly one of: 'gc_25', 'gc_50', or 'gc_100'",
-                        "enum": ["gc_25", "gc_50", "gc_100"]
-                    }
-                },
-                "required": ["product_id"]
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "create_paypal_checkout",
+                "description": "Create a PayPal checkout session for purchasing gift cards. For a single card use the product_id parameter (and quantity for several of the same card). For different cards in one purchase use the items parameter, so they share ONE checkout. " + product_id_help + " Do NOT invent other parameters.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "product_id": product_id,
+                        "quantity": {
+                            "type": "integer",
+                            "description": "How many of product_id to buy (default 1)",
+                            "minimum": 1
+                        },
+                        "items": {
+                            "type": "array",
+                            "description": "Cart of different gift cards bought in one checkout",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "product_id": {key: value for key, value in product_id.items() if key != 'description'},
+                                    "quantity": {
+                                        "type": "integer",
+                                        "minimum": 1
+                                    }
+                                },
+                                "required": ["product_id"]
+                            }
+                        }
+                    },
+                    "required": []
+                }
             }
         }
-    }
-]
+    ]
 
-def get_paypal_access_token():
-    """Get PayPal OAuth access token"""
+def chat_tools():
+    """Tool definitions for the current catalog"""
+    return catalog.derived('tools', build_tools)
+
+def fetch_paypal_access_token():
+    """Request a new PayPal OAuth access token, returning (token, expires_in)"""
     url = f"{PAYPAL_API_BASE[PAYPAL_MODE]}/v1/oauth2/token"
     
-    print(f"\n{'='*60}")
-    print(f"🔐 Getting PayPal Access Token")
-    print(f"{'='*60}")
-    print(f"🌍 PayPal Mode: {PAYPAL_MODE}")
-    print(f"🔗 Token URL: {url}")
-    print(f"👤 Client ID: {PAYPAL_CLIENT_ID[:20]}...")
+    paypal_log.info("Requesting PayPal access token", extra={"paypal_mode": PAYPAL_MODE})
     
     headers = {
         "Accept": "application/json",
@@ -108,141 +301,445 @@ def get_paypal_access_token():
     }
     data = {"grant_type": "client_credentials"}
     
-    response = requests.post(
+    response = paypal_client.post(
         url,
         headers=headers,
         data=data,
         auth=(PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET)
     )
     
-    print(f"📥 Response Status: {response.status_code}")
-    
     if response.status_code == 200:
-        token = response.json()['access_token']
-        print(f"✅ Access Token Received: {token[:30]}...")
-        print(f"{'='*60}\n")
-        return token
+        token_data = response.json()
+        token = token_data['access_token']
+        expires_in = token_data.get('expires_in', 0)
+        paypal_log.info("PayPal access token received", extra={"expires_in": expires_in})
+        return token, expires_in
     else:
         error_msg = f"Failed to get PayPal token: {response.text}"
-        print(f"❌ {error_msg}")
-        print(f"{'='*60}\n")
+        paypal_log.error("PayPal token request failed", extra={"status": response.status_code})
         raise Exception(error_msg)
 
-def list_gift_cards():
-    """Function to list available gift cards"""
+# Shared PayPal token, reused for its lifetime instead of minted per call
+# Token store shared by all workers, keyed on the credentials
+paypal_token_store = SQLiteTokenStore(
+    PAYPAL_TOKEN_CACHE_PATH,
+    key=f"{PAYPAL_MODE}:{PAYPAL_CLIENT_ID}"
+) if PAYPAL_TOKEN_CACHE_PATH else None
+
+paypal_token_cache = TokenCache(
+    fetch_paypal_access_token,
+    refresh_margin=PAYPAL_TOKEN_REFRESH_MARGIN,
+    store=paypal_token_store
+)
+
+def get_paypal_access_token():
+    """Get PayPal OAuth access token (cached until shortly before expiry)"""
+    with metrics.span('paypal.token'):
+        return paypal_token_cache.get()
+
+def list_gift_cards(query=None, min_price=None, max_price=None, currency=None, page=1, page_size=None):
+    """Function to list available gift cards, filtered and one page at a time"""
+    try:
+        page = max(1, int(page or 1))
+        page_size = min(max(1, int(page_size or CATALOG_PAGE_SIZE)), CATALOG_MAX_PAGE_SIZE)
+        min_price = float(min_price) if min_price is not None else None
+        max_price = float(max_price) if max_price is not None else None
+    except (TypeError, ValueError):
+        return json.dumps({"error": "Invalid list_gift_cards arguments"})
+    products, total = catalog.search(
+        query, min_price, max_price, currency,
+        offset=(page - 1) * page_size,
+        limit=page_size
+    )
     return json.dumps({
-        "products": list(PRODUCTS.values())
+        "products": products,
+        "total": total,
+        "page": page,
+        "has_more": page * page_size < total
     })
 
-def create_paypal_checkout(product_id):
-    """Create PayPal order for instant checkout"""
-    print(f"\n{'='*60}")
-    print(f"🛒 Creating PayPal checkout for product: {product_id}")
-    print(f"{'='*60}")
+# Most cards of one kind a single checkout may contain
+MAX_CART_QUANTITY = int(os.getenv('MAX_CART_QUANTITY', '10'))
+
+def normalize_cart(product_id=None, quantity=1, items=None):
+    """Turn create_paypal_checkout arguments into [(product_id, quantity), ...]
     
+    Repeated products are merged, keeping first-mention order. Raises
+    ValueError with a message safe to show the AI.
+    """
+    lines = items if items else [{"product_id": product_id, "quantity": quantity}]
+    cart = {}
+    for line in lines:
+        line_product = line.get('product_id') if isinstance(line, dict) else None
+        if line_product not in catalog:
+            raise ValueError(f"Invalid product ID: {line_product}")
+        try:
+            line_quantity = int(1 if line.get('quantity') is None else line['quantity'])
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid quantity for {line_product}: {line.get('quantity')}")
+        if line_quantity < 1:
+            raise ValueError(f"Invalid quantity for {line_product}: {line_quantity}")
+        cart[line_product] = cart.get(line_product, 0) + line_quantity
+        if cart[line_product] > MAX_CART_QUANTITY:
+            raise ValueError(f"At most {MAX_CART_QUANTITY} of each gift card per checkout")
+    if len({catalog[pid]['currency'] for pid in cart}) > 1:
+        raise ValueError("All gift cards in one checkout must share a currency")
+    return list(cart.items())
+
+def cart_total(cart):
+    """Total price of a cart, formatted as a PayPal amount"""
+    return f"{sum(catalog[pid]['price'] * quantity for pid, quantity in cart):.2f}"
+
+def build_paypal_order(cart):
+    """Build the /v2/checkout/orders request body
+    
+    `cart` is a product ID or a list of (product_id, quantity). Every card goes
+    into one purchase unit with an item breakdown, so the buyer approves a
+    single order however many cards it holds.
+    """
+    if isinstance(cart, str):
+        cart = [(cart, 1)]
+    currency = catalog[cart[0][0]]['currency']
+    if cart[0][1] == 1 and len(cart) == 1:
+        reference_id = cart[0][0]
+        description = catalog[reference_id]['description']
+    else:
+        reference_id = 'cart'
+        # PayPal allows 127 characters
+        description = ', '.join(f"{quantity} x {catalog[pid]['name']}" for pid, quantity in cart)[:127]
+    return {
+        "intent": "CAPTURE",
+        "purchase_units": [{
+            "reference_id": reference_id,
+            "description": description,
+            "amount": {
+                "currency_code": currency,
+                "value": cart_total(cart),
+                "breakdown": {
+                    "item_total": {"currency_code": currency, "value": cart_total(cart)}
+                }
+            },
+            "items": [
+                {
+                    "name": catalog[pid]['name'],
+                    "sku": pid,
+                    "quantity": str(quantity),
+                    "category": "DIGITAL_GOODS",
+                    "unit_amount": {
+                        "currency_code": currency,
+                        "value": f"{catalog[pid]['price']:.2f}"
+                    }
+                }
+                for pid, quantity in cart
+            ],
+            "custom_id": f"gift_card_{datetime.now().timestamp()}"
+        }],
+        "application_context": {
+            "brand_name": "Gift Card Store",
+            "landing_page": "NO_PREFERENCE",
+            "user_action": "PAY_NOW",
+            "return_url": "http://localhost:3000/success",
+            "cancel_url": "http://localhost:3000/cancel"
+        }
+    }
+
+class PayPalError(Exception):
+    """PayPal rejected a request; the message is safe to show the AI"""
+
+def create_paypal_order(cart):
+    """Create a PayPal order for a product ID or cart, returning the checkout result
+    
+    Raises PayPalError if PayPal rejects the order.
+    """
+    if isinstance(cart, str):
+        cart = [(cart, 1)]
+    access_token = get_paypal_access_token()
+    
+    api_base = PAYPAL_API_BASE[PAYPAL_MODE]
+    url = f"{api_base}/v2/checkout/orders"
+    
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+        # Makes retried order creation idempotent on PayPal's side
+        "PayPal-Request-Id": str(uuid.uuid4())
+    }
+    
+    order_data = build_paypal_order(cart)
+    
+    with metrics.span('paypal.order'):
+        response = paypal_client.post(url, headers=headers, json=order_data)
+    
+    if response.status_code == 401:
+        # Token was revoked or expired early; the next call fetches a new one
+        paypal_token_cache.invalidate()
+    
+    if response.status_code != 201:
+        paypal_log.error("PayPal order creation failed", extra={
+            "items": dict(cart),
+            "status": response.status_code,
+            "body": response.text
+        })
+        raise PayPalError(f"PayPal API error ({response.status_code}): {response.text}")
+    
+    order = response.json()
+    paypal_log.info("PayPal order created", extra={
+        "items": dict(cart),
+        "order_id": order['id'],
+        "amount": f"{cart_total(cart)} {catalog[cart[0][0]]['currency']}"
+    })
+    # Full response dumps are sampled (LOG_DEBUG_SAMPLE_RATE)
+    paypal_log.debug("PayPal order response", extra={"url": url, "links": order['links']})
+    
+    # Get approval URL
+    approval_url = next(
+        link['href'] for link in order['links'] 
+        if link['rel'] == 'approve'
+    )
+    
+    # Verify it's a sandbox URL
+    if PAYPAL_MODE == 'sandbox' and 'sandbox.paypal.com' not in approval_url:
+        paypal_log.warning("Sandbox order returned a non-sandbox approval URL", extra={
+            "checkout_url": approval_url
+        })
+    
+    return checkout_result(cart, order['id'], approval_url)
+
+def checkout_result(cart, order_id, checkout_url):
+    """create_paypal_checkout result for a created order"""
+    return {
+        "success": True,
+        "checkout_url": checkout_url,
+        "order_id": order_id,
+        "items": [{"product_id": pid, "quantity": quantity} for pid, quantity in cart],
+        "total": cart_total(cart)
+    }
+
+def create_paypal_checkout(product_id=None, quantity=1, items=None):
+    """Create PayPal order for instant checkout of one card or a cart"""
     try:
-        if product_id not in PRODUCTS:
-            error_msg = f"Invalid product ID: {product_id}"
-            print(f"❌ {error_msg}")
-            return json.dumps({"error": error_msg})
+        try:
+            cart = normalize_cart(product_id, quantity, items)
+        except ValueError as e:
+            paypal_log.warning("Checkout requested for an invalid cart", extra={
+                "product_id": product_id,
+                "quantity": quantity,
+                "items": items
+            })
+            return json.dumps({"error": str(e)})
         
-        product = PRODUCTS[product_id]
-        print(f"✅ Product found: {product['name']} - ${product['price']}")
+        # Hand out a pre-created order if the pool has one ready (single cards only)
+        single = cart[0][0] if len(cart) == 1 and cart[0][1] == 1 else None
+        result = order_pool.take(single) if ORDER_POOL_DEPTH and single else None
+        if result:
+            paypal_log.info("Using pre-created order", extra={
+                "product_id": single,
+                "order_id": result['order_id']
+            })
+        else:
+            result = create_paypal_order(cart)
         
+        return json.dumps(result)
+    
+    except (PayPalError, CircuitOpen) as e:
+        return json.dumps({"error": str(e)})
+    
+    except Exception as e:
+        error_msg = f"Exception: {str(e)}"
+        paypal_log.exception("Checkout failed", extra={"product_id": product_id, "items": items})
+        return json.dumps({"error": error_msg})
+
+# Batch checkout (POST /checkout/batch) for bulk orders without the LLM.
+# A PayPal order holds up to BATCH_MAX_ORDER_LINES different cards and at most
+# BATCH_MAX_ORDER_TOTAL in its currency; bigger batches are split over orders.
+BATCH_MAX_CARDS = int(os.getenv('BATCH_MAX_CARDS', '5000'))
+BATCH_MAX_ORDER_LINES = int(os.getenv('BATCH_MAX_ORDER_LINES', '50'))
+BATCH_MAX_ORDER_TOTAL = float(os.getenv('BATCH_MAX_ORDER_TOTAL', '10000'))
+# Orders of one batch created at once, over the pooled PayPal session
+BATCH_ORDER_WORKERS = int(os.getenv('BATCH_ORDER_WORKERS', '8'))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_ORDER_WORKERS, thread_name_prefix='batch-order')
+
+def normalize_batch(items):
+    """Validate batch lines in one pass, returning (cart, errors)
+    
+    `cart` is [(product_id, quantity), ...] with repeated products merged in
+    first-mention order; `errors` lists every problem found, by line.
+    """
+    if not isinstance(items, list) or not items:
+        return [], ["items must be a non-empty list of {product_id, quantity}"]
+    cart, errors = {}, []
+    for index, line in enumerate(items):
+        line_product = line.get('product_id') if isinstance(line, dict) else None
+        if line_product not in catalog:
+            errors.append(f"Line {index}: invalid product ID {line_product!r}")
+            continue
+        try:
+            line_quantity = int(line.get('quantity', 1))
+        except (TypeError, ValueError):
+            line_quantity = 0
+        if line_quantity < 1:
+            errors.append(f"Line {index}: invalid quantity {line.get('quantity')!r} for {line_product}")
+            continue
+        if catalog[line_product]['price'] > BATCH_MAX_ORDER_TOTAL:
+            errors.append(f"Line {index}: {line_product} costs more than one order may total")
+            continue
+        cart[line_product] = cart.get(line_product, 0) + line_quantity
+    cards = sum(cart.values())
+    if cards > BATCH_MAX_CARDS:
+        errors.append(f"At most {BATCH_MAX_CARDS} cards per batch, got {cards}")
+    return list(cart.items()), errors
+
+def plan_batch_orders(cart):
+    """Split a batch cart into as few PayPal orders as the per-order limits allow
+    
+    Orders never mix currencies. Each is filled up to BATCH_MAX_ORDER_LINES
+    lines and BATCH_MAX_ORDER_TOTAL before the next is started, splitting a
+    product's quantity across orders where needed.
+    """
+    by_currency = {}
+    for product_id, quantity in cart:
+        by_currency.setdefault(catalog[product_id]['currency'], []).append((product_id, quantity))
+    # Whole cents, so the totals add up exactly
+    limit = round(BATCH_MAX_ORDER_TOTAL * 100)
+    orders = []
+    for lines in by_currency.values():
+        order, total = [], 0
+        for product_id, quantity in lines:
+            price = round(catalog[product_id]['price'] * 100)
+            while quantity:
+                fits = (limit - total) // price
+                if len(order) >= BATCH_MAX_ORDER_LINES or not fits:
+                    orders.append(order)
+                    order, total = [], 0
+                    continue
+                taken = min(quantity, fits)
+                order.append((product_id, taken))
+                total += taken * price
+                quantity -= taken
+        if order:
+            orders.append(order)
+    return orders
+
+def batch_order_outcome(index, order, result=None, error=None):
+    """Body of the `order` (or, with `error`, `order_error`) event for one order of a batch"""
+    if error is not None:
+        paypal_log.warning("Batch order failed", extra={"index": index, "error": str(error)})
+        return {
+            "index": index,
+            "items": [{"product_id": pid, "quantity": quantity} for pid, quantity in order],
+            "error": str(error)
+        }
+    return {"index": index, "currency": catalog[order[0][0]]['currency'], **result}
+
+def create_batch_order(index, order):
+    """Create one order of a batch, returning its batch_order_outcome"""
+    try:
+        return batch_order_outcome(index, order, create_paypal_order(order))
+    except Exception as e:
+        return batch_order_outcome(index, order, error=e)
+
+def batch_done(outcomes):
+    """Body of a batch's `done` event"""
+    totals = {}
+    for outcome in outcomes:
+        if 'error' not in outcome:
+            totals[outcome['currency']] = totals.get(outcome['currency'], 0) + round(float(outcome['total']) * 100)
+    created = sum('error' not in outcome for outcome in outcomes)
+    return {
+        "orders": created,
+        "failed": len(outcomes) - created,
+        "totals": {currency: f"{cents / 100:.2f}" for currency, cents in totals.items()}
+    }
+
+# Ready, unapproved PayPal orders per product, refilled in the background.
+# Off by default (ORDER_POOL_DEPTH=0) since every pooled order is a real PayPal order.
+ORDER_POOL_DEPTH = int(os.getenv('ORDER_POOL_DEPTH', '0'))
+# Products kept ready, as comma-separated IDs. There is no default: pooling
+# every product of a large catalog would hold depth x products real orders.
+ORDER_POOL_PRODUCTS = [pid.strip() for pid in os.getenv('ORDER_POOL_PRODUCTS', '').split(',') if pid.strip()]
+
+def pooled_products(catalog):
+    """The ORDER_POOL_PRODUCTS that are in the catalog"""
+    return [pid for pid in ORDER_POOL_PRODUCTS if pid in catalog]
+
+order_pool = OrderPool(
+    create_paypal_order,
+    pooled_products(catalog),
+    depth=ORDER_POOL_DEPTH,
+    # Unapproved orders expire after 3 hours; leave the buyer at least one
+    max_age=int(os.getenv('ORDER_POOL_MAX_AGE', '7200'))
+)
+
+def capture_order(order_id, payload):
+    """Capture an approved PayPal order and fulfil it (runs on a capture worker)
+    
+    Raises PermanentJobError if PayPal declines the capture, and DeferJob
+    while PayPal's circuit breaker is open (the wait doesn't use up an
+    attempt); any other exception is retried with backoff.
+    """
+    # Worker threads handle one job after another; start each with a fresh context
+    clear_log_context(order_id=order_id)
+    try:
         access_token = get_paypal_access_token()
         
-        api_base = PAYPAL_API_BASE[PAYPAL_MODE]
-        url = f"{api_base}/v2/checkout/orders"
-        
-        print(f"\n{'~'*60}")
-        print(f"📦 Creating PayPal Order")
-        print(f"{'~'*60}")
-        print(f"🌐 API Base URL: {api_base}")
-        print(f"🔗 Full API URL: {url}")
-        print(f"💰 Amount: ${product['price']} {product['currency']}")
-        
+        url = f"{PAYPAL_API_BASE[PAYPAL_MODE]}/v2/checkout/orders/{order_id}/capture"
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {access_token}"
+            "Authorization": f"Bearer {access_token}",
+            # Same order always maps to the same key so retried captures are harmless
+            "PayPal-Request-Id": f"capture-{order_id}"
         }
         
-        order_data = {
-            "intent": "CAPTURE",
-            "purchase_units": [{
-                "reference_id": product_id,
-                "description": product['description'],
-                "amount": {
-                    "currency_code": product['currency'],
-                    "value": str(product['price'])
-                },
-                "custom_id": f"gift_card_{datetime.now().timestamp()}"
-            }],
-            "application_context": {
-                "brand_name": "Gift Card Store",
-                "landing_page": "NO_PREFERENCE",
-                "user_action": "PAY_NOW",
-                "return_url": "http://localhost:3000/success",
-                "cancel_url": "http://localhost:3000/cancel"
-            }
-        }
-        
-        print(f"📤 Sending order to PayPal...")
-        response = requests.post(url, headers=headers, json=order_data)
-        
-        print(f"\n{'*'*60}")
-        print(f"📥 PayPal Response")
-        print(f"{'*'*60}")
-        print(f"Status Code: {response.status_code}")
-        
-        if response.status_code == 201:
-            order = response.json()
-            print(f"✅ Order Created Successfully!")
-            print(f"Order ID: {order['id']}")
-            print(f"\nAvailable Links:")
-            for link in order['links']:
-                print(f"  - {link['rel']}: {link['href']}")
-            
-            # Get approval URL
-            approval_url = next(
-                link['href'] for link in order['links'] 
-                if link['rel'] == 'approve'
-            )
-            
-            result = {
-                "success": True,
-                "checkout_url": approval_url,
-                "order_id": order['id']
-            }
-            
-            print(f"\n{'🎯'*30}")
-            print(f"🔗 CHECKOUT URL TO USE:")
-            print(f"{'🎯'*30}")
-            print(f"{approval_url}")
-            print(f"{'🎯'*30}")
-            
-            # Verify it's a sandbox URL
-            if PAYPAL_MODE == 'sandbox' and 'sandbox.paypal.com' not in approval_url:
-                print(f"\n⚠️  WARNING: URL does not contain 'sandbox'!")
-                print(f"Expected: https://www.sandbox.paypal.com/...")
-                print(f"Got: {approval_url}")
-            elif PAYPAL_MODE == 'sandbox' and 'sandbox.paypal.com' in approval_url:
-                print(f"\n✅ Correct! This is a SANDBOX URL")
-            
-            print(f"{'='*60}\n")
-            
-            return json.dumps(result)
-        else:
-            error_msg = f"PayPal API error ({response.status_code}): {response.text}"
-            print(f"❌ {error_msg}")
-            print(f"Response Body: {response.text}")
-            print(f"{'='*60}\n")
-            return json.dumps({"error": error_msg})
-            
-    except Exception as e:
-        error_msg = f"Exception: {str(e)}"
-        print(f"❌ {error_msg}")
-        print(f"{'='*60}\n")
-        return json.dumps({"error": error_msg})
+        paypal_log.info("Capturing PayPal order")
+        with metrics.span('paypal.capture'):
+            response = paypal_client.post(url, headers=headers)
+    except CircuitOpen as e:
+        raise DeferJob(str(e), e.retry_after)
+    
+    if response.status_code == 401:
+        paypal_token_cache.invalidate()
+        raise Exception("PayPal rejected the access token")
+    
+    if response.status_code in [200, 201]:
+        capture_status = response.json()['status']
+    elif 'ORDER_ALREADY_CAPTURED' in response.text:
+        capture_status = 'COMPLETED'
+    elif response.status_code in [400, 403, 404, 422]:
+        raise PermanentJobError(f"Capture failed: {response.text}")
+    else:
+        raise Exception(f"Capture failed ({response.status_code}): {response.text}")
+    
+    paypal_log.info("PayPal order captured", extra={"capture_status": capture_status})
+    
+    # TODO: Save order to database
+    # TODO: Generate and send gift card code
+    # TODO: Send confirmation email
+    
+    return {"status": capture_status}
+
+def capture_status_body(job):
+    """Response body describing a capture job"""
+    return {
+        "success": job['status'] != 'failed',
+        "order_id": job['key'],
+        # queued, running, retrying, completed or failed
+        "status": job['status'],
+        "capture_status": (job['result'] or {}).get('status'),
+        "attempts": job['attempts'],
+        "error": job['error'],
+        "status_url": f"/capture-payment/{job['key']}"
+    }
+
+# Durable capture/fulfilment queue, so PayPal latency and fulfilment work stay
+# off the request path. Jobs are keyed on order_id, so duplicate captures are no-ops.
+capture_queue = JobQueue(
+    capture_order,
+    path=os.getenv('CAPTURE_QUEUE_PATH', 'jobs.db'),
+    workers=int(os.getenv('CAPTURE_WORKERS', '2')),
+    # With the default backoff, 10 attempts ride out about 13 minutes of PayPal errors
+    max_attempts=int(os.getenv('CAPTURE_MAX_ATTEMPTS', '10')),
+    backoff=float(os.getenv('CAPTURE_RETRY_BACKOFF', '2'))
+)
 
 # Function mapping
 FUNCTION_MAP = {
@@ -250,67 +747,634 @@ FUNCTION_MAP = {
     "create_paypal_checkout": create_paypal_checkout
 }
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    """Handle chat messages with Perplexity AI"""
-    data = request.json
-    user_message = data.get('message', '')
-    session_id = data.get('session_id', 'default')
-    
-    # Initialize or get conversation history
-    if session_id not in conversations:
-        conversations[session_id] = []
+# All tool calls of one assistant turn run concurrently on this pool, so a turn
+# with several checkouts waits for PayPal once instead of once per call
+TOOL_CALL_WORKERS = int(os.getenv('TOOL_CALL_WORKERS', '4'))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_CALL_WORKERS, thread_name_prefix='tool-call')
+
+def call_tool(function_name, function_args):
+    """Run one tool from FUNCTION_MAP, returning its JSON result"""
+    function = FUNCTION_MAP.get(function_name)
+    if function is None:
+        chat_log.warning("AI called an unknown tool", extra={"tool": function_name})
+        return json.dumps({"error": f"Unknown function: {function_name}"})
+    if function_args is None:
+        return MERGED_CHECKOUT_RESULT
+    return function(**function_args)
+
+def run_tool_calls(calls):
+    """Run parsed tool calls concurrently, returning their results in call order
     
-    # Add user message to history
-    conversations[session_id].append({
-        "role": "user",
-        "content": user_message
-    })
+    Each call runs in a copy of the request's context, so its logs and spans
+    stay attached to the request.
+    """
+    if len(calls) == 1:
+        _, function_name, function_args = calls[0]
+        return [call_tool(function_name, function_args)]
+    futures = [
+        tool_executor.submit(contextvars.copy_context().run, call_tool, function_name, function_args)
+        for _, function_name, function_args in calls
+    ]
+    return [future.result() for future in futures]
+
+# Answers obvious catalog and purchase messages without calling Perplexity
+INTENT_ROUTER_ENABLED = os.getenv('INTENT_ROUTER', 'on') != 'off'
+# Its patterns are compiled from the tool schema by the first message routed
+intent_router = IntentRouter(
+    catalog,
+    chat_tools,
+    min_confidence=float(os.getenv('INTENT_ROUTER_MIN_CONFIDENCE', '0.8'))
+)
+
+def route_intent(user_message):
+    """Return a high-confidence Intent for the message, or None to use the LLM"""
+    if not INTENT_ROUTER_ENABLED:
+        return None
+    return intent_router.route(user_message)
+
+def routed_turn(intent, function_response):
+    """History messages and templated reply for a turn answered by the router
     
-    try:
-        # Call Perplexity API with function calling
-        headers = {
-            "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-            "Content-Type": "application/json"
+    The turn is recorded as a tool call plus result, exactly as if the LLM had
+    made the call, so later completions see a consistent history.
+    """
+    call_id = f"call_router_{uuid.uuid4().hex[:12]}"
+    messages = [
+        {
+            "role": "assistant",
+            "content": "",
+            "tool_calls": [{
+                "id": call_id,
+                "type": "function",
+                "function": {"name": intent.tool, "arguments": json.dumps(intent.arguments)}
+            }]
+        },
+        {
+            "role": "tool",
+            "tool_call_id": call_id,
+            "content": function_response
         }
-        
-        payload = {
-            "model": "sonar-pro",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": """You are a helpful gift card sales assistant for our Gift Card Store.
+    ]
+    return messages, intent_router.reply(intent, json.loads(function_response))
+
+def fallback_intent(user_message):
+    """What to do with a turn while Perplexity is unavailable
+    
+    A confident router intent (even with INTENT_ROUTER=off), otherwise the
+    catalog, so customers can keep browsing and buying without the LLM.
+    """
+    intent = intent_router.classify(user_message)
+    if intent is not None and intent.confidence >= intent_router.min_confidence:
+        return intent
+    return Intent('list_gift_cards', {}, 0.0)
+
+def fallback_turn(intent, function_response):
+    """History messages and templated reply for a turn answered by fallback_intent"""
+    chat_log.warning("Answered without Perplexity", extra={"tool": intent.tool, "arguments": intent.arguments})
+    messages, reply = routed_turn(intent, function_response)
+    if not intent.confidence:
+        reply = "Sorry, I can't answer that in detail right now. " + reply
+    return messages, reply
+
+def fallback_followup(calls, function_responses):
+    """Templated reply to tool results when the follow-up completion can't be made"""
+    chat_log.warning("Follow-up answered without Perplexity", extra={"tool": calls[0][1]})
+    # A checkout, if there is one, is what the customer needs to hear about
+    for (_, function_name, function_args), function_response in zip(calls, function_responses):
+        if checkout_url_from(function_response):
+            break
+    else:
+        (_, function_name, function_args), function_response = calls[0], function_responses[0]
+    return intent_router.reply(Intent(function_name, function_args, 0.0), json.loads(function_response))
+
+# System prompt for the first completion of each turn, completed from the catalog
+CHAT_SYSTEM_PROMPT_TEMPLATE = """You are a helpful gift card sales assistant for our Gift Card Store.
 
 AVAILABLE PRODUCTS:
-- gc_25: $25 Gift Card ($25.00 USD)
-- gc_50: $50 Gift Card ($50.00 USD)  
-- gc_100: $100 Gift Card ($100.00 USD)
+{products}
 
 CRITICAL INSTRUCTIONS:
 1. When user asks what's available, use the list_gift_cards function
 2. When user wants to buy ANY gift card, you MUST immediately call the create_paypal_checkout function
 3. DO NOT just talk about calling the function - ACTUALLY CALL IT
-4. Use ONLY the product_id parameter with values: gc_25, gc_50, or gc_100
-5. After the function returns a checkout URL, tell user to click the button
+4. Use the product_id parameter with {product_ids} (add quantity for several of the same card)
+5. When user wants different cards at once, make ONE create_paypal_checkout call with the items parameter
+6. After the function returns a checkout URL, tell user to click the button
 
 Example correct behavior:
-User: "I want the $50 card"
-You: [CALL create_paypal_checkout function with product_id="gc_50"]
+User: "I want the {example_name}"
+You: [CALL create_paypal_checkout function with product_id="{example_id}"]
 Then: "Great! Please click the PayPal button below to complete your purchase."
 
 DO NOT output JSON in your response. Just call the function directly."""
-                }
-            ] + conversations[session_id],
-            "tools": TOOLS,
-            "tool_choice": "auto",
-            "temperature": 0.1
+
+def build_chat_system_prompt(catalog):
+    """CHAT_SYSTEM_PROMPT_TEMPLATE for the catalog: small ones are listed in full"""
+    product_ids = list(catalog)
+    if len(product_ids) <= CATALOG_INLINE_LIMIT:
+        products = "\n".join(
+            f"- {pid}: {catalog[pid]['name']} ({catalog[pid]['price']:.2f} {catalog[pid]['currency']})"
+            for pid in product_ids
+        )
+        id_values = "values: " + ", ".join(product_ids[:-1]) + (", or " if len(product_ids) > 1 else "") + product_ids[-1]
+    else:
+        low, high = catalog.price_range()
+        products = (f"{len(product_ids)} gift cards from {low:.2f} to {high:.2f} ({', '.join(catalog.currencies)}). "
+                    f"Use list_gift_cards with a query, price range or currency to find the right card and its product ID.")
+        id_values = "a product ID returned by list_gift_cards (never guess one)"
+    example = catalog[product_ids[len(product_ids) // 2]]
+    return CHAT_SYSTEM_PROMPT_TEMPLATE.format(
+        products=products,
+        product_ids=id_values,
+        example_name=example['name'],
+        example_id=example['id']
+    )
+
+def chat_system_prompt():
+    """System prompt for the current catalog"""
+    return catalog.derived('chat_system_prompt', build_chat_system_prompt)
+
+# System prompt for the completion that follows a tool call
+FOLLOWUP_SYSTEM_PROMPT = """You are a helpful gift card sales assistant. You can:
+1. Show available gift cards when asked
+2. Help users purchase gift cards by creating PayPal checkout sessions
+3. Answer questions about the products
+
+IMPORTANT: When you receive a checkout URL from the create_paypal_checkout function,
+you MUST include that EXACT URL in your response. Do not modify it or create your own URL.
+Tell the user to click the PayPal button that will appear below your message.
+
+Be friendly and guide users through the purchase process."""
+
+# Follow-up replies after a tool call, reused for tool results of the same shape.
+# Opt-in per tool, e.g. REPLY_CACHE_TOOLS=list_gift_cards,create_paypal_checkout
+reply_cache = ReplyCache(
+    tools=[name.strip() for name in os.getenv('REPLY_CACHE_TOOLS', '').split(',') if name.strip()],
+    max_entries=int(os.getenv('REPLY_CACHE_MAX_ENTRIES', '1000')),
+    ttl=int(os.getenv('REPLY_CACHE_TTL', '3600'))
+)
+
+def followup_cache_key(function_name, function_args, function_response):
+    """Reply cache key for the completion that follows this tool call (None if uncached)"""
+    return reply_cache.key(FOLLOWUP_SYSTEM_PROMPT, function_name, function_args, function_response)
+
+def perplexity_headers():
+    """Headers for Perplexity chat completion requests"""
+    return {
+        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+def perplexity_post(payload, **kwargs):
+    """POST a completion payload; returns None if Perplexity is unavailable
+    
+    Unavailable means its circuit breaker is open, the request failed or
+    timed out, or it answered 429/5xx. Completion POSTs are not retried
+    (only failed connects are), so one such answer is enough. Other errors
+    (a bad key or model) come back as the response.
+    """
+    import requests  # loaded with perplexity_client's session
+    
+    try:
+        response = perplexity_client.post(
+            PERPLEXITY_API_URL,
+            headers=perplexity_headers(),
+            data=payload.body,
+            **kwargs
+        )
+    except (CircuitOpen, requests.RequestException) as e:
+        chat_log.warning("Perplexity unavailable", extra={"error": str(e)})
+        return None
+    if failed_status(response.status_code):
+        chat_log.warning("Perplexity unavailable", extra={"status": response.status_code})
+        response.close()
+        return None
+    return response
+
+# Model parameters sent with every completion, next to the tool schema
+CHAT_PARAMS = {
+    "model": "sonar-pro",
+    "tool_choice": "auto",
+    "temperature": 0.1
+}
+
+def chat_params():
+    """CHAT_PARAMS with the tool schema for the current catalog"""
+    return {**CHAT_PARAMS, "tools": chat_tools()}
+
+# Encodes chat_params() (on the first request) and the system prompts once,
+# and each session's messages only once, instead of re-serializing the whole
+# request per call. JSON_BACKEND=auto uses orjson when it is installed.
+payload_builder = PayloadBuilder(
+    chat_params,
+    backend=os.getenv('JSON_BACKEND', 'auto'),
+    max_sessions=int(os.getenv('SESSION_MAX_SESSIONS', '10000'))
+)
+
+def apply_catalog(catalog):
+    """Drop the encoded tool schema and router patterns after the catalog changed
+    
+    Both are rebuilt from the new catalog on first use, as are the tool
+    schema and system prompt themselves. Pooled orders were created at the
+    old prices, so the order pool is emptied and refilled.
+    """
+    payload_builder.set_params(chat_params)
+    intent_router.load(catalog, chat_tools)
+    order_pool.set_products(pooled_products(catalog))
+
+catalog.on_change(apply_catalog)
+
+def build_chat_payload(system_prompt, messages, summary=None):
+    """Build the Perplexity chat completion request body as a dict
+    
+    `summary` (from the context window) goes in a second system message.
+    This is what payload_builder encodes; requests are sent pre-encoded.
+    """
+    system_messages = [
+        {
+            "role": "system",
+            "content": system_prompt
         }
+    ]
+    if summary:
+        system_messages.append({
+            "role": "system",
+            "content": summary
+        })
+    return {
+        "messages": system_messages + messages,
+        **chat_params()
+    }
+
+def repair_tool_arguments(function_name, function_args):
+    """Map common argument mistakes from the AI onto a valid call
+    
+    Returns the (possibly corrected) arguments, or None if they can't be fixed.
+    """
+    if function_name != 'create_paypal_checkout' or 'product_id' in function_args or function_args.get('items'):
+        return function_args
+    
+    chat_log.warning("AI called create_paypal_checkout without product_id", extra={"arguments": function_args})
+    
+    # Try to map common mistakes
+    if 'amount' in function_args or 'product' in function_args:
+        # Try to infer the correct product_id: the card closest to the amount
+        try:
+            amount = float(function_args.get('amount', 0))
+        except (TypeError, ValueError):
+            amount = 0.0
+        function_args = {'product_id': catalog.nearest(amount)}
+        chat_log.info("Auto-corrected tool arguments", extra={"arguments": function_args})
+        return function_args
+    return None
+
+# Error responses for tool calls whose arguments can't be used
+INVALID_TOOL_ARGUMENTS = ({"error": "Invalid function arguments from AI"}, 500)
+
+def build_wrong_tool_parameters(catalog):
+    """Error response for a checkout call without a usable product, naming the cards on offer"""
+    names = [catalog[pid]['name'] for pid in catalog]
+    if len(names) <= CATALOG_INLINE_LIMIT:
+        choices = ": " + ", ".join(names[:-1]) + (", or " if len(names) > 1 else "") + names[-1] + "?"
+    else:
+        choices = ", or ask me to list them."
+    return ({
+        "error": "AI used wrong function parameters. Please try again.",
+        "response": "I apologize, there was an error. Please tell me which gift card you'd like" + choices
+    }, 200)
+
+def parse_tool_calls(tool_calls):
+    """Parse and repair every tool call of an assistant message
+    
+    Returns ([(tool_call, function_name, function_args), ...], None), or
+    (None, (body, status)) for the first call whose arguments can't be used.
+    """
+    calls = []
+    for tool_call in tool_calls:
+        function_name = tool_call['function']['name']
+        try:
+            function_args = json.loads(tool_call['function']['arguments'] or '{}')
+        except json.JSONDecodeError:
+            chat_log.warning("AI sent unparseable tool arguments", extra={
+                "tool": function_name,
+                "arguments": tool_call['function']['arguments']
+            })
+            return None, INVALID_TOOL_ARGUMENTS
         
-        response = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers=headers,
-            json=payload
-        )
+        function_args = repair_tool_arguments(function_name, function_args)
+        if function_args is None:
+            return None, catalog.derived('wrong_tool_parameters', build_wrong_tool_parameters)
+        calls.append((tool_call, function_name, function_args))
+    return merge_checkout_calls(calls), None
+
+# Result for a checkout call folded into an earlier one by merge_checkout_calls
+MERGED_CHECKOUT_RESULT = json.dumps({
+    "merged": True,
+    "note": "These gift cards were added to the order of the first create_paypal_checkout call"
+})
+
+def merge_checkout_calls(calls):
+    """Fold every create_paypal_checkout call of a turn into the first one, as one cart
+    
+    Separate calls would create one PayPal order each, and the reply only
+    carries one checkout URL. The folded calls keep their place, since each
+    needs a tool result, with None arguments: they are answered with
+    MERGED_CHECKOUT_RESULT instead of being run.
+    """
+    checkouts = [index for index, (_, name, _) in enumerate(calls) if name == 'create_paypal_checkout']
+    if len(checkouts) < 2:
+        return calls
+    items = []
+    for index in checkouts:
+        function_args = calls[index][2]
+        items.extend(function_args.get('items') or [{
+            "product_id": function_args.get('product_id'),
+            "quantity": function_args.get('quantity')
+        }])
+    chat_log.info("Merged checkout calls into one cart", extra={"calls": len(checkouts), "items": items})
+    merged = list(calls)
+    merged[checkouts[0]] = (calls[checkouts[0]][0], 'create_paypal_checkout', {"items": items})
+    for index in checkouts[1:]:
+        merged[index] = (calls[index][0], 'create_paypal_checkout', None)
+    return merged
+
+def tool_result_messages(calls, function_responses):
+    """History entries for tool results, in the order the AI made the calls"""
+    return [
+        {
+            "role": "tool",
+            "tool_call_id": tool_call['id'],
+            "content": function_response
+        }
+        for (tool_call, _, _), function_response in zip(calls, function_responses)
+    ]
+
+def turn_followup_cache_key(calls, function_responses):
+    """Reply cache key for a turn's follow-up; only single-call turns are cached"""
+    if len(calls) != 1:
+        return None
+    _, function_name, function_args = calls[0]
+    return followup_cache_key(function_name, function_args, function_responses[0])
+
+def first_checkout_url(function_responses):
+    """Checkout URL of the first tool result that created an order"""
+    return next(filter(None, map(checkout_url_from, function_responses)), None)
+
+def detect_product_in_text(content):
+    """Fallback: find the product an AI reply talks about when it skipped the tool call
+    
+    Only a reply naming exactly one product (by ID or price) counts.
+    """
+    product_ids, _ = intent_router.products_mentioned(' '.join(content.lower().split()))
+    return product_ids.pop() if len(product_ids) == 1 else None
+
+# Share one Perplexity call among concurrent identical first messages (e.g. a
+# promo burst). Only history-free payloads qualify, so responses are unchanged.
+COALESCE_FIRST_TURN = os.getenv('COALESCE_FIRST_TURN', 'on') != 'off'
+
+def first_turn_coalesce_key(payload):
+    """Coalescing key for a completion whose only message is the user's first, else None"""
+    messages = payload.messages
+    if not COALESCE_FIRST_TURN or payload.summary or [m['role'] for m in messages] != ['user']:
+        return None
+    # Every other part of the body is the same for all requests
+    normalized = [payload.system_prompt, ' '.join((messages[0].get('content') or '').split())]
+    return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+def build_session_payload(system_prompt, session_id, history, stream=False):
+    """Encoded chat payload (a ChatPayload) for the session's context window"""
+    messages, summary = context_window.fit(session_id, history)
+    return payload_builder.build(system_prompt, messages, summary, session_id=session_id, stream=stream)
+
+def checkout_url_from(function_response):
+    """Extract the checkout URL from a create_paypal_checkout result"""
+    return json.loads(function_response).get('checkout_url')
+
+def completion_delta(line):
+    """The delta carried by one line of a streamed (SSE) Perplexity completion
+    
+    Returns {} for lines without one and None at the closing [DONE].
+    """
+    if not line or not line.startswith('data:'):
+        return {}
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return None
+    chunk = json.loads(data)
+    if not chunk.get('choices'):
+        return {}
+    return chunk['choices'][0].get('delta') or {}
+
+def merge_tool_call_fragments(tool_calls, delta):
+    """Join a delta's tool call fragments into `tool_calls`, keyed by call index"""
+    for fragment in delta.get('tool_calls') or []:
+        call = tool_calls.setdefault(fragment.get('index', 0), {
+            "id": None,
+            "type": "function",
+            "function": {"name": "", "arguments": ""}
+        })
+        if fragment.get('id'):
+            call['id'] = fragment['id']
+        function = fragment.get('function') or {}
+        if function.get('name'):
+            call['function']['name'] += function['name']
+        if function.get('arguments'):
+            call['function']['arguments'] += function['arguments']
+
+def streamed_message(content, tool_calls):
+    """Assemble the assistant message from streamed content fragments and tool calls"""
+    message = {"role": "assistant", "content": ''.join(content)}
+    if tool_calls:
+        message['tool_calls'] = [tool_calls[index] for index in sorted(tool_calls)]
+    return message
+
+def iter_completion_stream(response):
+    """Parse a streamed (SSE) Perplexity completion
+    
+    Yields content fragments as they arrive and returns the assembled
+    assistant message, with tool call arguments joined across chunks.
+    """
+    content = []
+    tool_calls = {}
+    # SSE is always UTF-8; without a charset requests would decode as ISO-8859-1
+    response.encoding = 'utf-8'
+    for line in response.iter_lines(decode_unicode=True):
+        delta = completion_delta(line)
+        if delta is None:
+            break
+        
+        if delta.get('content'):
+            content.append(delta['content'])
+            yield delta['content']
+        
+        merge_tool_call_fragments(tool_calls, delta)
+    
+    return streamed_message(content, tool_calls)
+
+def sse_event(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def checkout_event(function_response):
+    """SSE `checkout` event for a create_paypal_checkout result"""
+    function_result = json.loads(function_response)
+    return sse_event('checkout', {
+        "checkout_url": function_result['checkout_url'],
+        "order_id": function_result.get('order_id')
+    })
+
+def relay_tokens(fragments):
+    """Forward completion fragments as SSE `token` events, returning the final message"""
+    while True:
+        try:
+            fragment = next(fragments)
+        except StopIteration as finished:
+            return finished.value
+        yield sse_event('token', {"content": fragment})
+
+# Token buckets in front of /chat and /chat/stream: RATE_LIMIT_SESSION_RATE
+# messages/second per session with bursts of RATE_LIMIT_SESSION_BURST, and the
+# same per client IP (a rate of 0 disables a limit). Buckets are per worker.
+# session_id is chosen by the client, so only the per-IP limit, off by default
+# because every client behind an untrusted proxy shares one address, stops a
+# bot that sends each message under a new session.
+session_limiter = RateLimiter(
+    rate=float(os.getenv('RATE_LIMIT_SESSION_RATE', '0.5')),
+    burst=int(os.getenv('RATE_LIMIT_SESSION_BURST', '10'))
+)
+ip_limiter = RateLimiter(
+    rate=float(os.getenv('RATE_LIMIT_IP_RATE', '0')),
+    burst=int(os.getenv('RATE_LIMIT_IP_BURST', '50'))
+)
+# A stricter bucket per client IP for /checkout/batch, whose one request may
+# create many PayPal orders: RATE_LIMIT_BATCH_RATE batches/second, bursts of
+# RATE_LIMIT_BATCH_BURST. On by default, unlike the chat limits.
+batch_limiter = RateLimiter(
+    rate=float(os.getenv('RATE_LIMIT_BATCH_RATE', '0.05')),
+    burst=int(os.getenv('RATE_LIMIT_BATCH_BURST', '3'))
+)
+# Proxies in front of the app that append to X-Forwarded-For: 'off' (the
+# peer address is the client), 'on' (one proxy) or a count of chained proxies
+TRUST_FORWARDED_FOR = {'off': 0, 'on': 1}.get(os.getenv('TRUST_FORWARDED_FOR', 'off'))
+if TRUST_FORWARDED_FOR is None:
+    TRUST_FORWARDED_FOR = int(os.getenv('TRUST_FORWARDED_FOR'))
+
+def forwarded_client_ip(forwarded_for, remote_addr):
+    """Client address from an X-Forwarded-For header and the peer address
+    
+    Each trusted proxy appends the address it got the request from, so the
+    client is TRUST_FORWARDED_FOR entries from the right. Entries to the
+    left of it were sent by the client and may be forged.
+    """
+    if not TRUST_FORWARDED_FOR:
+        return remote_addr
+    hops = [hop.strip() for hop in (forwarded_for or '').split(',') if hop.strip()]
+    if len(hops) < TRUST_FORWARDED_FOR:
+        # Did not come through every proxy: only the peer address can be trusted
+        return remote_addr
+    return hops[-TRUST_FORWARDED_FOR]
+
+# At most ADMISSION_MAX_IN_FLIGHT turns wait on Perplexity at once (0: no limit);
+# ADMISSION_MAX_QUEUE more wait up to ADMISSION_QUEUE_TIMEOUT seconds for a slot
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '256'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '512'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '2'))
+admission = AdmissionGate(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+
+def too_many_requests(reason, retry_after):
+    """Body of a 429 response, with `retry_after` rounded up to whole seconds"""
+    seconds = max(1, math.ceil(retry_after))
+    chat_log.info("Request turned away", extra={"reason": reason, "retry_after": seconds})
+    return {
+        "error": "Too many requests, please try again shortly",
+        "reason": reason,
+        "retry_after": seconds
+    }
+
+def rejected(reason, retry_after):
+    """Flask 429 response with a Retry-After header"""
+    body = too_many_requests(reason, retry_after)
+    return jsonify(body), 429, {"Retry-After": str(body['retry_after'])}
+
+# Per-IP buckets by endpoint, with the reason a rejection reports
+CLIENT_RATE_LIMITS = {
+    'giftcards.chat': (ip_limiter, 'ip_rate'),
+    'giftcards.chat_stream': (ip_limiter, 'ip_rate'),
+    'giftcards.checkout_batch': (batch_limiter, 'batch_rate'),
+}
+
+@api.before_app_request
+def limit_client_rate():
+    """Per-IP token buckets for the chat and batch checkout endpoints"""
+    limit = CLIENT_RATE_LIMITS.get(request.endpoint)
+    if limit is None:
+        return None
+    limiter, reason = limit
+    client_ip = forwarded_client_ip(request.headers.get('X-Forwarded-For'), request.remote_addr)
+    retry_after = limiter.acquire(client_ip)
+    if retry_after:
+        return rejected(reason, retry_after)
+    return None
+
+@api.route('/chat', methods=['POST'])
+def chat():
+    """Handle chat messages with Perplexity AI"""
+    data = request.json
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', 'default')
+    bind_log_context(session_id=session_id)
+    
+    retry_after = session_limiter.acquire(session_id)
+    if retry_after:
+        return rejected('session_rate', retry_after)
+    
+    # Load conversation history
+    with metrics.span('session.load'):
+        history = session_store.load(session_id)
+    
+    # Add user message to history
+    history.append({
+        "role": "user",
+        "content": user_message
+    })
+    
+    admitted_at = None
+    try:
+        # Fast path: obvious catalog/purchase requests skip the LLM entirely
+        with metrics.span('router'):
+            intent = route_intent(user_message)
+        if intent:
+            chat_log.info("Routed without LLM", extra={"tool": intent.tool, "arguments": intent.arguments})
+            function_response = FUNCTION_MAP[intent.tool](**intent.arguments)
+            messages, reply = routed_turn(intent, function_response)
+            history.extend(messages)
+            return jsonify({
+                "response": reply,
+                "checkout_url": checkout_url_from(function_response),
+                "session_id": session_id
+            })
+        
+        # Only turns that need Perplexity count against the concurrency limit
+        with metrics.span('admission.wait'):
+            admitted_at = admission.acquire()
+        
+        # Call Perplexity API with function calling
+        payload = build_session_payload(chat_system_prompt(), session_id, history)
+        
+        with metrics.span('perplexity.completion'):
+            response = perplexity_post(payload, coalesce_key=first_turn_coalesce_key(payload), hedge=True)
+        
+        if response is None:
+            # Perplexity is down or shedding load: answer from templates instead
+            intent = fallback_intent(user_message)
+            function_response = FUNCTION_MAP[intent.tool](**intent.arguments)
+            messages, reply = fallback_turn(intent, function_response)
+            history.extend(messages)
+            return jsonify({
+                "response": reply,
+                "checkout_url": checkout_url_from(function_response),
+                "session_id": session_id
+            })
         
         if response.status_code != 200:
             return jsonify({
@@ -320,130 +1384,73 @@ DO NOT output JSON in your response. Just call the function directly."""
         response_data = response.json()
         assistant_message = response_data['choices'][0]['message']
         
-        print(f"\n{'📨'*30}")
-        print(f"AI Response received")
-        print(f"{'📨'*30}")
-        print(f"Has tool_calls: {bool(assistant_message.get('tool_calls'))}")
-        print(f"Content: {assistant_message.get('content', '')[:200]}")
-        print(f"{'📨'*30}\n")
+        chat_log.debug("AI response received", extra={
+            "has_tool_calls": bool(assistant_message.get('tool_calls')),
+            "content": (assistant_message.get('content') or '')[:200]
+        })
         
         # Initialize checkout_url
         checkout_url = None
         
         # Check if function calling is needed
         if assistant_message.get('tool_calls'):
-            tool_call = assistant_message['tool_calls'][0]
-            function_name = tool_call['function']['name']
-            
-            print(f"\n{'⚙️ '*30}")
-            print(f"🔧 Function Call Detected")
-            print(f"{'⚙️ '*30}")
-            print(f"Function: {function_name}")
-            print(f"Raw arguments: {tool_call['function']['arguments']}")
-            
-            try:
-                function_args = json.loads(tool_call['function']['arguments'])
-                print(f"Parsed arguments: {function_args}")
-            except json.JSONDecodeError as e:
-                print(f"❌ Failed to parse arguments: {e}")
-                return jsonify({"error": "Invalid function arguments from AI"}), 500
-            
-            # Validate arguments for create_paypal_checkout
-            if function_name == 'create_paypal_checkout':
-                if 'product_id' not in function_args:
-                    print(f"❌ Missing required parameter: product_id")
-                    print(f"⚠️  AI tried to use wrong parameters!")
-                    
-                    # Try to map common mistakes
-                    if 'amount' in function_args or 'product' in function_args:
-                        # Try to infer the correct product_id
-                        amount = function_args.get('amount', 0)
-                        if amount >= 90:
-                            function_args = {'product_id': 'gc_100'}
-                        elif amount >= 40:
-                            function_args = {'product_id': 'gc_50'}
-                        else:
-                            function_args = {'product_id': 'gc_25'}
-                        print(f"🔄 Auto-corrected to: {function_args}")
-                    else:
-                        return jsonify({
-                            "error": "AI used wrong function parameters. Please try again.",
-                            "response": "I apologize, there was an error. Please tell me which gift card you'd like: $25, $50, or $100?"
-                        }), 200
+            # Validate (and repair) the arguments of every call before running any
+            calls, error = parse_tool_calls(assistant_message['tool_calls'])
+            if error is not None:
+                body, status = error
+                return jsonify(body), status
             
-            print(f"✅ Calling function with: {function_args}")
-            print(f"{'⚙️ '*30}\n")
+            for _, function_name, function_args in calls:
+                chat_log.info("Calling tool", extra={"tool": function_name, "arguments": function_args})
             
-            # Execute function
-            function_response = FUNCTION_MAP[function_name](**function_args)
-            print(f"✅ Function response: {function_response}")
+            # Execute all calls at once
+            function_responses = run_tool_calls(calls)
+            for (_, function_name, _), function_response in zip(calls, function_responses):
+                chat_log.debug("Tool response", extra={"tool": function_name, "response": function_response})
             
-            # Add function call and response to history
-            conversations[session_id].append(assistant_message)
-            conversations[session_id].append({
-                "role": "tool",
-                "tool_call_id": tool_call['id'],
-                "content": function_response
-            })
-            
-            # Get final response from Perplexity
-            payload['messages'] = [
-                {
-                    "role": "system",
-                    "content": """You are a helpful gift card sales assistant. You can:
-1. Show available gift cards when asked
-2. Help users purchase gift cards by creating PayPal checkout sessions
-3. Answer questions about the products
-
-IMPORTANT: When you receive a checkout URL from the create_paypal_checkout function,
-you MUST include that EXACT URL in your response. Do not modify it or create your own URL.
-Tell the user to click the PayPal button that will appear below your message.
-
-Be friendly and guide users through the purchase process."""
-                }
-            ] + conversations[session_id]
-            
-            response = requests.post(
-                "https://api.perplexity.ai/chat/completions",
-                headers=headers,
-                json=payload
-            )
+            # Add function calls and responses to history
+            history.append(assistant_message)
+            history.extend(tool_result_messages(calls, function_responses))
             
-            if response.status_code != 200:
-                return jsonify({
-                    "error": f"Perplexity API error: {response.text}"
-                }), 500
-            
-            response_data = response.json()
-            assistant_message = response_data['choices'][0]['message']
+            # Get final response from Perplexity, unless an identical tool result was seen before
+            cache_key = turn_followup_cache_key(calls, function_responses)
+            cached_reply = reply_cache.get(cache_key, function_responses[0])
+            if cached_reply is not None:
+                chat_log.info("Follow-up reply served from cache", extra={"tool": calls[0][1]})
+                assistant_message = {"role": "assistant", "content": cached_reply}
+            else:
+                payload = build_session_payload(FOLLOWUP_SYSTEM_PROMPT, session_id, history)
+                
+                with metrics.span('perplexity.followup'):
+                    response = perplexity_post(payload, hedge=True)
+                
+                if response is None:
+                    # The tools already ran; describe their results from templates
+                    assistant_message = {
+                        "role": "assistant",
+                        "content": fallback_followup(calls, function_responses)
+                    }
+                elif response.status_code != 200:
+                    return jsonify({
+                        "error": f"Perplexity API error: {response.text}"
+                    }), 500
+                else:
+                    response_data = response.json()
+                    assistant_message = response_data['choices'][0]['message']
+                    reply_cache.put(cache_key, function_responses[0], assistant_message.get('content'))
             
-            # Parse the function response to extract checkout URL
-            function_result = json.loads(function_response)
-            checkout_url = function_result.get('checkout_url')
-            print(f"🔗 Checkout URL extracted: {checkout_url}")
+            # Parse the function responses to extract checkout URL
+            checkout_url = first_checkout_url(function_responses)
         else:
             # Fallback: Parse text response for product mentions
-            print(f"\n⚠️  No tool_calls detected. Trying text parsing fallback...")
-            content = assistant_message.get('content', '').lower()
+            content = assistant_message.get('content', '')
             
             # Check if user wants to buy and which product
-            if 'gc_50' in content or '$50' in content or '50' in content:
-                print(f"💡 Detected $50 gift card request in text")
-                function_response = create_paypal_checkout('gc_50')
-                function_result = json.loads(function_response)
-                checkout_url = function_result.get('checkout_url')
-            elif 'gc_100' in content or '$100' in content or '100' in content:
-                print(f"💡 Detected $100 gift card request in text")
-                function_response = create_paypal_checkout('gc_100')
-                function_result = json.loads(function_response)
-                checkout_url = function_result.get('checkout_url')
-            elif 'gc_25' in content or '$25' in content or '25' in content:
-                print(f"💡 Detected $25 gift card request in text")
-                function_response = create_paypal_checkout('gc_25')
-                function_result = json.loads(function_response)
-                checkout_url = function_result.get('checkout_url')
+            product_id = detect_product_in_text(content)
+            if product_id:
+                chat_log.info("No tool call; product detected in reply text", extra={"product_id": product_id})
+                checkout_url = checkout_url_from(create_paypal_checkout(product_id))
             else:
-                print(f"❌ Could not detect product selection")
                 checkout_url = None
         
         return jsonify({
@@ -452,54 +1459,363 @@ Be friendly and guide users through the purchase process."""
             "session_id": session_id
         })
         
+    except Overloaded as e:
+        # Not part of the conversation: the client sends it again later
+        history.pop()
+        return rejected(e.reason, e.retry_after)
+    
     except Exception as e:
+        chat_log.exception("Chat turn failed")
         return jsonify({"error": str(e)}), 500
+    
+    finally:
+        if admitted_at is not None:
+            admission.release(admitted_at)
+        with metrics.span('session.save'):
+            session_store.save(session_id, history)
 
-@app.route('/capture-payment', methods=['POST'])
-def capture_payment():
-    """Capture PayPal payment after user approval"""
+@api.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming variant of /chat using Server-Sent Events
+    
+    Events: `token` ({"content"}) for each text fragment, `checkout`
+    ({"checkout_url", "order_id"}) as soon as the PayPal order exists,
+    then `done` with the same body /chat returns, or `error`.
+    """
     data = request.json
-    order_id = data.get('order_id')
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', 'default')
     
-    try:
-        access_token = get_paypal_access_token()
-        
-        url = f"{PAYPAL_API_BASE[PAYPAL_MODE]}/v2/checkout/orders/{order_id}/capture"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {access_token}"
-        }
-        
-        response = requests.post(url, headers=headers)
-        
-        if response.status_code in [200, 201]:
-            capture_data = response.json()
+    bind_log_context(session_id=session_id)
+    
+    retry_after = session_limiter.acquire(session_id)
+    if retry_after:
+        return rejected('session_rate', retry_after)
+    
+    with metrics.span('session.load'):
+        history = session_store.load(session_id)
+    history.append({
+        "role": "user",
+        "content": user_message
+    })
+    
+    # Routed before the stream starts, so a turn that needs Perplexity can
+    # still be turned away with a 429 instead of an error event
+    with metrics.span('router'):
+        intent = route_intent(user_message)
+    admitted_at = None
+    if not intent:
+        try:
+            with metrics.span('admission.wait'):
+                admitted_at = admission.acquire()
+        except Overloaded as e:
+            return rejected(e.reason, e.retry_after)
+    
+    def stream_completion(system_prompt, stage):
+        """Relay one completion; returns None, before any token, if Perplexity is unavailable"""
+        payload = build_session_payload(system_prompt, session_id, history, stream=True)
+        # Includes the time spent relaying tokens to the browser
+        with metrics.span(stage):
+            response = perplexity_post(payload, stream=True)
+            if response is None:
+                return None
+            with response:
+                if response.status_code != 200:
+                    raise Exception(f"Perplexity API error: {response.text}")
+                return (yield from relay_tokens(iter_completion_stream(response)))
+    
+    def generate():
+        try:
+            assistant_message = None
+            if not intent:
+                assistant_message = yield from stream_completion(chat_system_prompt(), 'perplexity.completion')
             
-            # TODO: Save order to database
-            # TODO: Generate and send gift card code
-            # TODO: Send confirmation email
+            if assistant_message is None:
+                # Routed, or Perplexity is unavailable: answer from templates
+                if intent:
+                    function_response = FUNCTION_MAP[intent.tool](**intent.arguments)
+                    messages, reply = routed_turn(intent, function_response)
+                else:
+                    fallback = fallback_intent(user_message)
+                    function_response = FUNCTION_MAP[fallback.tool](**fallback.arguments)
+                    messages, reply = fallback_turn(fallback, function_response)
+                history.extend(messages)
+                checkout_url = checkout_url_from(function_response)
+                if checkout_url:
+                    yield checkout_event(function_response)
+                yield sse_event('token', {"content": reply})
+                yield sse_event('done', {
+                    "response": reply,
+                    "checkout_url": checkout_url,
+                    "session_id": session_id
+                })
+                return
             
-            return jsonify({
-                "success": True,
-                "order_id": order_id,
-                "status": capture_data['status']
-            })
-        else:
-            return jsonify({
-                "error": f"Capture failed: {response.text}"
-            }), 400
+            checkout_url = None
+            
+            if assistant_message.get('tool_calls'):
+                calls, error = parse_tool_calls(assistant_message['tool_calls'])
+                if error is not None:
+                    yield sse_event('error', error[0])
+                    return
+                for _, function_name, function_args in calls:
+                    chat_log.info("Streamed tool call", extra={"tool": function_name, "arguments": function_args})
+                
+                function_responses = run_tool_calls(calls)
+                checkout_url = first_checkout_url(function_responses)
+                for function_response in function_responses:
+                    if checkout_url_from(function_response):
+                        # Show the PayPal button before the follow-up text finishes
+                        yield checkout_event(function_response)
+                
+                history.append(assistant_message)
+                history.extend(tool_result_messages(calls, function_responses))
+                
+                cache_key = turn_followup_cache_key(calls, function_responses)
+                cached_reply = reply_cache.get(cache_key, function_responses[0])
+                if cached_reply is not None:
+                    yield sse_event('token', {"content": cached_reply})
+                    assistant_message = {"role": "assistant", "content": cached_reply}
+                else:
+                    assistant_message = yield from stream_completion(FOLLOWUP_SYSTEM_PROMPT, 'perplexity.followup')
+                    if assistant_message is None:
+                        reply = fallback_followup(calls, function_responses)
+                        yield sse_event('token', {"content": reply})
+                        assistant_message = {"role": "assistant", "content": reply}
+                    else:
+                        reply_cache.put(cache_key, function_responses[0], assistant_message.get('content'))
+            else:
+                # Fallback: Parse text response for product mentions
+                product_id = detect_product_in_text(assistant_message.get('content', ''))
+                if product_id:
+                    chat_log.info("No tool call; product detected in streamed text", extra={"product_id": product_id})
+                    function_response = create_paypal_checkout(product_id)
+                    checkout_url = checkout_url_from(function_response)
+                    if checkout_url:
+                        yield checkout_event(function_response)
             
+            yield sse_event('done', {
+                "response": assistant_message['content'],
+                "checkout_url": checkout_url,
+                "session_id": session_id
+            })
+        
+        except Exception as e:
+            chat_log.exception("Streamed chat turn failed")
+            yield sse_event('error', {"error": str(e)})
+        
+        finally:
+            # Also runs when the browser disconnects mid-stream
+            with metrics.span('session.save'):
+                session_store.save(session_id, history)
+            metrics.finish_trace(200)
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        # Stop reverse proxies from buffering the stream
+        "X-Accel-Buffering": "no"
+    })
+    if admitted_at is not None:
+        # Runs even if the client disconnects before the stream starts
+        response.call_on_close(lambda: admission.release(admitted_at))
+    return response
+
+@api.route('/checkout/batch', methods=['POST'])
+def checkout_batch():
+    """Create PayPal orders for a bulk purchase, streamed as Server-Sent Events
+    
+    Body: {"items": [{"product_id", "quantity"}, ...]}. Invalid batches get a
+    400 listing every problem. Otherwise events are `plan` ({"orders",
+    "cards"}), then `order` (as /chat's checkout result, plus "index" and
+    "currency") or `order_error` for each order as it completes, then `done`.
+    """
+    data = request.get_json(silent=True) or {}
+    cart, errors = normalize_batch(data.get('items'))
+    if errors:
+        return jsonify({"error": "Invalid batch", "details": errors}), 400
+    
+    orders = plan_batch_orders(cart)
+    paypal_log.info("Batch checkout", extra={"cards": sum(q for _, q in cart), "orders": len(orders)})
+    try:
+        # One token for the whole batch, fetched before any order is sent
+        get_paypal_access_token()
     except Exception as e:
+        paypal_log.error("Batch checkout could not get a PayPal token", extra={"error": str(e)})
+        return jsonify({"error": f"PayPal is unavailable: {e}"}), 502
+    
+    def generate():
+        futures = [
+            batch_executor.submit(contextvars.copy_context().run, create_batch_order, index, order)
+            for index, order in enumerate(orders)
+        ]
+        outcomes = []
+        try:
+            yield sse_event('plan', {"orders": len(orders), "cards": sum(q for _, q in cart)})
+            for future in as_completed(futures):
+                outcome = future.result()
+                outcomes.append(outcome)
+                yield sse_event('order_error' if 'error' in outcome else 'order', outcome)
+            yield sse_event('done', batch_done(outcomes))
+        finally:
+            # The client went away: don't start orders nobody will see
+            for future in futures:
+                future.cancel()
+            metrics.finish_trace(200)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@api.route('/capture-payment', methods=['POST'])
+def capture_payment():
+    """Queue capture and fulfilment of an approved PayPal order
+    
+    Returns 202 as soon as the job is stored; poll GET /capture-payment/<order_id>
+    for the outcome. Posting the same order again returns the existing job,
+    or queues it again if it failed after running out of attempts.
+    """
+    data = request.json
+    order_id = data.get('order_id')
+    if not order_id:
+        return jsonify({"error": "order_id is required"}), 400
+    
+    try:
+        with metrics.span('capture.enqueue'):
+            job, created = capture_queue.enqueue(order_id)
+    except Exception as e:
+        paypal_log.exception("Capture could not be queued", extra={"order_id": order_id})
         return jsonify({"error": str(e)}), 500
+    
+    if created:
+        paypal_log.info("Capture queued", extra={"order_id": order_id})
+    return jsonify(capture_status_body(job)), 202
+
+@api.route('/capture-payment/<order_id>', methods=['GET'])
+def capture_payment_status(order_id):
+    """Status of a queued capture"""
+    job = capture_queue.get(order_id)
+    if job is None:
+        return jsonify({"error": f"No capture queued for order {order_id}"}), 404
+    return jsonify(capture_status_body(job))
 
-@app.route('/health', methods=['GET'])
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Latency histograms in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
+    breakers = {breaker.name: breaker.snapshot() for breaker in (perplexity_breaker, paypal_breaker)}
     return jsonify({
-        "status": "healthy",
-        "paypal_mode": PAYPAL_MODE
+        # Still serving, but failing fast on an upstream while its breaker isn't closed
+        "status": "healthy" if all(b["state"] in ('closed', 'disabled') for b in breakers.values()) else "degraded",
+        "paypal_mode": PAYPAL_MODE,
+        "paypal_token": paypal_token_cache.snapshot(),
+        "sessions": session_store.snapshot(),
+        "context_window": context_window.snapshot(),
+        "catalog": catalog.snapshot(),
+        "admission": {
+            "session_rate": session_limiter.snapshot(),
+            "ip_rate": ip_limiter.snapshot(),
+            "batch_rate": batch_limiter.snapshot(),
+            "concurrency": admission.snapshot()
+        },
+        "intent_router": intent_router.snapshot(),
+        "order_pool": order_pool.snapshot() if ORDER_POOL_DEPTH else None,
+        "reply_cache": reply_cache.snapshot(),
+        "capture_queue": capture_queue.snapshot(),
+        "coalescing": {"first_turn": perplexity_client.single_flight.snapshot()},
+        "payload_builder": payload_builder.snapshot(),
+        "upstreams": {
+            client.name: client.pool_stats()
+            for client in (perplexity_client, paypal_client)
+        },
+        "circuit_breakers": breakers,
+        "hedging": hedge_policy.snapshot() if PERPLEXITY_HEDGE else None
     })
 
+def start_workers():
+    """Start the worker's background threads: capture workers and the order pool warmer
+    
+    Run by create_app() and by asgi_app on lifespan startup rather than on
+    import, so importing this module starts no threads and opens no files.
+    """
+    capture_queue.start()
+    if ORDER_POOL_DEPTH:
+        if not ORDER_POOL_PRODUCTS:
+            paypal_log.warning("ORDER_POOL_DEPTH is set but ORDER_POOL_PRODUCTS is empty; no orders will be pooled")
+        order_pool.start()
+
+def create_app():
+    """Application factory: a Flask app serving `api`, with CORS
+    
+    Also starts the background workers (see start_workers).
+    """
+    from flask_cors import CORS
+    
+    app = Flask(__name__)
+    # Lets a page on another origin read when to retry after a 429
+    CORS(app, expose_headers=['Retry-After'])
+    app.register_blueprint(api)
+    start_workers()
+    return app
+
+def __getattr__(name):
+    # `app` (gunicorn's app:app, the benchmarks) is built on first access, so
+    # importing this module for its helpers (asgi_app) skips Flask's setup
+    if name == 'app':
+        return globals().setdefault('app', create_app())
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def missing_settings():
+    """Names of REQUIRED_SETTINGS that are not set"""
+    return [name for name in REQUIRED_SETTINGS if not os.getenv(name)]
+
+def warm_up(upstreams=True):
+    """Get a worker ready before it accepts traffic
+    
+    Fails fast on missing settings. Then pre-encodes the static payload parts
+    and, with `upstreams`, opens the upstream connections and fetches (or
+    adopts from another worker) the PayPal token; upstream failures are only
+    logged, so a PayPal outage doesn't stop workers from booting.
+    """
+    missing = missing_settings()
+    if missing:
+        raise RuntimeError(f"Missing environment variables: {', '.join(missing)}")
+    
+    start = time.perf_counter()
+    for prompt in (chat_system_prompt(), FOLLOWUP_SYSTEM_PROMPT):
+        payload_builder.system_message(prompt)
+    list_gift_cards()
+    
+    warmed = {}
+    if upstreams:
+        warmed['perplexity'] = perplexity_client.warm(PERPLEXITY_API_URL)
+        try:
+            # Also opens the PayPal connection
+            get_paypal_access_token()
+            warmed['paypal'] = True
+        except Exception as e:
+            warmed['paypal'] = False
+            paypal_log.warning("PayPal token fetch failed during warmup", extra={"error": str(e)})
+    logging.getLogger('giftcards').info("Worker warmed up", extra={
+        "pid": os.getpid(),
+        "upstreams": warmed,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 1)
+    })
+
+def shut_down(timeout=30):
+    """Stop a worker's background threads once it stops taking requests
+    
+    Running capture jobs finish; queued ones stay in the shared queue for the
+    remaining workers.
+    """
+    if ORDER_POOL_DEPTH:
+        order_pool.stop()
+    capture_queue.stop(timeout=timeout)
+
 if __name__ == '__main__':
     print("\n" + "="*60)
     print("🔍 Checking Environment Variables...")
@@ -557,4 +1873,4 @@ if __name__ == '__main__':
     print("🚀 Starting Flask server...")
     print("="*60 + "\n")
     
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    create_app().run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,885 @@
+"""
+Async (ASGI) version of the chat pipeline
+Same JSON contract as the Flask app, but a request waiting on Perplexity or
+PayPal holds a coroutine instead of a worker thread.
+
+Run with: uvicorn asgi_app:app --port 5000
+Requires: pip install httpx uvicorn
+"""
+
+import asyncio
+import inspect
+import json
+import logging
+import os
+import time
+import uuid
+
+import httpx
+
+from admission import AsyncAdmissionGate, Overloaded
+from app import (
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT,
+    BATCH_ORDER_WORKERS,
+    FOLLOWUP_SYSTEM_PROMPT,
+    MERGED_CHECKOUT_RESULT,
+    ORDER_POOL_DEPTH,
+    PAYPAL_API_BASE,
+    PAYPAL_CLIENT_ID,
+    PAYPAL_CLIENT_SECRET,
+    PAYPAL_MODE,
+    PAYPAL_TOKEN_REFRESH_MARGIN,
+    PERPLEXITY_API_URL,
+    PERPLEXITY_HEDGE,
+    PayPalError,
+    TOOL_CALL_WORKERS,
+    batch_done,
+    batch_limiter,
+    batch_order_outcome,
+    build_paypal_order,
+    build_session_payload,
+    capture_queue,
+    capture_status_body,
+    catalog,
+    chat_log,
+    chat_system_prompt,
+    checkout_event,
+    checkout_result,
+    checkout_url_from,
+    completion_delta,
+    detect_product_in_text,
+    fallback_followup,
+    fallback_intent,
+    fallback_turn,
+    first_checkout_url,
+    forwarded_client_ip,
+    first_turn_coalesce_key,
+    hedge_policy,
+    ip_limiter,
+    list_gift_cards,
+    merge_tool_call_fragments,
+    metrics,
+    normalize_batch,
+    normalize_cart,
+    order_pool,
+    parse_tool_calls,
+    payload_builder,
+    paypal_breaker,
+    paypal_log,
+    paypal_token_store,
+    perplexity_breaker,
+    perplexity_headers,
+    plan_batch_orders,
+    reply_cache,
+    route_intent,
+    routed_turn,
+    session_limiter,
+    session_store,
+    shut_down,
+    sse_event,
+    start_workers,
+    streamed_message,
+    too_many_requests,
+    tool_result_messages,
+    turn_followup_cache_key,
+    warm_up,
+)
+from circuit_breaker import CircuitOpen
+from hedging import AsyncHedger
+from single_flight import AsyncSingleFlight
+from structured_logging import bind_log_context, clear_log_context
+from token_cache import AsyncTokenCache
+from upstream import failed_status, upstream_settings
+
+log = logging.getLogger('giftcards.asgi')
+
+# Upper bound on simultaneous connections per upstream (one per in-flight call)
+ASYNC_UPSTREAM_MAX_CONNECTIONS = int(os.getenv('ASYNC_UPSTREAM_MAX_CONNECTIONS', '1000'))
+
+
+def build_async_client(prefix):
+    """Build a pooled httpx client using the same settings as upstream.UpstreamClient"""
+    settings = upstream_settings(prefix)
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(settings['read_timeout'], connect=settings['connect_timeout']),
+        limits=httpx.Limits(
+            max_connections=ASYNC_UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings['pool_size']
+        ),
+        # httpx only retries failed connects, which are always safe to repeat
+        transport=httpx.AsyncHTTPTransport(retries=settings['max_retries'])
+    )
+
+
+# Created on lifespan startup (or first use) so they bind to the running loop
+upstream_clients = {}
+
+# The same breakers as the sync clients, so both see one view of each upstream
+breakers = {'perplexity': perplexity_breaker, 'paypal': paypal_breaker}
+
+
+async def upstream_post(upstream, url, stream=False, **kwargs):
+    """POST to an upstream behind its circuit breaker, recording latency like UpstreamClient
+
+    With stream=True the body is left unread (the caller must aclose() the
+    response) and the latency recorded is the time to the response headers.
+    """
+    client = perplexity_http() if upstream == 'perplexity' else paypal_http()
+    ticket = breakers[upstream].allow()
+    start = time.perf_counter()
+    try:
+        if stream:
+            response = await client.send(client.build_request('POST', url, **kwargs), stream=True)
+        else:
+            response = await client.post(url, **kwargs)
+    except httpx.HTTPError:
+        elapsed = time.perf_counter() - start
+        breakers[upstream].record(ticket, True, elapsed)
+        metrics.observe_upstream(upstream, 'error', elapsed)
+        raise
+    except BaseException:
+        # Cancelled (a hedge loser, a cancelled batch, a client disconnect):
+        # a half-open probe gives its slot back without counting either way
+        breakers[upstream].release(ticket)
+        raise
+    elapsed = time.perf_counter() - start
+    breakers[upstream].record(ticket, failed_status(response.status_code), elapsed)
+    metrics.observe_upstream(upstream, response.status_code, elapsed)
+    return response
+
+
+def perplexity_http():
+    if 'perplexity' not in upstream_clients:
+        upstream_clients['perplexity'] = build_async_client('PERPLEXITY')
+    return upstream_clients['perplexity']
+
+
+def paypal_http():
+    if 'paypal' not in upstream_clients:
+        upstream_clients['paypal'] = build_async_client('PAYPAL')
+    return upstream_clients['paypal']
+
+
+async def fetch_paypal_access_token():
+    """Request a new PayPal OAuth access token, returning (token, expires_in)"""
+    response = await upstream_post(
+        'paypal',
+        f"{PAYPAL_API_BASE[PAYPAL_MODE]}/v1/oauth2/token",
+        headers={"Accept": "application/json", "Accept-Language": "en_US"},
+        data={"grant_type": "client_credentials"},
+        auth=(PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET)
+    )
+    if response.status_code != 200:
+        raise Exception(f"Failed to get PayPal token: {response.text}")
+    token_data = response.json()
+    return token_data['access_token'], token_data.get('expires_in', 0)
+
+
+paypal_token_cache = AsyncTokenCache(
+    fetch_paypal_access_token,
+    refresh_margin=PAYPAL_TOKEN_REFRESH_MARGIN,
+    store=paypal_token_store
+)
+
+
+async def warm_up_upstreams():
+    """Open the async upstream connections and get a PayPal token before serving (best effort)"""
+    try:
+        await perplexity_http().head(PERPLEXITY_API_URL)
+    except httpx.HTTPError:
+        pass
+    try:
+        await paypal_token_cache.get()
+    except Exception as e:
+        paypal_log.warning("PayPal token fetch failed during warmup", extra={"error": str(e)})
+
+
+async def create_paypal_order(cart):
+    """Create a PayPal order for a cart, returning the checkout result (see app.create_paypal_order)
+
+    Raises PayPalError if PayPal rejects the order.
+    """
+    with metrics.span('paypal.token'):
+        access_token = await paypal_token_cache.get()
+    with metrics.span('paypal.order'):
+        response = await upstream_post(
+            'paypal',
+            f"{PAYPAL_API_BASE[PAYPAL_MODE]}/v2/checkout/orders",
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {access_token}",
+                "PayPal-Request-Id": str(uuid.uuid4())
+            },
+            json=build_paypal_order(cart)
+        )
+
+    if response.status_code == 401:
+        paypal_token_cache.invalidate()
+
+    if response.status_code != 201:
+        raise PayPalError(f"PayPal API error ({response.status_code}): {response.text}")
+    order = response.json()
+    approval_url = next(
+        link['href'] for link in order['links']
+        if link['rel'] == 'approve'
+    )
+    return checkout_result(cart, order['id'], approval_url)
+
+
+async def create_paypal_checkout(product_id=None, quantity=1, items=None):
+    """Create PayPal order for instant checkout of one card or a cart"""
+    try:
+        try:
+            cart = normalize_cart(product_id, quantity, items)
+        except ValueError as e:
+            return json.dumps({"error": str(e)})
+
+        # Pool lookups never block, so the shared warmer serves this path too
+        single = cart[0][0] if len(cart) == 1 and cart[0][1] == 1 else None
+        result = order_pool.take(single) if ORDER_POOL_DEPTH and single else None
+        if result:
+            return json.dumps(result)
+
+        return json.dumps(await create_paypal_order(cart))
+    except PayPalError as e:
+        return json.dumps({"error": str(e)})
+    except Exception as e:
+        paypal_log.exception("Checkout failed", extra={"product_id": product_id, "items": items})
+        return json.dumps({"error": f"Exception: {str(e)}"})
+
+
+async def list_gift_cards_async(**arguments):
+    return list_gift_cards(**arguments)
+
+
+# Async counterparts of app.FUNCTION_MAP
+FUNCTION_MAP = {
+    "list_gift_cards": list_gift_cards_async,
+    "create_paypal_checkout": create_paypal_checkout
+}
+
+
+async def run_tool_calls(calls):
+    """Run parsed tool calls concurrently (see app.run_tool_calls), at most TOOL_CALL_WORKERS at a time"""
+    limit = asyncio.Semaphore(TOOL_CALL_WORKERS)
+
+    async def call_tool(function_name, function_args):
+        function = FUNCTION_MAP.get(function_name)
+        if function is None:
+            return json.dumps({"error": f"Unknown function: {function_name}"})
+        if function_args is None:
+            return MERGED_CHECKOUT_RESULT
+        async with limit:
+            return await function(**function_args)
+
+    return await asyncio.gather(*(
+        call_tool(function_name, function_args) for _, function_name, function_args in calls
+    ))
+
+
+# Identical concurrent first-turn completions share one call (see app.first_turn_coalesce_key)
+first_turn_flight = AsyncSingleFlight()
+
+# Backup completions for slow ones, sharing the sync app's latency history and budget
+hedger = AsyncHedger(hedge_policy, accept=lambda response: not failed_status(response.status_code))
+
+
+async def post_completion(**request):
+    if PERPLEXITY_HEDGE:
+        return await hedger.call(upstream_post, 'perplexity', PERPLEXITY_API_URL, **request)
+    return await upstream_post('perplexity', PERPLEXITY_API_URL, **request)
+
+
+async def complete(payload, stage):
+    """Run one Perplexity chat completion, returning (message, error_text)
+
+    Both are None if Perplexity is unavailable (see app.perplexity_post).
+    """
+    request = {"headers": perplexity_headers(), "content": payload.body}
+    coalesce_key = first_turn_coalesce_key(payload)
+    try:
+        with metrics.span(stage):
+            if coalesce_key is None:
+                response = await post_completion(**request)
+            else:
+                response = await first_turn_flight.do(coalesce_key, post_completion, **request)
+    except (CircuitOpen, httpx.HTTPError) as e:
+        chat_log.warning("Perplexity unavailable", extra={"error": str(e)})
+        return None, None
+    if failed_status(response.status_code):
+        chat_log.warning("Perplexity unavailable", extra={"status": response.status_code})
+        return None, None
+    if response.status_code != 200:
+        return None, response.text
+    return response.json()['choices'][0]['message'], None
+
+
+async def completion_events(payload, stage, result):
+    """Relay one streamed Perplexity completion as SSE `token` events (see app.chat_stream)
+
+    Stores the assembled assistant message in result['message']; leaves it
+    unset, before any token, if Perplexity is unavailable.
+    """
+    # Includes the time spent relaying tokens to the browser
+    with metrics.span(stage):
+        try:
+            response = await upstream_post(
+                'perplexity', PERPLEXITY_API_URL, stream=True,
+                headers=perplexity_headers(), content=payload.body
+            )
+        except (CircuitOpen, httpx.HTTPError) as e:
+            chat_log.warning("Perplexity unavailable", extra={"error": str(e)})
+            return
+        try:
+            if failed_status(response.status_code):
+                chat_log.warning("Perplexity unavailable", extra={"status": response.status_code})
+                return
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"Perplexity API error: {response.text}")
+            content = []
+            tool_calls = {}
+            async for line in response.aiter_lines():
+                delta = completion_delta(line)
+                if delta is None:
+                    break
+                if delta.get('content'):
+                    content.append(delta['content'])
+                    yield sse_event('token', {"content": delta['content']})
+                merge_tool_call_fragments(tool_calls, delta)
+            result['message'] = streamed_message(content, tool_calls)
+        finally:
+            await response.aclose()
+
+
+# Turns waiting on Perplexity at once, as in app.admission, served in arrival order
+admission = AsyncAdmissionGate(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+
+
+async def chat(data):
+    """Handle chat messages with Perplexity AI (see app.chat)"""
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', 'default')
+    bind_log_context(session_id=session_id)
+
+    retry_after = session_limiter.acquire(session_id)
+    if retry_after:
+        return too_many_requests('session_rate', retry_after), 429
+
+    with metrics.span('session.load'):
+        history = session_store.load(session_id)
+    history.append({
+        "role": "user",
+        "content": user_message
+    })
+
+    admitted_at = None
+    try:
+        # Fast path: obvious catalog/purchase requests skip the LLM entirely
+        with metrics.span('router'):
+            intent = route_intent(user_message)
+        if intent:
+            function_response = await FUNCTION_MAP[intent.tool](**intent.arguments)
+            messages, reply = routed_turn(intent, function_response)
+            history.extend(messages)
+            return {
+                "response": reply,
+                "checkout_url": checkout_url_from(function_response),
+                "session_id": session_id
+            }, 200
+
+        with metrics.span('admission.wait'):
+            admitted_at = await admission.acquire()
+
+        assistant_message, error = await complete(
+            build_session_payload(chat_system_prompt(), session_id, history), 'perplexity.completion'
+        )
+        if error is not None:
+            return {"error": f"Perplexity API error: {error}"}, 500
+        if assistant_message is None:
+            # Perplexity is down or shedding load: answer from templates instead
+            intent = fallback_intent(user_message)
+            function_response = await FUNCTION_MAP[intent.tool](**intent.arguments)
+            messages, reply = fallback_turn(intent, function_response)
+            history.extend(messages)
+            return {
+                "response": reply,
+                "checkout_url": checkout_url_from(function_response),
+                "session_id": session_id
+            }, 200
+
+        checkout_url = None
+
+        if assistant_message.get('tool_calls'):
+            calls, error = parse_tool_calls(assistant_message['tool_calls'])
+            if error is not None:
+                return error
+
+            function_responses = await run_tool_calls(calls)
+
+            history.append(assistant_message)
+            history.extend(tool_result_messages(calls, function_responses))
+
+            cache_key = turn_followup_cache_key(calls, function_responses)
+            cached_reply = reply_cache.get(cache_key, function_responses[0])
+            if cached_reply is not None:
+                assistant_message = {"role": "assistant", "content": cached_reply}
+            else:
+                assistant_message, error = await complete(
+                    build_session_payload(FOLLOWUP_SYSTEM_PROMPT, session_id, history), 'perplexity.followup'
+                )
+                if error is not None:
+                    return {"error": f"Perplexity API error: {error}"}, 500
+                if assistant_message is None:
+                    assistant_message = {
+                        "role": "assistant",
+                        "content": fallback_followup(calls, function_responses)
+                    }
+                else:
+                    reply_cache.put(cache_key, function_responses[0], assistant_message.get('content'))
+
+            checkout_url = first_checkout_url(function_responses)
+        else:
+            # Fallback: Parse text response for product mentions
+            product_id = detect_product_in_text(assistant_message.get('content', ''))
+            if product_id:
+                checkout_url = checkout_url_from(await create_paypal_checkout(product_id))
+
+        return {
+            "response": assistant_message['content'],
+            "checkout_url": checkout_url,
+            "session_id": session_id
+        }, 200
+
+    except Overloaded as e:
+        history.pop()
+        return too_many_requests(e.reason, e.retry_after), 429
+
+    except Exception as e:
+        chat_log.exception("Chat turn failed")
+        return {"error": str(e)}, 500
+
+    finally:
+        if admitted_at is not None:
+            admission.release(admitted_at)
+        with metrics.span('session.save'):
+            session_store.save(session_id, history)
+
+
+async def chat_stream(data):
+    """Streaming variant of chat using Server-Sent Events (see app.chat_stream)
+
+    Returns the events as an async generator, or a 429 body.
+    """
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', 'default')
+    bind_log_context(session_id=session_id)
+
+    retry_after = session_limiter.acquire(session_id)
+    if retry_after:
+        return too_many_requests('session_rate', retry_after), 429
+
+    with metrics.span('session.load'):
+        history = session_store.load(session_id)
+    history.append({
+        "role": "user",
+        "content": user_message
+    })
+
+    # Routed before the stream starts, so a turn that needs Perplexity can
+    # still be turned away with a 429 instead of an error event
+    with metrics.span('router'):
+        intent = route_intent(user_message)
+    admitted_at = None
+    if not intent:
+        try:
+            with metrics.span('admission.wait'):
+                admitted_at = await admission.acquire()
+        except Overloaded as e:
+            return too_many_requests(e.reason, e.retry_after), 429
+    return chat_events(user_message, session_id, history, intent, admitted_at), 200
+
+
+async def chat_events(user_message, session_id, history, intent, admitted_at):
+    """Run one streamed chat turn, yielding its events (see app.chat_stream)"""
+    try:
+        assistant_message = None
+        if not intent:
+            completion = {}
+            payload = build_session_payload(chat_system_prompt(), session_id, history, stream=True)
+            async for event in completion_events(payload, 'perplexity.completion', completion):
+                yield event
+            assistant_message = completion.get('message')
+
+        if assistant_message is None:
+            # Routed, or Perplexity is unavailable: answer from templates
+            if intent:
+                function_response = await FUNCTION_MAP[intent.tool](**intent.arguments)
+                messages, reply = routed_turn(intent, function_response)
+            else:
+                fallback = fallback_intent(user_message)
+                function_response = await FUNCTION_MAP[fallback.tool](**fallback.arguments)
+                messages, reply = fallback_turn(fallback, function_response)
+            history.extend(messages)
+            checkout_url = checkout_url_from(function_response)
+            if checkout_url:
+                yield checkout_event(function_response)
+            yield sse_event('token', {"content": reply})
+            yield sse_event('done', {
+                "response": reply,
+                "checkout_url": checkout_url,
+                "session_id": session_id
+            })
+            return
+
+        checkout_url = None
+
+        if assistant_message.get('tool_calls'):
+            calls, error = parse_tool_calls(assistant_message['tool_calls'])
+            if error is not None:
+                yield sse_event('error', error[0])
+                return
+            for _, function_name, function_args in calls:
+                chat_log.info("Streamed tool call", extra={"tool": function_name, "arguments": function_args})
+
+            function_responses = await run_tool_calls(calls)
+            checkout_url = first_checkout_url(function_responses)
+            for function_response in function_responses:
+                if checkout_url_from(function_response):
+                    # Show the PayPal button before the follow-up text finishes
+                    yield checkout_event(function_response)
+
+            history.append(assistant_message)
+            history.extend(tool_result_messages(calls, function_responses))
+
+            cache_key = turn_followup_cache_key(calls, function_responses)
+            cached_reply = reply_cache.get(cache_key, function_responses[0])
+            if cached_reply is not None:
+                yield sse_event('token', {"content": cached_reply})
+                assistant_message = {"role": "assistant", "content": cached_reply}
+            else:
+                completion = {}
+                payload = build_session_payload(FOLLOWUP_SYSTEM_PROMPT, session_id, history, stream=True)
+                async for event in completion_events(payload, 'perplexity.followup', completion):
+                    yield event
+                assistant_message = completion.get('message')
+                if assistant_message is None:
+                    reply = fallback_followup(calls, function_responses)
+                    yield sse_event('token', {"content": reply})
+                    assistant_message = {"role": "assistant", "content": reply}
+                else:
+                    reply_cache.put(cache_key, function_responses[0], assistant_message.get('content'))
+        else:
+            # Fallback: Parse text response for product mentions
+            product_id = detect_product_in_text(assistant_message.get('content', ''))
+            if product_id:
+                chat_log.info("No tool call; product detected in streamed text", extra={"product_id": product_id})
+                function_response = await create_paypal_checkout(product_id)
+                checkout_url = checkout_url_from(function_response)
+                if checkout_url:
+                    yield checkout_event(function_response)
+
+        yield sse_event('done', {
+            "response": assistant_message['content'],
+            "checkout_url": checkout_url,
+            "session_id": session_id
+        })
+
+    except Exception as e:
+        chat_log.exception("Streamed chat turn failed")
+        yield sse_event('error', {"error": str(e)})
+
+    finally:
+        # Also runs when the browser disconnects mid-stream
+        if admitted_at is not None:
+            admission.release(admitted_at)
+        with metrics.span('session.save'):
+            session_store.save(session_id, history)
+
+
+async def checkout_batch(data):
+    """Create PayPal orders for a bulk purchase (see app.checkout_batch)
+
+    Returns the Server-Sent Events as an async generator, or an error body.
+    """
+    cart, errors = normalize_batch(data.get('items'))
+    if errors:
+        return {"error": "Invalid batch", "details": errors}, 400
+    orders = plan_batch_orders(cart)
+    try:
+        # One token for the whole batch, fetched before any order is sent
+        await paypal_token_cache.get()
+    except Exception as e:
+        paypal_log.error("Batch checkout could not get a PayPal token", extra={"error": str(e)})
+        return {"error": f"PayPal is unavailable: {e}"}, 502
+    return batch_events(cart, orders), 200
+
+
+async def batch_events(cart, orders):
+    """Create the orders of a batch, BATCH_ORDER_WORKERS at a time, yielding events as they complete"""
+    limit = asyncio.Semaphore(BATCH_ORDER_WORKERS)
+
+    async def create(index, order):
+        async with limit:
+            try:
+                return batch_order_outcome(index, order, await create_paypal_order(order))
+            except Exception as e:
+                return batch_order_outcome(index, order, error=e)
+
+    tasks = [asyncio.ensure_future(create(index, order)) for index, order in enumerate(orders)]
+    outcomes = []
+    try:
+        yield sse_event('plan', {"orders": len(orders), "cards": sum(q for _, q in cart)})
+        for next_done in asyncio.as_completed(tasks):
+            outcome = await next_done
+            outcomes.append(outcome)
+            yield sse_event('order_error' if 'error' in outcome else 'order', outcome)
+        yield sse_event('done', batch_done(outcomes))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def capture_payment(data):
+    """Queue capture and fulfilment of an approved PayPal order (see app.capture_payment)"""
+    order_id = data.get('order_id')
+    if not order_id:
+        return {"error": "order_id is required"}, 400
+
+    try:
+        with metrics.span('capture.enqueue'):
+            job, created = capture_queue.enqueue(order_id)
+    except Exception as e:
+        paypal_log.exception("Capture could not be queued", extra={"order_id": order_id})
+        return {"error": str(e)}, 500
+    return capture_status_body(job), 202
+
+
+async def capture_payment_status(order_id):
+    """Status of a queued capture"""
+    job = capture_queue.get(order_id)
+    if job is None:
+        return {"error": f"No capture queued for order {order_id}"}, 404
+    return capture_status_body(job), 200
+
+
+async def health(data):
+    """Health check endpoint"""
+    circuit_breakers = {name: breaker.snapshot() for name, breaker in breakers.items()}
+    return {
+        "status": "healthy" if all(b["state"] in ('closed', 'disabled') for b in circuit_breakers.values())
+        else "degraded",
+        "paypal_mode": PAYPAL_MODE,
+        "paypal_token": paypal_token_cache.snapshot(),
+        "sessions": session_store.snapshot(),
+        "catalog": catalog.snapshot(),
+        "admission": {
+            "session_rate": session_limiter.snapshot(),
+            "ip_rate": ip_limiter.snapshot(),
+            "batch_rate": batch_limiter.snapshot(),
+            "concurrency": admission.snapshot()
+        },
+        "reply_cache": reply_cache.snapshot(),
+        "capture_queue": capture_queue.snapshot(),
+        "coalescing": {"first_turn": first_turn_flight.snapshot()},
+        "payload_builder": payload_builder.snapshot(),
+        "circuit_breakers": circuit_breakers,
+        "hedging": hedge_policy.snapshot() if PERPLEXITY_HEDGE else None,
+        "server": "asgi"
+    }, 200
+
+
+ROUTES = {
+    ('POST', '/chat'): chat,
+    ('POST', '/chat/stream'): chat_stream,
+    ('POST', '/checkout/batch'): checkout_batch,
+    ('POST', '/capture-payment'): capture_payment,
+    ('GET', '/health'): health,
+}
+
+# Per-IP buckets by route, with the reason a rejection reports (see app.CLIENT_RATE_LIMITS)
+CLIENT_RATE_LIMITS = {
+    ('POST', '/chat'): (ip_limiter, 'ip_rate'),
+    ('POST', '/chat/stream'): (ip_limiter, 'ip_rate'),
+    ('POST', '/checkout/batch'): (batch_limiter, 'batch_rate'),
+}
+
+# GET /capture-payment/<order_id>
+CAPTURE_STATUS_PREFIX = '/capture-payment/'
+
+# Same permissive CORS policy as the Flask app's (see app.create_app)
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type'),
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+    (b'access-control-expose-headers', b'Retry-After'),
+]
+
+
+async def send_json(send, body, status=200, headers=()):
+    payload = json.dumps(body).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+        ] + CORS_HEADERS + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def send_events(send, events, headers=()):
+    """Stream an async generator of Server-Sent Events"""
+    start = {
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ] + CORS_HEADERS + list(headers),
+    }
+    try:
+        async for event in events:
+            # Headers go out with the first event, so the generator has started
+            # (and its cleanup will run) even if the client is already gone
+            if start:
+                await send(start)
+                start = None
+            await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+    finally:
+        await events.aclose()
+    if start:
+        await send(start)
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_text(send, text, headers=()):
+    payload = text.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/plain; version=0.0.4'),
+            (b'content-length', str(len(payload)).encode()),
+        ] + CORS_HEADERS + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+def route_label(method, path):
+    """Route template for metrics labels, matching Flask's url_rule names"""
+    if method == 'GET' and path.startswith(CAPTURE_STATUS_PREFIX):
+        return CAPTURE_STATUS_PREFIX + '<order_id>'
+    return path if (method, path) in ROUTES else 'unmatched'
+
+
+async def dispatch(method, path, receive):
+    """Run the handler for a request, returning (body, status)"""
+    if method == 'GET' and path.startswith(CAPTURE_STATUS_PREFIX):
+        return await capture_payment_status(path[len(CAPTURE_STATUS_PREFIX):])
+
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        return {"error": "Not found"}, 404
+
+    body = await read_body(receive)
+    try:
+        data = json.loads(body) if body else {}
+    except json.JSONDecodeError:
+        return {"error": "Request body must be JSON"}, 400
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+    try:
+        return await handler(data)
+    except Exception:
+        # What Flask does for an unhandled error: log it and answer 500
+        log.exception("Unhandled error", extra={"path": path})
+        return {"error": "Internal server error"}, 500
+
+
+def client_ip(scope):
+    """Client address, from X-Forwarded-For when behind trusted proxies (see app.forwarded_client_ip)"""
+    forwarded = dict(scope['headers']).get(b'x-forwarded-for', b'').decode()
+    return forwarded_client_ip(forwarded, (scope.get('client') or ('unknown', 0))[0])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # The server only starts accepting connections once this completes
+            try:
+                warm_up(upstreams=False)
+            except RuntimeError as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            start_workers()
+            perplexity_http()
+            paypal_http()
+            await warm_up_upstreams()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Sent after the server has drained in-flight requests
+            await asyncio.to_thread(shut_down)
+            for client in upstream_clients.values():
+                await client.aclose()
+            upstream_clients.clear()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    if method == 'OPTIONS':
+        await send({'type': 'http.response.start', 'status': 204, 'headers': CORS_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    # Correlate every log record of this request, honouring an incoming X-Request-ID
+    request_id = dict(scope['headers']).get(b'x-request-id', b'').decode() or uuid.uuid4().hex[:16]
+    clear_log_context(request_id=request_id)
+    id_header = [(b'x-request-id', request_id.encode())]
+
+    # A stat call at most every CATALOG_RELOAD_INTERVAL; a changed file is re-read inline
+    catalog.refresh()
+
+    path = scope['path']
+    if method == 'GET' and path == '/metrics':
+        await send_text(send, metrics.render(), id_header)
+        return
+
+    metrics.start_trace(route_label(method, path))
+    # Per-IP token buckets for the chat and batch checkout endpoints
+    limit = CLIENT_RATE_LIMITS.get((method, path))
+    retry_after = limit[0].acquire(client_ip(scope)) if limit else 0
+    if retry_after:
+        response, status = too_many_requests(limit[1], retry_after), 429
+    else:
+        response, status = await dispatch(method, path, receive)
+    if status == 429:
+        id_header = id_header + [(b'retry-after', str(response['retry_after']).encode())]
+    if inspect.isasyncgen(response):
+        await send_events(send, response, id_header)
+    else:
+        await send_json(send, response, status, id_header)
+    metrics.finish_trace(status)
@@ -0,0 +1,3 @@
+"""
+Benchmarks for the gift card store, run against local upstream stubs
+"""
@@ -0,0 +1,130 @@
+"""
+Bulk checkout throughput: one /chat checkout per card vs POST /checkout/batch
+
+Usage: python -m benchmarks.bench_batch [--cards 300] [--order-total 1000] [--paypal-latency 0.1]
+
+The per-card baseline buys each card in its own conversation ("I want to buy
+the $50 card", answered by the intent router), --concurrency at a time.  The
+batch requests the same cards, a mix of the built-in $25/$50/$100 cards, in
+one call; --order-total caps each PayPal order so the batch spans several
+orders, created one at a time and then --workers at a time.  Reports cards
+per second, orders created, time to the first `order` event and PayPal calls.
+Requires httpx (load generator) and uvicorn (async server).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load_chat import free_port, start_server
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+PRODUCTS = [('gc_25', "I want to buy the $25 card"),
+            ('gc_50', "I want to buy the $50 card"),
+            ('gc_100', "I want to buy the $100 card")]
+
+
+async def per_card(base_url, cards, concurrency):
+    """Each card in its own /chat conversation; returns (orders, first order seconds)"""
+    limit = asyncio.Semaphore(concurrency)
+    orders, firsts = [], []
+    start = time.perf_counter()
+
+    async def buy(client, index):
+        async with limit:
+            message = PRODUCTS[index % len(PRODUCTS)][1]
+            response = await client.post(f'{base_url}/chat', json={"message": message, "session_id": f"card_{index}_{start}"})
+            if response.status_code == 200 and response.json().get('checkout_url'):
+                orders.append(index)
+                firsts.append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(timeout=120) as client:
+        await asyncio.gather(*(buy(client, index) for index in range(cards)))
+    return len(orders), min(firsts) if firsts else None
+
+
+async def batch(base_url, cards):
+    """All cards in one /checkout/batch call; returns (orders, first order seconds)"""
+    counts = {}
+    for index in range(cards):
+        product_id = PRODUCTS[index % len(PRODUCTS)][0]
+        counts[product_id] = counts.get(product_id, 0) + 1
+    items = [{"product_id": product_id, "quantity": quantity} for product_id, quantity in counts.items()]
+
+    start = time.perf_counter()
+    first, done, event = None, None, None
+    async with httpx.AsyncClient(timeout=300) as client:
+        async with client.stream('POST', f'{base_url}/checkout/batch', json={"items": items}) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"batch failed: {response.status_code} {(await response.aread()).decode()}")
+            async for line in response.aiter_lines():
+                if line.startswith('event: '):
+                    event = line[len('event: '):]
+                elif line.startswith('data: '):
+                    if event == 'order' and first is None:
+                        first = time.perf_counter() - start
+                    elif event == 'done':
+                        done = json.loads(line[len('data: '):])
+    return done['orders'] if done else 0, first
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cards', type=int, default=300, help='cards bought')
+    parser.add_argument('--order-total', type=float, default=1000, help='BATCH_MAX_ORDER_TOTAL for the batch runs')
+    parser.add_argument('--workers', type=int, default=8, help='BATCH_ORDER_WORKERS for the concurrent batch run')
+    parser.add_argument('--concurrency', type=int, default=8, help='conversations at once for the per-card baseline')
+    parser.add_argument('--paypal-latency', type=float, default=0.1, help='median stub PayPal latency (s)')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads for the sync server')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async', 'prefork'])
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer().start()
+    paypal = StubPayPalServer(token_latency=args.paypal_latency, order_latency=args.paypal_latency).start()
+
+    print(f"{args.cards} cards, PayPal {args.paypal_latency * 1000:.0f} ms per call, "
+          f"batch orders capped at {args.order_total:.0f}\n")
+    print(f"{'mode':<7} {'path':<18} {'orders':>7} {'seconds':>8} {'cards/s':>8} {'first ms':>9} {'paypal calls':>13}")
+    runs = [
+        ('per-card /chat', {}, lambda url: per_card(url, args.cards, args.concurrency)),
+        ('batch, 1 worker', {"BATCH_ORDER_WORKERS": "1"}, lambda url: batch(url, args.cards)),
+        (f'batch, {args.workers} workers', {"BATCH_ORDER_WORKERS": str(args.workers)}, lambda url: batch(url, args.cards)),
+    ]
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for mode in args.modes:
+                for number, (label, overrides, run) in enumerate(runs):
+                    port = free_port()
+                    env = {
+                        "LOG_LEVEL": "WARNING",
+                        "CAPTURE_QUEUE_PATH": os.path.join(workdir, f'{mode}-{number}-jobs.db'),
+                        "RATE_LIMIT_SESSION_RATE": "0",
+                        "RATE_LIMIT_BATCH_RATE": "0",
+                        "BATCH_MAX_ORDER_TOTAL": str(args.order_total),
+                        **overrides,
+                    }
+                    process = start_server(mode, port, args.threads, perplexity, paypal, **env)
+                    calls_before = sum(paypal.calls.values())
+                    try:
+                        start = time.perf_counter()
+                        orders, first = asyncio.run(run(f'http://127.0.0.1:{port}'))
+                        elapsed = time.perf_counter() - start
+                    finally:
+                        process.terminate()
+                        process.wait()
+                    calls = sum(paypal.calls.values()) - calls_before
+                    first_ms = f"{first * 1000:9.0f}" if first is not None else f"{'-':>9}"
+                    print(f"{mode:<7} {label:<18} {orders:7d} {elapsed:8.2f} {args.cards / elapsed:8.1f} "
+                          f"{first_ms} {calls:13d}")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
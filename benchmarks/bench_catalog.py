@@ -0,0 +1,117 @@
+"""
+Catalog lookups and LLM context size at growing catalog sizes: a linear scan
+of the product list vs the indexed catalog, and the whole catalog in every
+request vs the generated prompt and tool schema
+
+Usage: python -m benchmarks.bench_catalog [--sizes 100 1000 10000] [--queries 2000]
+
+Synthetic catalogs mix brands, occasions, denominations and currencies.
+Queries combine a keyword, a price range and a currency, the filters
+list_gift_cards exposes.  Context size is the JSON length of the system
+prompt plus tool schema sent with every completion.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from catalog import WORD, Catalog, keywords
+
+BRANDS = ['amazon', 'steam', 'spotify', 'netflix', 'starbucks', 'apple', 'uber', 'airbnb', 'target', 'ikea']
+OCCASIONS = ['birthday', 'wedding', 'holiday', 'thank you', 'graduation', 'anniversary']
+DENOMINATIONS = [10, 15, 20, 25, 50, 75, 100, 150, 200, 500]
+CURRENCIES = ['USD', 'EUR', 'GBP']
+
+
+def synthetic_catalog(size, rng):
+    products = []
+    for index in range(size):
+        brand, price, currency = rng.choice(BRANDS), rng.choice(DENOMINATIONS), rng.choice(CURRENCIES)
+        products.append({
+            "id": f"{brand}_{price}_{currency.lower()}_{index}",
+            "name": f"{brand.title()} {price} {currency} Gift Card",
+            "description": f"Perfect for a {rng.choice(OCCASIONS)}",
+            "price": price,
+            "currency": currency,
+        })
+    return products
+
+
+def synthetic_queries(count, rng):
+    queries = []
+    for _ in range(count):
+        low = rng.choice(DENOMINATIONS)
+        queries.append({
+            "query": rng.choice(BRANDS + OCCASIONS + [None]),
+            "min_price": low,
+            "max_price": low * rng.choice([1, 2, 4]),
+            "currency": rng.choice(CURRENCIES + [None]),
+        })
+    return queries
+
+
+def linear_search(scan, query=None, min_price=None, max_price=None, currency=None, offset=0, limit=10):
+    """The obvious implementation: filter every (product, keywords), then sort and slice"""
+    words = WORD.findall((query or '').lower())
+    matched = [
+        product for product, terms in scan
+        if (min_price is None or product['price'] >= min_price)
+        and (max_price is None or product['price'] <= max_price)
+        and (currency is None or product['currency'] == currency)
+        and all(word in terms for word in words)
+    ]
+    matched.sort(key=lambda product: product['price'])
+    return matched[offset:offset + limit], len(matched)
+
+
+def time_queries(search, queries):
+    start = time.perf_counter()
+    for query in queries:
+        search(**query, limit=10)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='catalog sizes')
+    parser.add_argument('--queries', type=int, default=2000, help='queries timed per catalog size')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ.update(
+        LOG_LEVEL='WARNING',
+        CAPTURE_QUEUE_PATH=os.path.join(tempfile.mkdtemp(), 'jobs.db'),
+    )
+    import app
+
+    rng = random.Random(args.seed)
+    queries = synthetic_queries(args.queries, rng)
+    print(f"{args.queries} filtered queries per catalog size, page size 10\n")
+    print(f"{'products':>9} {'scan us':>9} {'index us':>9} {'speedup':>8} "
+          f"{'full ctx KiB':>13} {'generated KiB':>14} {'load ms':>8}")
+    for size in args.sizes:
+        products = synthetic_catalog(size, rng)
+        start = time.perf_counter()
+        catalog = Catalog(products)
+        load = time.perf_counter() - start
+        scan = [(product, keywords(product)) for product in catalog.values()]
+
+        # Both must return the same pages
+        for query in queries[:50]:
+            assert catalog.search(**query, limit=10) == linear_search(scan, **query), query
+
+        scanned = time_queries(lambda **query: linear_search(scan, **query), queries)
+        indexed = time_queries(catalog.search, queries)
+
+        # Every product in the prompt (the old approach) vs what is generated
+        full_context = len(json.dumps(products)) + len(json.dumps(app.build_tools(catalog)))
+        generated = len(json.dumps(app.build_chat_system_prompt(catalog))) + len(json.dumps(app.build_tools(catalog)))
+        print(f"{size:9d} {scanned * 1e6:9.1f} {indexed * 1e6:9.1f} {scanned / indexed:7.1f}x "
+              f"{full_context / 1024:13.1f} {generated / 1024:14.1f} {load * 1000:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Bytes sent to Perplexity per request and /chat latency, with and without
+context windowing, over one long session
+
+Usage: python -m benchmarks.bench_context_window [--turns 60] [--latency-per-kb 0.01]
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+from benchmarks.load_chat import SCRIPT
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+
+def run_session(app, turns, session_id):
+    """Send `turns` scripted messages; returns per-turn (bytes_sent, seconds)"""
+    client = app.app.test_client()
+    results = []
+    for turn in range(turns):
+        sent_before = app.perplexity_client.stats["bytes_sent"]
+        calls_before = app.perplexity_client.stats["requests"]
+        start = time.perf_counter()
+        client.post('/chat', json={"message": SCRIPT[turn % len(SCRIPT)], "session_id": session_id})
+        elapsed = time.perf_counter() - start
+        calls = app.perplexity_client.stats["requests"] - calls_before
+        sent = app.perplexity_client.stats["bytes_sent"] - sent_before
+        results.append((sent / max(calls, 1), elapsed))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--turns', type=int, default=60)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub base completion latency (s)')
+    parser.add_argument('--latency-per-kb', type=float, default=0.01, help='stub latency per KiB of request (s)')
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer(latency=args.latency, latency_per_kb=args.latency_per_kb).start()
+    paypal = StubPayPalServer(token_latency=0, order_latency=0).start()
+    os.environ.update(
+        PERPLEXITY_API_URL=perplexity.completions_url,
+        PAYPAL_API_URL=paypal.url,
+        PAYPAL_CLIENT_ID='bench-client-id',
+        PAYPAL_CLIENT_SECRET='bench-client-secret',
+        # Keep the whole session so only the context window limits the payload
+        SESSION_MAX_TURNS='100000',
+        SESSION_MAX_TOKENS='100000000',
+        LOG_LEVEL='WARNING',
+    )
+    import app
+
+    keep_turns = app.context_window.keep_turns
+    print(f"{args.turns} turns, stub latency {args.latency * 1000:.0f} ms + "
+          f"{args.latency_per_kb * 1000:.0f} ms/KiB\n")
+    print(f"{'context':<10} {'avg bytes/req':>14} {'last bytes/req':>15} {'avg ms/turn':>12} {'last 10 ms':>11}")
+    try:
+        for label, turns_kept in (("full", 0), ("windowed", keep_turns)):
+            app.context_window.keep_turns = turns_kept
+            results = run_session(app, args.turns, f"bench_{label}")
+            sizes = [r[0] for r in results]
+            times = [r[1] * 1000 for r in results]
+            print(f"{label:<10} {statistics.mean(sizes):14.0f} {sizes[-1]:15.0f} "
+                  f"{statistics.mean(times):12.1f} {statistics.mean(times[-10:]):11.1f}")
+        print(f"\n{app.context_window.snapshot()}")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
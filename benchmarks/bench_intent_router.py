@@ -0,0 +1,101 @@
+"""
+Intent router hit rate, accuracy and /chat latency on a replayable corpus
+
+Usage: python -m benchmarks.bench_intent_router [--corpus benchmarks/corpus/chat_messages.tsv]
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), 'corpus', 'chat_messages.tsv')
+
+
+def load_corpus(path):
+    """Read (expected, message) pairs, skipping comments and blank lines"""
+    corpus = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            expected, message = line.split('\t', 1)
+            corpus.append((expected, message))
+    return corpus
+
+
+def label(intent):
+    if intent is None:
+        return 'llm'
+    if intent.tool == 'list_gift_cards':
+        return 'catalog'
+    return f"purchase:{intent.arguments['product_id']}"
+
+
+def replay(app, corpus, session_prefix):
+    """Send every corpus message as a fresh session; returns latencies in ms"""
+    client = app.app.test_client()
+    latencies = []
+    for index, (_, message) in enumerate(corpus):
+        start = time.perf_counter()
+        client.post('/chat', json={"message": message, "session_id": f"{session_prefix}_{index}"})
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='stub completion latency (s)')
+    parser.add_argument('--paypal-latency', type=float, default=0.1, help='stub PayPal latency (s)')
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer(latency=args.llm_latency).start()
+    paypal = StubPayPalServer(token_latency=args.paypal_latency, order_latency=args.paypal_latency).start()
+    os.environ.update(
+        PERPLEXITY_API_URL=perplexity.completions_url,
+        PAYPAL_API_URL=paypal.url,
+        PAYPAL_CLIENT_ID='bench-client-id',
+        PAYPAL_CLIENT_SECRET='bench-client-secret',
+        LOG_LEVEL='WARNING',
+    )
+    import app
+
+    corpus = load_corpus(args.corpus)
+    routed = correct = wrong = 0
+    for expected, message in corpus:
+        intent = app.intent_router.route(message)
+        actual = label(intent)
+        if intent is not None:
+            routed += 1
+            if actual == expected:
+                correct += 1
+            else:
+                wrong += 1
+                print(f"  misrouted: {message!r} -> {actual} (expected {expected})")
+    routable = sum(1 for expected, _ in corpus if expected != 'llm')
+    print(f"{len(corpus)} messages, {routable} routable")
+    print(f"hit rate {routed / len(corpus):.1%}   recall {correct / routable:.1%}   "
+          f"precision {correct / routed if routed else 0:.1%}   misrouted {wrong}\n")
+
+    try:
+        # Warm the token so both runs pay the same PayPal cost
+        app.paypal_token_cache.get()
+        print(f"{'router':<8} {'mean ms':>8} {'p50 ms':>8} {'max ms':>8} {'LLM calls':>10}")
+        for enabled in (False, True):
+            app.INTENT_ROUTER_ENABLED = enabled
+            perplexity.calls.clear()
+            latencies = replay(app, corpus, f"router_{enabled}")
+            print(f"{'on' if enabled else 'off':<8} {statistics.mean(latencies):8.0f} "
+                  f"{statistics.median(latencies):8.0f} {max(latencies):8.0f} "
+                  f"{perplexity.calls.get('completions', 0):10d}")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
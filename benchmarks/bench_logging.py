@@ -0,0 +1,70 @@
+"""
+/chat throughput with logging off, on (synchronous and queued) and at DEBUG
+
+Usage: python -m benchmarks.bench_logging [--users 50] [--turns 3] [--llm-latency 0.05]
+
+Each configuration runs the sync server in a subprocess whose log output goes
+to a real file, so the cost of formatting and writing every record is paid.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+
+from benchmarks.load_chat import free_port, percentile, run_load, start_server
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+CONFIGS = [
+    ("off", dict(LOG_LEVEL='WARNING')),
+    ("info-sync", dict(LOG_LEVEL='INFO', LOG_QUEUE='off')),
+    ("info", dict(LOG_LEVEL='INFO')),
+    ("debug-1%", dict(LOG_LEVEL='DEBUG', LOG_DEBUG_SAMPLE_RATE='0.01')),
+    ("debug-all", dict(LOG_LEVEL='DEBUG', LOG_DEBUG_SAMPLE_RATE='1')),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--turns', type=int, default=3, help='messages per user')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads for the sync server')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='stub completion latency (s)')
+    parser.add_argument('--paypal-latency', type=float, default=0.02, help='stub PayPal latency (s)')
+    parser.add_argument('--format', default='json', choices=['json', 'text'])
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer(latency=args.llm_latency).start()
+    paypal = StubPayPalServer(token_latency=args.paypal_latency, order_latency=args.paypal_latency).start()
+
+    print(f"{args.users} users x {args.turns} turns, LLM {args.llm_latency * 1000:.0f} ms, "
+          f"PayPal {args.paypal_latency * 1000:.0f} ms, {args.format} logs\n")
+    print(f"{'logging':<10} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'log B/req':>10} {'failed':>7}")
+    try:
+        for label, env in CONFIGS:
+            with tempfile.TemporaryFile() as log_file:
+                port = free_port()
+                # Router off so every turn exercises the LLM and PayPal log paths
+                process = start_server('sync', port, args.threads, perplexity, paypal, output=log_file,
+                                       LOG_FORMAT=args.format, INTENT_ROUTER='off', **env)
+                try:
+                    latencies, failures, elapsed = asyncio.run(
+                        run_load(f'http://127.0.0.1:{port}', args.users, args.turns)
+                    )
+                finally:
+                    process.terminate()
+                    process.wait()
+                log_bytes = os.fstat(log_file.fileno()).st_size
+            requests = len(latencies) + len(failures)
+            if latencies:
+                print(f"{label:<10} {len(latencies) / elapsed:8.1f} {percentile(latencies, 50) * 1000:8.0f} "
+                      f"{percentile(latencies, 99) * 1000:8.0f} {log_bytes / requests:10.0f} {len(failures):7d}")
+            else:
+                print(f"{label:<10} all {len(failures)} requests failed")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
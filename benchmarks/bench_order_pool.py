@@ -0,0 +1,86 @@
+"""
+Checkout latency with and without the pre-created PayPal order pool
+
+Usage: python -m benchmarks.bench_order_pool [--checkouts 30] [--interval 0.2] [--depth 3]
+                                             [--products gc_25,gc_50,gc_100]
+
+Checkouts arrive every --interval seconds, rotating through the pooled products,
+against a local PayPal stub. A final run with a tiny --max-age shows pooled
+orders being discarded as they age out.
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+from benchmarks.stubs import StubPayPalServer
+
+
+def run_checkouts(app, count, interval):
+    """Run `count` checkouts spaced `interval` apart; returns latencies in ms"""
+    product_ids = app.pooled_products(app.catalog)
+    latencies = []
+    for index in range(count):
+        start = time.perf_counter()
+        app.create_paypal_checkout(product_ids[index % len(product_ids)])
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(interval)
+    return latencies
+
+
+def wait_for_fill(pool, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(depth >= pool.depth for depth in pool.snapshot()['depth'].values()):
+            return
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--checkouts', type=int, default=30)
+    parser.add_argument('--interval', type=float, default=0.2, help='seconds between checkouts')
+    parser.add_argument('--depth', type=int, default=3, help='pooled orders per product')
+    parser.add_argument('--products', default='gc_25,gc_50,gc_100', help='comma-separated product IDs to pool')
+    parser.add_argument('--order-latency', type=float, default=0.3, help='stub order creation latency (s)')
+    parser.add_argument('--max-age', type=float, default=0.5, help='order max age for the expiry run (s)')
+    args = parser.parse_args()
+
+    paypal = StubPayPalServer(token_latency=0.05, order_latency=args.order_latency).start()
+    os.environ.update(
+        PAYPAL_API_URL=paypal.url,
+        PAYPAL_CLIENT_ID='bench-client-id',
+        PAYPAL_CLIENT_SECRET='bench-client-secret',
+        ORDER_POOL_DEPTH=str(args.depth),
+        ORDER_POOL_PRODUCTS=args.products,
+        LOG_LEVEL='WARNING',
+    )
+    import app
+    app.start_workers()
+    app.paypal_token_cache.get()
+    pool = app.order_pool
+
+    print(f"{args.checkouts} checkouts every {args.interval * 1000:.0f} ms, "
+          f"order creation {args.order_latency * 1000:.0f} ms, pool depth {args.depth}\n")
+    print(f"{'pool':<8} {'mean ms':>8} {'p50 ms':>8} {'max ms':>8}")
+    try:
+        wait_for_fill(pool)
+        for label, depth in (("off", 0), ("on", args.depth)):
+            app.ORDER_POOL_DEPTH = depth
+            latencies = run_checkouts(app, args.checkouts, args.interval)
+            print(f"{label:<8} {statistics.mean(latencies):8.1f} {statistics.median(latencies):8.1f} "
+                  f"{max(latencies):8.1f}")
+        print(f"\n{pool.snapshot()}")
+
+        # Orders that outlive max_age are discarded rather than handed out
+        pool.max_age = args.max_age
+        time.sleep(args.max_age * 3)
+        print(f"after {args.max_age * 3:.1f}s idle with max_age {args.max_age}s: {pool.snapshot()}")
+    finally:
+        pool.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+/chat past upstream capacity, with and without admission control, and one
+session flooding /chat past its rate limit
+
+Usage: python -m benchmarks.bench_overload [--rate 60] [--duration 10] [--upstream-slots 8]
+
+Requests arrive open-loop (at a fixed rate, whether or not earlier ones have
+finished) while the Perplexity stub serves at most --upstream-slots
+completions at once, so arrivals beyond its capacity pile up.  Without
+admission control every request waits its turn and latency grows for the
+whole run; with it, turns beyond the in-flight limit and its short queue get
+an immediate 429 and the ones admitted stay fast.  Each arrival is a new
+session (with first-turn coalescing off, so each costs a completion) and
+only the concurrency gate is in play; the flood then sends
+--flood messages from one session as fast as possible.
+Requires httpx (load generator) and uvicorn (async server).
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load_chat import free_port, percentile, start_server
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+# Not answered by the intent router, so every turn needs a completion
+MESSAGE = "Can you help me pick a present for my sister?"
+
+
+async def post_chat(client, base_url, session_id, results):
+    start = time.perf_counter()
+    try:
+        response = await client.post(f'{base_url}/chat', json={"message": MESSAGE, "session_id": session_id})
+        status = response.status_code
+    except httpx.HTTPError:
+        status = None
+    results.append((status, time.perf_counter() - start))
+
+
+async def open_loop(base_url, rate, duration):
+    """Fire one new-session turn every 1/rate seconds for `duration` seconds"""
+    results, tasks = [], []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=200)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        for index in range(int(rate * duration)):
+            await asyncio.sleep(max(0.0, start + index / rate - time.perf_counter()))
+            tasks.append(asyncio.create_task(post_chat(client, base_url, f"overload_{index}_{start}", results)))
+        await asyncio.gather(*tasks)
+    return results
+
+
+async def flood(base_url, messages):
+    """Back-to-back turns from a single session"""
+    results = []
+    async with httpx.AsyncClient(timeout=120) as client:
+        session_id = f"flood_{time.monotonic_ns()}"
+        for _ in range(messages):
+            await post_chat(client, base_url, session_id, results)
+    return results
+
+
+def report(label, results):
+    ok = [seconds for status, seconds in results if status == 200]
+    limited = [seconds for status, seconds in results if status == 429]
+    other = len(results) - len(ok) - len(limited)
+    columns = [
+        f"{percentile(values, pct) * 1000:9.0f}" if values else f"{'-':>9}"
+        for values, pct in ((ok, 50), (ok, 99), (limited, 50))
+    ]
+    print(f"{label:<18} {len(ok):6d} {len(limited):6d} {other:6d} {' '.join(columns)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=60, help='arriving turns per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of arrivals')
+    parser.add_argument('--upstream-slots', type=int, default=8, help='completions the stub serves at once')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='median stub completion latency (s)')
+    parser.add_argument('--threads', type=int, default=64, help='worker threads for the sync server')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='ADMISSION_MAX_IN_FLIGHT when admission is on')
+    parser.add_argument('--max-queue', type=int, default=16, help='ADMISSION_MAX_QUEUE when admission is on')
+    parser.add_argument('--flood', type=int, default=30, help='messages sent by the flooding session')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async', 'prefork'])
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer(latency=args.llm_latency, concurrency=args.upstream_slots).start()
+    paypal = StubPayPalServer().start()
+    capacity = args.upstream_slots / args.llm_latency
+
+    print(f"{args.rate:.0f} turns/s for {args.duration:.0f}s against ~{capacity:.0f} turns/s of upstream capacity "
+          f"({args.upstream_slots} slots x {args.llm_latency * 1000:.0f} ms)\n")
+    print(f"{'mode':<18} {'ok':>6} {'429':>6} {'failed':>6} {'ok p50':>9} {'ok p99':>9} {'429 p50':>9}")
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for mode in args.modes:
+                for admission in ('off', 'on'):
+                    port = free_port()
+                    env = {
+                        "LOG_LEVEL": "WARNING",
+                        "CAPTURE_QUEUE_PATH": os.path.join(workdir, f'{mode}-{admission}-jobs.db'),
+                        "COALESCE_FIRST_TURN": "off",
+                        "ADMISSION_MAX_IN_FLIGHT": str(args.max_in_flight) if admission == 'on' else "0",
+                        "ADMISSION_MAX_QUEUE": str(args.max_queue),
+                        "RATE_LIMIT_SESSION_RATE": "0.5" if admission == 'on' else "0",
+                    }
+                    process = start_server(mode, port, args.threads, perplexity, paypal, **env)
+                    base_url = f'http://127.0.0.1:{port}'
+                    try:
+                        report(f"{mode} admission {admission}", asyncio.run(open_loop(base_url, args.rate, args.duration)))
+                        if admission == 'on':
+                            report(f"{mode} 1-session flood", asyncio.run(flood(base_url, args.flood)))
+                    finally:
+                        process.terminate()
+                        process.wait()
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+CPU cost of encoding the Perplexity request body: json.dumps of the whole
+payload per call vs the pre-encoded payload builder, at growing session lengths
+
+Usage: python -m benchmarks.bench_payload [--turns 10 100 1000] [--requests 50]
+
+Each session grows one turn per request and the full history is sent (no
+context window), the worst case for re-encoding.  Reports bytes per request,
+CPU time per request and encode throughput.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.bench_session_store import synthetic_turn
+from payload_builder import PayloadBuilder, json_backend, orjson
+
+
+def legacy_body(app, history):
+    """What requests' json= did before: encode the whole dict every call"""
+    return json.dumps(app.build_chat_payload(app.chat_system_prompt(), history)).encode()
+
+
+def measure(build, history, turns, requests):
+    """Grow `history` by one turn per request; returns (bytes/req, CPU s/req)"""
+    sent = cpu = 0.0
+    for request in range(requests):
+        history.extend(synthetic_turn('bench', turns + request))
+        start = time.process_time()
+        body = build(history)
+        cpu += time.process_time() - start
+        sent += len(body)
+    return sent / requests, cpu / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--turns', type=int, nargs='+', default=[10, 100, 1000], help='session lengths')
+    parser.add_argument('--requests', type=int, default=50, help='requests measured per session length')
+    args = parser.parse_args()
+
+    os.environ.update(
+        LOG_LEVEL='WARNING',
+        CAPTURE_QUEUE_PATH=os.path.join(tempfile.mkdtemp(), 'jobs.db'),
+    )
+    import app
+
+    builders = {"dumps": lambda history: legacy_body(app, history)}
+    for backend in ('json', 'orjson'):
+        if backend == 'orjson' and orjson is None:
+            continue
+        builder = PayloadBuilder(app.chat_params(), backend=backend)
+        builders[f"builder/{backend}"] = (
+            lambda history, builder=builder: builder.build(app.chat_system_prompt(), history, session_id='bench').body
+        )
+
+    # Every variant must produce the same request
+    sample = [message for turn in range(3) for message in synthetic_turn('check', turn)]
+    expected = json.loads(legacy_body(app, sample))
+    for name, build in builders.items():
+        assert json.loads(build(list(sample))) == expected, name
+
+    print(f"{args.requests} requests per session length, full history, "
+          f"default backend: {json_backend()[0]}\n")
+    print(f"{'turns':>6} {'builder':<15} {'KiB/req':>9} {'CPU us/req':>11} {'MiB/s':>8} {'speedup':>8}")
+    for turns in args.turns:
+        baseline = None
+        for name, build in builders.items():
+            history = [message for turn in range(turns) for message in synthetic_turn('bench', turn)]
+            size, cpu = measure(build, history, turns, args.requests)
+            baseline = baseline or cpu
+            rate = size / cpu / 2 ** 20 if cpu else float('inf')
+            print(f"{turns:6d} {name:<15} {size / 1024:9.1f} {cpu * 1e6:11.0f} {rate:8.0f} {baseline / cpu if cpu else 0:7.1f}x")
+        print()
+
+
+if __name__ == '__main__':
+    main()
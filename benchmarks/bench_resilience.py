@@ -0,0 +1,176 @@
+"""
+/chat while Perplexity stalls, with and without circuit breakers, and tail
+latency of /chat with and without hedged completions
+
+Usage: python -m benchmarks.bench_resilience [--rate 10] [--duration 8] [--stall 3.0]
+                                             [--users 20] [--turns 15] [--jitter 0.8]
+
+Outage: every completion takes --stall seconds while turns arrive open-loop
+and GET /capture-payment/<id> is polled alongside.  Without a breaker each
+turn waits out the stall and holds a worker (on the sync server the poll
+queues behind them); with one, turns are answered from templates as soon
+as enough slow calls were seen.
+
+Tail: completions have log-normal latency (sigma --jitter) and users chat
+back to back; hedging sends a backup completion after the p95 latency.
+Every turn needs a completion (no routing or coalescing).
+Requires httpx (load generator) and uvicorn (async server).
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load_chat import free_port, percentile, start_server
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+# Not answered by the intent router, so every turn needs a completion
+MESSAGE = "Can you help me pick a present for my sister?"
+# Start of the reply given when Perplexity can't be used (app.fallback_turn)
+FALLBACK_REPLY = "Sorry, I can't answer that in detail right now."
+
+
+async def post_chat(client, base_url, session_id, latencies, fallbacks):
+    start = time.perf_counter()
+    try:
+        response = await client.post(f'{base_url}/chat', json={"message": MESSAGE, "session_id": session_id})
+        body = response.json() if response.status_code == 200 else {}
+    except (httpx.HTTPError, ValueError):
+        body = {}
+    if 'response' in body:
+        latencies.append(time.perf_counter() - start)
+        fallbacks.append(body['response'].startswith(FALLBACK_REPLY))
+
+
+async def poll_other_endpoint(client, base_url, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            await client.get(f'{base_url}/capture-payment/unknown-order')
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+
+
+async def outage(base_url, rate, duration):
+    """Open-loop new-session turns for `duration` seconds, polling another endpoint meanwhile"""
+    latencies, fallbacks, other = [], [], []
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=200)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        poller = asyncio.create_task(poll_other_endpoint(client, base_url, stop, other))
+        start = time.perf_counter()
+        tasks = []
+        for index in range(int(rate * duration)):
+            await asyncio.sleep(max(0.0, start + index / rate - time.perf_counter()))
+            tasks.append(asyncio.create_task(
+                post_chat(client, base_url, f"outage_{index}_{start}", latencies, fallbacks)
+            ))
+        await asyncio.gather(*tasks)
+        stop.set()
+        await poller
+    return latencies, fallbacks, other
+
+
+async def tail(base_url, users, turns):
+    """Closed-loop users, each turn in a new session"""
+    latencies, fallbacks = [], []
+
+    async def user(index):
+        for turn in range(turns):
+            await post_chat(client, base_url, f"tail_{index}_{turn}_{time.monotonic_ns()}", latencies, fallbacks)
+
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        await asyncio.gather(*(user(index) for index in range(users)))
+    return latencies, fallbacks
+
+
+def ms(values, pct):
+    return f"{percentile(values, pct) * 1000:9.0f}" if values else f"{'-':>9}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=10, help='arriving turns per second during the outage')
+    parser.add_argument('--duration', type=float, default=8, help='seconds of arrivals during the outage')
+    parser.add_argument('--stall', type=float, default=3.0, help='completion latency during the outage (s)')
+    parser.add_argument('--users', type=int, default=20, help='concurrent users for the tail test')
+    parser.add_argument('--turns', type=int, default=15, help='turns per user for the tail test')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='median completion latency for the tail test (s)')
+    parser.add_argument('--jitter', type=float, default=0.8, help='log-normal sigma of completion latency')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads for the sync server')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async', 'prefork'])
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer(latency=args.stall, first_token_latency=0.05, seed=args.seed).start()
+    paypal = StubPayPalServer().start()
+    base_env = {"LOG_LEVEL": "ERROR", "COALESCE_FIRST_TURN": "off"}
+    # Trip quickly enough to show up in a short run
+    breaker_env = {
+        "PERPLEXITY_BREAKER_SLOW_SECONDS": str(args.stall / 3),
+        "PERPLEXITY_BREAKER_MIN_CALLS": "5",
+        "PERPLEXITY_BREAKER_OPEN_SECONDS": "5",
+    }
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            print(f"Outage: {args.rate:.0f} turns/s for {args.duration:.0f}s, every completion takes "
+                  f"{args.stall:.1f}s\n")
+            print(f"{'mode':<16} {'turns':>6} {'fallback':>9} {'p50 ms':>9} {'p99 ms':>9} {'other p99':>10}")
+            for mode in args.modes:
+                for breaker in ('off', 'on'):
+                    perplexity.latency, perplexity.jitter = args.stall, 0.0
+                    env = {
+                        **base_env,
+                        "CAPTURE_QUEUE_PATH": os.path.join(workdir, f'{mode}-breaker-{breaker}.db'),
+                        "PERPLEXITY_BREAKER": breaker,
+                        **breaker_env,
+                    }
+                    port = free_port()
+                    process = start_server(mode, port, args.threads, perplexity, paypal, **env)
+                    try:
+                        latencies, fallbacks, other = asyncio.run(
+                            outage(f'http://127.0.0.1:{port}', args.rate, args.duration)
+                        )
+                    finally:
+                        process.terminate()
+                        process.wait()
+                    print(f"{mode + ' breaker ' + breaker:<16} {len(latencies):6d} {sum(fallbacks):9d} "
+                          f"{ms(latencies, 50)} {ms(latencies, 99)} {ms(other, 99):>10}")
+
+            print(f"\nTail: {args.users} users x {args.turns} turns, completions {args.llm_latency * 1000:.0f} ms "
+                  f"median, jitter {args.jitter}\n")
+            print(f"{'mode':<16} {'turns':>6} {'calls':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+            for mode in args.modes:
+                for hedge in ('off', 'on'):
+                    perplexity.latency, perplexity.jitter = args.llm_latency, args.jitter
+                    env = {
+                        **base_env,
+                        "CAPTURE_QUEUE_PATH": os.path.join(workdir, f'{mode}-hedge-{hedge}.db'),
+                        "PERPLEXITY_HEDGE": hedge,
+                    }
+                    port = free_port()
+                    process = start_server(mode, port, args.threads, perplexity, paypal, **env)
+                    calls_before = perplexity.calls.get('completions', 0)
+                    try:
+                        latencies, _ = asyncio.run(tail(f'http://127.0.0.1:{port}', args.users, args.turns))
+                    finally:
+                        process.terminate()
+                        process.wait()
+                    calls = perplexity.calls.get('completions', 0) - calls_before
+                    print(f"{mode + ' hedge ' + hedge:<16} {len(latencies):6d} {calls:6d} "
+                          f"{ms(latencies, 50)} {ms(latencies, 95)} {ms(latencies, 99)}")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
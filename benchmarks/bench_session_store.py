@@ -0,0 +1,104 @@
+"""
+Memory use of conversation storage under 100k synthetic sessions
+
+Usage: python -m benchmarks.bench_session_store [--sessions 100000] [--turns 6]
+
+Compares the old unbounded dict with the bounded memory store and reports the
+SQLite store's file size, save/load rate and eviction counters.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from session_store import MemorySessionStore, SQLiteSessionStore
+
+TOOL_RESULT = json.dumps({"products": [
+    {"id": "gc_50", "name": "$50 Gift Card", "description": "Most popular choice", "price": 50.0, "currency": "USD"}
+]})
+
+
+def synthetic_turn(session, turn):
+    """One purchase-style turn: user message, assistant tool call, tool result"""
+    call_id = f"call_{session}_{turn}"
+    return [
+        {"role": "user", "content": f"Session {session} turn {turn}: I want to buy the $50 card"},
+        {"role": "assistant", "content": "", "tool_calls": [{
+            "id": call_id, "type": "function",
+            "function": {"name": "create_paypal_checkout", "arguments": '{"product_id": "gc_50"}'}
+        }]},
+        {"role": "tool", "tool_call_id": call_id, "content": TOOL_RESULT},
+    ]
+
+
+def fill(store, sessions, turns):
+    """Replay `turns` load/save cycles for every session; returns elapsed seconds"""
+    start = time.perf_counter()
+    for session in range(sessions):
+        for turn in range(turns):
+            session_id = f"session_{session}"
+            history = store.load(session_id)
+            history.extend(synthetic_turn(session, turn))
+            store.save(session_id, history)
+    return time.perf_counter() - start
+
+
+class UnboundedStore:
+    """The original module-level `conversations = {}` behaviour"""
+
+    def __init__(self):
+        self.conversations = {}
+
+    def load(self, session_id):
+        return self.conversations.setdefault(session_id, [])
+
+    def save(self, session_id, messages):
+        pass
+
+
+def measure_memory(label, store, sessions, turns):
+    tracemalloc.start()
+    elapsed = fill(store, sessions, turns)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    ops = sessions * turns * 2 / elapsed
+    print(f"{label:<22} {current / 2**20:9.1f} MiB  peak {peak / 2**20:9.1f} MiB  {ops:10.0f} ops/s")
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--turns', type=int, default=6, help='turns per session')
+    parser.add_argument('--max-sessions', type=int, default=10000)
+    parser.add_argument('--max-turns', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{args.sessions} sessions x {args.turns} turns "
+          f"(caps: {args.max_sessions} sessions, {args.max_turns} turns)\n")
+
+    measure_memory("unbounded dict", UnboundedStore(), args.sessions, args.turns)
+    store = measure_memory(
+        "memory store",
+        MemorySessionStore(max_sessions=args.max_sessions, max_turns=args.max_turns),
+        args.sessions, args.turns
+    )
+    print(f"{'':<22} {store.snapshot()}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sessions.db')
+        store = SQLiteSessionStore(path, max_sessions=args.max_sessions, max_turns=args.max_turns,
+                                   sweep_interval=1000)
+        elapsed = fill(store, args.sessions, args.turns)
+        store.sweep()
+        size = sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+        print(f"{'sqlite store':<22} {size / 2**20:9.1f} MiB on disk "
+              f"{args.sessions * args.turns * 2 / elapsed:22.0f} ops/s")
+        print(f"{'':<22} {store.snapshot()}")
+
+
+if __name__ == '__main__':
+    main()
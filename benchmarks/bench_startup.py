@@ -0,0 +1,167 @@
+"""
+Cold start: import time of the app modules and time to the first request
+
+Usage: python -m benchmarks.bench_startup [--runs 5] [--json startup.json]
+                                          [--baseline startup.json] [--tolerance 0.25]
+
+Imports each module --runs times in a fresh interpreter under
+`python -X importtime` and reports the median, plus the heaviest imports of
+the last run.  Then starts each server mode --runs times against local
+stubs and reports the median time from launch until GET /health answers (ready) and until the
+first /chat turn that needs a completion has been answered (first reply).
+The first turn's own latency against the second's is what it pays for
+setup left to it.  With --baseline, exits
+1 if any figure grew by more than --tolerance against a previous --json
+run, so it can run in CI.  Requires httpx (load generator) and uvicorn
+(async server).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load_chat import free_port, start_server
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+# Not answered by the intent router, so the turn needs a completion
+MESSAGE = "Can you help me pick a present for my sister?"
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module, env):
+    """Run `import module` under -X importtime; returns (total ms, {import: cumulative ms})"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO, env=env, capture_output=True, text=True, check=True
+    )
+    # Imports are listed after their own imports, so a module's direct
+    # imports are the one-level-deep lines just above it
+    children, cumulative, total = {}, {}, None
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, micros, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(micros) / 1000
+        elif depth == 0:
+            if name.strip() == module:
+                total, cumulative = int(micros) / 1000, children
+            children = {}
+    return total, cumulative
+
+
+def time_startup(mode, threads, perplexity, paypal, env):
+    """Seconds from launch to ready, to the end of the first turn and of the second"""
+    port = free_port()
+    start = time.perf_counter()
+    process = start_server(mode, port, threads, perplexity, paypal, poll_interval=0.005, **env)
+    try:
+        ready = time.perf_counter() - start
+        turns = []
+        with httpx.Client(timeout=30) as client:
+            for index in range(2):
+                sent = time.perf_counter()
+                response = client.post(f'http://127.0.0.1:{port}/chat',
+                                       json={"message": MESSAGE, "session_id": f"startup_{index}"})
+                response.raise_for_status()
+                turns.append(time.perf_counter() - sent)
+    finally:
+        process.terminate()
+        process.wait()
+    return ready, turns[0], turns[1]
+
+
+def regressions(result, baseline, tolerance):
+    """Human-readable list of figures worse than `baseline` by more than `tolerance`"""
+    found = []
+    for section, rows in result.items():
+        for name, figures in rows.items():
+            previous = baseline.get(section, {}).get(name, {})
+            for key, now in figures.items():
+                was = previous.get(key)
+                if was and now > was * (1 + tolerance):
+                    found.append(f"{section} {name} {key} {was} -> {now}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per import and server launches per mode')
+    parser.add_argument('--modules', nargs='+', default=['app', 'asgi_app'], help='modules to import')
+    parser.add_argument('--top', type=int, default=8, help='heaviest imports listed per module')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads for the sync server')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async', 'prefork'])
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the imports and servers (repeatable)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results from an earlier --json run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression vs the baseline')
+    args = parser.parse_args()
+
+    # No upstream latency, so the first turn shows only what the app sets up for it
+    perplexity = StubPerplexityServer(latency=0.0, first_token_latency=0.0).start()
+    paypal = StubPayPalServer(token_latency=0.0, order_latency=0.0, capture_latency=0.0).start()
+    env_overrides = dict(item.split('=', 1) for item in args.env)
+    results = {"import": {}, "startup": {}}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(
+                os.environ,
+                LOG_LEVEL="WARNING",
+                CAPTURE_QUEUE_PATH=os.path.join(workdir, 'import-jobs.db'),
+                **env_overrides
+            )
+            print(f"Median of {args.runs} fresh interpreters per module and launches per mode\n")
+            for module in args.modules:
+                runs = [import_times(module, env) for _ in range(args.runs)]
+                median = statistics.median(total for total, _ in runs)
+                results["import"][module] = {"median_ms": round(median, 1)}
+                heaviest = sorted(runs[-1][1].items(), key=lambda item: item[1], reverse=True)[:args.top]
+                print(f"{module}: {median:.0f} ms")
+                for name, ms in heaviest:
+                    print(f"  {name:<24} {ms:7.1f} ms")
+                print()
+
+            print(f"{'mode':<7} {'ready ms':>9} {'first reply ms':>15} {'1st turn ms':>12} {'2nd turn ms':>12}")
+            for mode in args.modes:
+                server_env = {
+                    "LOG_LEVEL": "WARNING",
+                    "CAPTURE_QUEUE_PATH": os.path.join(workdir, f'{mode}-jobs.db'),
+                    **env_overrides,
+                }
+                launches = [time_startup(mode, args.threads, perplexity, paypal, server_env)
+                            for _ in range(args.runs)]
+                ready, first, second = (statistics.median(column) for column in zip(*launches))
+                results["startup"][mode] = {
+                    "ready_ms": round(ready * 1000, 1),
+                    "first_reply_ms": round((ready + first) * 1000, 1),
+                }
+                print(f"{mode:<7} {ready * 1000:9.0f} {(ready + first) * 1000:15.0f} "
+                      f"{first * 1000:12.1f} {second * 1000:12.1f}")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
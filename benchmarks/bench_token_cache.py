@@ -0,0 +1,61 @@
+"""
+Checkout latency with and without the PayPal token cache
+
+Usage: python -m benchmarks.bench_token_cache [--checkouts 50] [--latency 0.05]
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+os.environ.setdefault('PAYPAL_CLIENT_ID', 'bench-client-id')
+os.environ.setdefault('PAYPAL_CLIENT_SECRET', 'bench-client-secret')
+# Per-checkout log lines would drown the report
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import app  # noqa: E402
+from benchmarks.stubs import StubPayPalServer  # noqa: E402
+
+
+def run_checkouts(count, uncached):
+    """Run `count` checkouts and return per-checkout latencies in seconds"""
+    latencies = []
+    for _ in range(count):
+        if uncached:
+            app.paypal_token_cache.invalidate()
+        start = time.perf_counter()
+        app.create_paypal_checkout('gc_50')
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(label, latencies, calls):
+    ms = sorted(x * 1000 for x in latencies)
+    p95 = ms[int(len(ms) * 0.95) - 1]
+    print(f"{label:<10} mean {statistics.mean(ms):7.1f} ms   p50 {statistics.median(ms):7.1f} ms   "
+          f"p95 {p95:7.1f} ms   token calls {calls.get('token', 0):4d}   order calls {calls.get('orders', 0):4d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--checkouts', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated PayPal latency per call, in seconds')
+    args = parser.parse_args()
+
+    stub = StubPayPalServer(token_latency=args.latency, order_latency=args.latency).start()
+    app.PAYPAL_API_BASE[app.PAYPAL_MODE] = stub.url
+    try:
+        print(f"{args.checkouts} checkouts, {args.latency * 1000:.0f} ms per PayPal call\n")
+        for label, uncached in (("uncached", True), ("cached", False)):
+            app.paypal_token_cache.invalidate()
+            stub.calls.clear()
+            latencies = run_checkouts(args.checkouts, uncached)
+            report(label, latencies, stub.calls)
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
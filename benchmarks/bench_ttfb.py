@@ -0,0 +1,59 @@
+"""
+Time to first byte of /chat vs /chat/stream
+
+Usage: python -m benchmarks.bench_ttfb [--requests 10] [--llm-latency 1.0]
+"""
+
+import argparse
+import statistics
+import time
+
+import requests
+
+from benchmarks.load_chat import SCRIPT, free_port, start_server
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+
+def measure(url, message, session_id):
+    """Return (seconds to first body byte, seconds to end of body)"""
+    start = time.perf_counter()
+    first = None
+    with requests.post(url, json={"message": message, "session_id": session_id}, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=64):
+            if chunk and first is None:
+                first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='stub completion latency (s)')
+    parser.add_argument('--first-token', type=float, default=0.15, help='stub time to first token (s)')
+    parser.add_argument('--paypal-latency', type=float, default=0.2, help='stub PayPal latency (s)')
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer(latency=args.llm_latency, first_token_latency=args.first_token).start()
+    paypal = StubPayPalServer(token_latency=args.paypal_latency, order_latency=args.paypal_latency).start()
+    port = free_port()
+    process = start_server('sync', port, 16, perplexity, paypal)
+    try:
+        print(f"{'endpoint':<13} {'message':<30} {'ttfb ms':>8} {'total ms':>9}")
+        for path in ('/chat', '/chat/stream'):
+            for turn, message in enumerate(SCRIPT):
+                results = [
+                    measure(f'http://127.0.0.1:{port}{path}', message, f'ttfb_{path}_{turn}_{i}')
+                    for i in range(args.requests)
+                ]
+                ttfb = statistics.median(r[0] for r in results) * 1000
+                total = statistics.median(r[1] for r in results) * 1000
+                print(f"{path:<13} {message[:30]:<30} {ttfb:8.0f} {total:9.0f}")
+    finally:
+        process.terminate()
+        process.wait()
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Replayable end-to-end benchmark: scripted conversations through checkout and capture
+
+Usage: python -m benchmarks.e2e [--users 50] [--rounds 2] [--seed 1] [--json results.json]
+                                [--baseline baseline.json] [--tolerance 0.15]
+
+Each virtual user plays conversations drawn (with a seeded RNG, so runs are
+replayable) from benchmarks/corpus/conversations.json against /chat.
+Conversations that end in a checkout POST /capture-payment with the order
+and poll GET /capture-payment/<order_id> until the job settles.  The
+Perplexity and PayPal stubs add log-normal latency jitter and can inject
+upstream errors.
+
+Reports throughput, p50/p95/p99 per step, failures and the RSS growth of
+the server (in prefork mode, the gunicorn master and its workers).  With
+--baseline, exits 1 if any mode regressed by more than --tolerance against
+a previous --json run, so it can gate performance changes.
+Requires httpx (load generator) and uvicorn (async server).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+
+from benchmarks.load_chat import free_port, percentile, start_server
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus', 'conversations.json')
+
+# Steps reported per mode; capture is enqueue-to-settled as seen by the client
+STEPS = ('chat', 'capture_enqueue', 'capture')
+
+
+def load_conversations(path=CORPUS):
+    with open(path) as f:
+        return json.load(f)
+
+
+def plan_conversations(conversations, users, rounds, seed):
+    """The conversations each user plays, fixed by `seed`"""
+    rng = random.Random(seed)
+    weights = [conversation.get('weight', 1) for conversation in conversations]
+    return [rng.choices(conversations, weights, k=rounds) for _ in range(users)]
+
+
+def order_id_from(checkout_url):
+    """PayPal order ID from an approval URL (its `token` parameter)"""
+    return parse_qs(urlparse(checkout_url).query).get('token', [None])[0]
+
+
+def process_rss_kb(pid):
+    """Resident set size of one process in kB, or None off Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    """PIDs of a process's children, found by scanning /proc"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The name in parentheses may contain spaces; the parent PID is
+                # the second field after it
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            pass
+    return children
+
+
+def rss_kb(pid):
+    """RSS in kB of a process and all its descendants, or None off Linux
+
+    In prefork mode this is the gunicorn master plus its workers.  Pages the
+    workers share are counted once per worker, so the total overstates the
+    memory in use but its growth is still each worker's own.
+    """
+    own = process_rss_kb(pid)
+    if own is None:
+        return None
+    return own + sum(rss_kb(child) or 0 for child in child_pids(pid))
+
+
+def settled_rss_kb(pid, interval=0.5, timeout=15):
+    """rss_kb() once it stops growing, so workers still booting are not counted as growth"""
+    deadline = time.monotonic() + timeout
+    previous = rss_kb(pid)
+    while previous is not None and time.monotonic() < deadline:
+        time.sleep(interval)
+        current = rss_kb(pid)
+        if current is None or abs(current - previous) <= previous * 0.01:
+            return current
+        previous = current
+    return previous
+
+
+class Recorder:
+    """Latencies and failures per step"""
+
+    def __init__(self):
+        self.latencies = {step: [] for step in STEPS}
+        self.failures = {step: 0 for step in STEPS}
+
+    def ok(self, step, seconds):
+        self.latencies[step].append(seconds)
+
+    def fail(self, step):
+        self.failures[step] += 1
+
+
+async def capture(client, base_url, order_id, recorder, poll_interval, capture_timeout):
+    start = time.perf_counter()
+    try:
+        response = await client.post(f'{base_url}/capture-payment', json={"order_id": order_id})
+    except httpx.HTTPError:
+        recorder.fail('capture_enqueue')
+        return
+    if response.status_code != 202:
+        recorder.fail('capture_enqueue')
+        return
+    recorder.ok('capture_enqueue', time.perf_counter() - start)
+
+    deadline = start + capture_timeout
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(poll_interval)
+        try:
+            status = (await client.get(f'{base_url}/capture-payment/{order_id}')).json().get('status')
+        except (httpx.HTTPError, ValueError):
+            continue
+        if status == 'completed':
+            recorder.ok('capture', time.perf_counter() - start)
+            return
+        if status == 'failed':
+            break
+    recorder.fail('capture')
+
+
+async def run_user(client, base_url, user, plan, recorder, poll_interval, capture_timeout):
+    for index, conversation in enumerate(plan):
+        session_id = f"e2e_{user}_{index}_{time.monotonic_ns()}"
+        order_id = None
+        for message in conversation['turns']:
+            start = time.perf_counter()
+            try:
+                response = await client.post(f'{base_url}/chat', json={
+                    "message": message,
+                    "session_id": session_id
+                })
+                body = response.json()
+                ok = response.status_code == 200 and 'error' not in body
+            except (httpx.HTTPError, ValueError):
+                ok = False
+            if not ok:
+                recorder.fail('chat')
+                continue
+            recorder.ok('chat', time.perf_counter() - start)
+            if body.get('checkout_url'):
+                order_id = order_id_from(body['checkout_url']) or order_id
+        if conversation.get('capture') and order_id:
+            await capture(client, base_url, order_id, recorder, poll_interval, capture_timeout)
+
+
+async def run_e2e(base_url, plans, poll_interval=0.05, capture_timeout=30):
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=len(plans), max_keepalive_connections=len(plans))
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(client, base_url, user, plan, recorder, poll_interval, capture_timeout)
+            for user, plan in enumerate(plans)
+        ))
+        elapsed = time.perf_counter() - start
+    return recorder, elapsed
+
+
+def summarize(recorder, elapsed, rss_before, rss_after):
+    result = {
+        "elapsed_s": round(elapsed, 3),
+        "chat_rps": round(len(recorder.latencies['chat']) / elapsed, 2),
+        "rss_growth_kb": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+        "steps": {},
+    }
+    for step in STEPS:
+        latencies = recorder.latencies[step]
+        result["steps"][step] = {
+            "ok": len(latencies),
+            "failed": recorder.failures[step],
+            **{f"p{pct}_ms": round(percentile(latencies, pct) * 1000, 1) if latencies else None
+               for pct in (50, 95, 99)},
+        }
+    return result
+
+
+def regressions(result, baseline, tolerance):
+    """Human-readable list of metrics worse than `baseline` by more than `tolerance`"""
+    found = []
+    for mode, current in result.items():
+        previous = baseline.get(mode)
+        if not previous:
+            continue
+        if current["chat_rps"] < previous["chat_rps"] * (1 - tolerance):
+            found.append(f"{mode} chat req/s {previous['chat_rps']} -> {current['chat_rps']}")
+        for step in STEPS:
+            for pct in ('p95_ms', 'p99_ms'):
+                was, now = previous["steps"][step][pct], current["steps"][step][pct]
+                if was and now and now > was * (1 + tolerance):
+                    found.append(f"{mode} {step} {pct} {was} -> {now}")
+            was_failed, now_failed = previous["steps"][step]["failed"], current["steps"][step]["failed"]
+            if now_failed > was_failed * (1 + tolerance):
+                found.append(f"{mode} {step} failures {was_failed} -> {now_failed}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--rounds', type=int, default=2, help='conversations per user')
+    parser.add_argument('--seed', type=int, default=1, help='seed for conversation choice and stub jitter/errors')
+    parser.add_argument('--corpus', default=CORPUS, help='conversation script (JSON)')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads for the sync server')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='median stub completion latency (s)')
+    parser.add_argument('--paypal-latency', type=float, default=0.1, help='median stub PayPal latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.3, help='log-normal sigma of stub latencies')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='fraction of completions that fail')
+    parser.add_argument('--paypal-error-rate', type=float, default=0.0, help='fraction of PayPal calls that fail')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async', 'prefork'])
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the server under test (repeatable)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results from an earlier --json run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed regression vs the baseline')
+    args = parser.parse_args()
+
+    plans = plan_conversations(load_conversations(args.corpus), args.users, args.rounds, args.seed)
+    env_overrides = dict(item.split('=', 1) for item in args.env)
+
+    perplexity = StubPerplexityServer(
+        latency=args.llm_latency, jitter=args.jitter, error_rate=args.llm_error_rate,
+        error_statuses=(429, 500, 503), seed=args.seed
+    ).start()
+    paypal = StubPayPalServer(
+        token_latency=args.paypal_latency, order_latency=args.paypal_latency,
+        capture_latency=args.paypal_latency, jitter=args.jitter, error_rate=args.paypal_error_rate,
+        error_statuses=(500, 503), seed=args.seed + 1
+    ).start()
+
+    print(f"{args.users} users x {args.rounds} conversations (seed {args.seed}), "
+          f"LLM {args.llm_latency * 1000:.0f} ms, PayPal {args.paypal_latency * 1000:.0f} ms, "
+          f"jitter {args.jitter}, errors LLM {args.llm_error_rate:.0%} / PayPal {args.paypal_error_rate:.0%}\n")
+    print(f"{'mode':<7} {'step':<16} {'ok':>6} {'failed':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for mode in args.modes:
+                port = free_port()
+                env = {
+                    "LOG_LEVEL": "WARNING",
+                    "CAPTURE_QUEUE_PATH": os.path.join(workdir, f'{mode}-jobs.db'),
+                    "CAPTURE_RETRY_BACKOFF": "0.2",
+                    **env_overrides,
+                }
+                process = start_server(mode, port, args.threads, perplexity, paypal, **env)
+                try:
+                    rss_before = settled_rss_kb(process.pid)
+                    recorder, elapsed = asyncio.run(run_e2e(f'http://127.0.0.1:{port}', plans))
+                    rss_after = rss_kb(process.pid)
+                finally:
+                    process.terminate()
+                    process.wait()
+                result = results[mode] = summarize(recorder, elapsed, rss_before, rss_after)
+                for step, stats in result["steps"].items():
+                    latencies = [
+                        f"{stats[key]:9.0f}" if stats[key] is not None else f"{'-':>9}"
+                        for key in ('p50_ms', 'p95_ms', 'p99_ms')
+                    ]
+                    print(f"{mode:<7} {step:<16} {stats['ok']:6d} {stats['failed']:7d} {' '.join(latencies)}")
+                growth = result["rss_growth_kb"]
+                print(f"{mode:<7} {result['chat_rps']:.1f} chat req/s, RSS "
+                      f"{'+' + str(growth) + ' kB' if growth is not None else 'n/a'}\n")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+    print(f"Upstream calls: perplexity {perplexity.calls}, paypal {paypal.calls}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
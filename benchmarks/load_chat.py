@@ -0,0 +1,137 @@
+"""
+Load test /chat on the sync (Flask) and async (ASGI) pipelines
+
+Usage: python -m benchmarks.load_chat [--users 200] [--turns 3] [--llm-latency 0.3]
+
+Both servers run in a subprocess against local Perplexity and PayPal stubs.
+Each virtual user holds its own session and sends a scripted conversation.
+Requires httpx (load generator) and uvicorn (async server).
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.stubs import StubPayPalServer, StubPerplexityServer
+
+SCRIPT = [
+    "What gift cards do you have?",
+    "I want to buy the $50 card",
+    "Thanks, that's all",
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, threads, perplexity, paypal, output=subprocess.DEVNULL, poll_interval=0.1,
+                 **env_overrides):
+    env = dict(
+        os.environ,
+        PERPLEXITY_API_KEY='bench-key',
+        PERPLEXITY_API_URL=perplexity.completions_url,
+        PAYPAL_CLIENT_ID='bench-client-id',
+        PAYPAL_CLIENT_SECRET='bench-client-secret',
+        PAYPAL_API_URL=paypal.url,
+        **env_overrides
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.servers', mode, '--port', str(port), '--threads', str(threads)],
+        env=env, stdout=output, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 15
+    with httpx.Client(timeout=1) as client:
+        while time.monotonic() < deadline:
+            try:
+                if client.get(f'http://127.0.0.1:{port}/health').status_code == 200:
+                    return process
+            except httpx.HTTPError:
+                time.sleep(poll_interval)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not become healthy on port {port}")
+
+
+async def run_user(client, base_url, user, turns, latencies, failures):
+    session_id = f"load_{user}_{time.monotonic_ns()}"
+    for turn in range(turns):
+        start = time.perf_counter()
+        try:
+            response = await client.post(f'{base_url}/chat', json={
+                "message": SCRIPT[turn % len(SCRIPT)],
+                "session_id": session_id
+            })
+            ok = response.status_code == 200 and 'error' not in response.json()
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            failures.append(turn)
+
+
+async def run_load(base_url, users, turns):
+    latencies, failures = [], []
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(client, base_url, user, turns, latencies, failures)
+            for user in range(users)
+        ))
+        elapsed = time.perf_counter() - start
+    return latencies, failures, elapsed
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='concurrent virtual users')
+    parser.add_argument('--turns', type=int, default=3, help='messages per user')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads for the sync server')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='stub completion latency (s)')
+    parser.add_argument('--paypal-latency', type=float, default=0.1, help='stub PayPal latency (s)')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async', 'prefork'])
+    args = parser.parse_args()
+
+    perplexity = StubPerplexityServer(latency=args.llm_latency).start()
+    paypal = StubPayPalServer(token_latency=args.paypal_latency, order_latency=args.paypal_latency).start()
+
+    print(f"{args.users} users x {args.turns} turns, LLM {args.llm_latency * 1000:.0f} ms, "
+          f"PayPal {args.paypal_latency * 1000:.0f} ms, sync threads {args.threads}\n")
+    print(f"{'mode':<7} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'failed':>7}")
+    try:
+        for mode in args.modes:
+            port = free_port()
+            process = start_server(mode, port, args.threads, perplexity, paypal)
+            try:
+                latencies, failures, elapsed = asyncio.run(
+                    run_load(f'http://127.0.0.1:{port}', args.users, args.turns)
+                )
+            finally:
+                process.terminate()
+                process.wait()
+            if latencies:
+                print(f"{mode:<7} {len(latencies) / elapsed:8.1f} {percentile(latencies, 50) * 1000:9.0f} "
+                      f"{percentile(latencies, 99) * 1000:9.0f} {len(failures):7d}")
+            else:
+                print(f"{mode:<7} all {len(failures)} requests failed")
+    finally:
+        perplexity.stop()
+        paypal.stop()
+
+
+if __name__ == '__main__':
+    main()
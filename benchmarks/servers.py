@@ -0,0 +1,77 @@
+"""
+Run the app under test for load benchmarks
+
+Usage: python -m benchmarks.servers {sync,async,prefork} --port 5000 [--threads 16]
+
+`sync` serves the Flask app from a fixed pool of worker threads, the way a
+gthread worker would; `async` serves asgi_app under uvicorn; `prefork` runs
+the production gunicorn setup (gunicorn.conf.py, WEB_CONCURRENCY workers).
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def serve_sync(port, threads):
+    from werkzeug.serving import BaseWSGIServer
+
+    from app import app
+
+    class PooledWSGIServer(BaseWSGIServer):
+        """WSGI server handing requests to a fixed-size thread pool"""
+
+        request_queue_size = 1024
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+        def process_request(self, request, client_address):
+            self.executor.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    PooledWSGIServer('127.0.0.1', port, app).serve_forever()
+
+
+def serve_async(port):
+    import uvicorn
+
+    uvicorn.run('asgi_app:app', host='127.0.0.1', port=port, log_level='warning',
+                access_log=False, backlog=1024)
+
+
+def serve_prefork(port, threads):
+    # Replace this process, so terminating it sends SIGTERM to the gunicorn master
+    os.execv(sys.executable, [
+        sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+        '--bind', f'127.0.0.1:{port}', '--threads', str(threads), '--log-level', 'warning'
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the app for load benchmarks')
+    parser.add_argument('mode', choices=['sync', 'async', 'prefork'])
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16,
+                        help='worker threads for the sync server')
+    args = parser.parse_args()
+
+    if args.mode == 'sync':
+        serve_sync(args.port, args.threads)
+    elif args.mode == 'prefork':
+        serve_prefork(args.port, args.threads)
+    else:
+        serve_async(args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Local stand-ins for the Perplexity and PayPal APIs so benchmarks never hit
+the real services
+
+Every stub takes a `jitter` (latencies are drawn from a log-normal
+distribution whose median is the configured latency and whose sigma is
+`jitter`) and an `error_rate` (that fraction of calls fails with one of
+`error_statuses`), so retries and tail latency can be exercised too.  A
+`concurrency` cap makes calls beyond it queue for a slot, like an upstream
+with limited capacity.
+"""
+
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Shared plumbing for the stub request handlers"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; avoid delayed-ACK stalls on keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            # OAuth token requests are form-encoded
+            return {}
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubServer(ThreadingHTTPServer):
+    """Threaded stub server with call counters, latency jitter and error injection"""
+
+    daemon_threads = True
+    # Load tests open hundreds of connections at once
+    request_queue_size = 1024
+
+    def __init__(self, handler, port=0, jitter=0.0, error_rate=0.0, error_statuses=(500, 503), seed=None,
+                 concurrency=0):
+        super().__init__(("127.0.0.1", port), handler)
+        self.jitter = jitter
+        self._slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.calls = {}
+        self._calls_lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def sample_latency(self, median):
+        """A latency drawn around `median` (exactly `median` without jitter)"""
+        if not self.jitter or median <= 0:
+            return median
+        with self._random_lock:
+            return median * math.exp(self._random.gauss(0.0, self.jitter))
+
+    def delay(self, median):
+        if self._slots is None:
+            time.sleep(self.sample_latency(median))
+            return
+        with self._slots:
+            time.sleep(self.sample_latency(median))
+
+    def injected_error(self):
+        """Status code to fail this call with, or None"""
+        if not self.error_rate:
+            return None
+        with self._random_lock:
+            if self._random.random() >= self.error_rate:
+                return None
+            return self._random.choice(self.error_statuses)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, endpoint):
+        with self._calls_lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early (e.g. a cancelled hedged request) are expected
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubPayPalHandler(StubHandler):
+    """Minimal PayPal REST API: OAuth token, order creation and capture"""
+
+    def do_POST(self):
+        server = self.server
+        self.read_json()
+
+        if self.path == "/v1/oauth2/token":
+            server.count("token")
+            server.delay(server.token_latency)
+            if self.send_injected_error():
+                return
+            self.send_json(200, {
+                "access_token": f"stub-token-{uuid.uuid4().hex}",
+                "token_type": "Bearer",
+                "expires_in": server.token_expires_in,
+            })
+        elif self.path == "/v2/checkout/orders":
+            server.count("orders")
+            server.delay(server.order_latency)
+            if self.send_injected_error():
+                return
+            order_id = uuid.uuid4().hex[:17].upper()
+            self.send_json(201, {
+                "id": order_id,
+                "status": "CREATED",
+                "links": [
+                    {"rel": "self", "href": f"{server.url}/v2/checkout/orders/{order_id}"},
+                    {"rel": "approve", "href": f"https://www.sandbox.paypal.com/checkoutnow?token={order_id}"},
+                    {"rel": "capture", "href": f"{server.url}/v2/checkout/orders/{order_id}/capture"},
+                ],
+            })
+        elif self.path.startswith("/v2/checkout/orders/") and self.path.endswith("/capture"):
+            server.count("capture")
+            server.delay(server.capture_latency)
+            if self.send_injected_error():
+                return
+            order_id = self.path.split("/")[-2]
+            self.send_json(201, {"id": order_id, "status": "COMPLETED"})
+        else:
+            self.send_json(404, {"name": "RESOURCE_NOT_FOUND"})
+
+    def send_injected_error(self):
+        status = self.server.injected_error()
+        if status is None:
+            return False
+        self.server.count(f"error_{status}")
+        self.send_json(status, {"name": "INTERNAL_SERVICE_ERROR", "message": "Injected by the stub"})
+        return True
+
+
+class StubPayPalServer(StubServer):
+    """PayPal stub with per-endpoint latency"""
+
+    def __init__(self, token_latency=0.05, order_latency=0.05, capture_latency=0.05,
+                 token_expires_in=32400, port=0, **options):
+        super().__init__(StubPayPalHandler, port, **options)
+        self.token_latency = token_latency
+        self.order_latency = order_latency
+        self.capture_latency = capture_latency
+        self.token_expires_in = token_expires_in
+
+
+# Dollar amounts the stub model recognises as a purchase, mapped to product IDs
+STUB_DENOMINATIONS = {"25": "gc_25", "50": "gc_50", "100": "gc_100"}
+STUB_QUANTITIES = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5}
+# "two $25 cards and one $100": an optional quantity before each denomination
+STUB_CART_LINE = re.compile(r"(?:\b(a|an|one|two|three|four|five|\d)\s+)?\$(25|50|100)\b")
+
+
+class StubPerplexityHandler(StubHandler):
+    """Scripted /chat/completions: tool calls for catalog and purchase requests"""
+
+    def do_POST(self):
+        server = self.server
+        body = self.read_json()
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": "not found"})
+            return
+
+        server.count("completions")
+        status = server.injected_error()
+        if status is not None:
+            server.delay(server.first_token_latency)
+            server.count(f"error_{status}")
+            self.send_json(status, {"error": {"message": "Injected by the stub", "code": status}})
+            return
+        message = self.reply(body.get("messages", []))
+        if body.get("stream"):
+            self.stream(message)
+            return
+        # Prompt processing time grows with the size of the request
+        server.delay(server.latency + server.latency_per_kb * int(self.headers.get("Content-Length") or 0) / 1024)
+        self.send_json(200, {
+            "id": f"stub-{uuid.uuid4().hex}",
+            "model": body.get("model", "sonar-pro"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+        })
+
+    def stream(self, message):
+        """Send `message` as SSE deltas: first token after first_token_latency,
+        the rest spread over the remainder of the completion latency"""
+        server = self.server
+        deltas = [{"role": "assistant"}]
+        words = (message.get("content") or "").split(" ")
+        deltas += [{"content": word if i == 0 else " " + word} for i, word in enumerate(words) if word]
+        for index, call in enumerate(message.get("tool_calls") or []):
+            arguments = call["function"]["arguments"]
+            middle = len(arguments) // 2
+            deltas.append({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                           "function": {"name": call["function"]["name"], "arguments": arguments[:middle]}}]})
+            deltas.append({"tool_calls": [{"index": index, "function": {"arguments": arguments[middle:]}}]})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        server.delay(server.first_token_latency)
+        interval = max(0.0, server.sample_latency(server.latency) - server.first_token_latency) / len(deltas)
+        for delta in deltas:
+            chunk = {"id": "stub", "choices": [{"index": 0, "delta": delta}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            time.sleep(interval)
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def reply(self, messages):
+        last = messages[-1] if messages else {}
+        if last.get("role") == "tool":
+            return {"role": "assistant", "content": "Great! Please click the PayPal button below to complete your purchase."}
+
+        text = (last.get("content") or "").lower()
+        amount = re.search(r"\$?(25|50|100)\b", text)
+        if amount and any(word in text for word in ("buy", "want", "get", "purchase", "take")):
+            cart = [
+                {"product_id": STUB_DENOMINATIONS[denomination],
+                 "quantity": int(STUB_QUANTITIES.get(quantity, quantity or 1))}
+                for quantity, denomination in STUB_CART_LINE.findall(text)
+            ]
+            if len(cart) > 1 and "separate" in text:
+                # One checkout per card, as parallel tool calls
+                return self.tool_calls(*(("create_paypal_checkout", line) for line in cart))
+            if len(cart) > 1 or (cart and cart[0]["quantity"] > 1):
+                return self.tool_call("create_paypal_checkout", {"items": cart})
+            return self.tool_call("create_paypal_checkout", {"product_id": STUB_DENOMINATIONS[amount.group(1)]})
+        if any(word in text for word in ("what", "available", "have", "list", "options")):
+            return self.tool_call("list_gift_cards", {})
+        return {"role": "assistant", "content": "I can help you pick a $25, $50 or $100 gift card."}
+
+    def tool_call(self, name, arguments):
+        return self.tool_calls((name, arguments))
+
+    def tool_calls(self, *calls):
+        return {
+            "role": "assistant",
+            "content": "",
+            "tool_calls": [
+                {
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(arguments)},
+                }
+                for name, arguments in calls
+            ],
+        }
+
+
+class StubPerplexityServer(StubServer):
+    """Perplexity stub with a median completion latency"""
+
+    def __init__(self, latency=0.2, first_token_latency=0.05, latency_per_kb=0.0, port=0, **options):
+        super().__init__(StubPerplexityHandler, port, **options)
+        self.latency = latency
+        self.latency_per_kb = latency_per_kb
+        self.first_token_latency = min(first_token_latency, latency)
+
+    @property
+    def completions_url(self):
+        return f"{self.url}/chat/completions"
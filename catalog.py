@@ -0,0 +1,281 @@
+"""
+Indexed product catalog
+Products come from a JSON file, a SQLite database or a built-in list and are
+indexed by id, price, currency and keyword, so lookups and filtered, paginated
+listings don't scan the catalog.  Anything derived from it (tool schema,
+prompt text) is cached until the catalog changes; the source is re-checked
+for changes at most every `reload_interval` seconds.
+"""
+
+import bisect
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+
+log = logging.getLogger('giftcards.catalog')
+
+REQUIRED_FIELDS = ('id', 'name', 'price', 'currency')
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def normalize_product(raw):
+    """Validated copy of a product record; raises ValueError"""
+    missing = [field for field in REQUIRED_FIELDS if raw.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"Product {raw.get('id')!r} is missing {', '.join(missing)}")
+    product = dict(raw)
+    product['id'] = str(raw['id'])
+    product['name'] = str(raw['name'])
+    product['description'] = raw.get('description') or ''
+    product['price'] = float(raw['price'])
+    product['currency'] = str(raw['currency']).upper()
+    if product['price'] <= 0:
+        raise ValueError(f"Product {product['id']!r} has a non-positive price")
+    return product
+
+
+def read_products(source):
+    """Raw product records from a .json file or a SQLite database's `products` table
+
+    The JSON file holds a list of products or {"products": [...]}.  The table
+    needs id, name, price and currency columns; description and keywords are
+    optional, and any other column is passed through.
+    """
+    if source.endswith('.json'):
+        with open(source) as f:
+            data = json.load(f)
+        return data['products'] if isinstance(data, dict) else data
+    db = sqlite3.connect(f'file:{source}?mode=ro', uri=True, timeout=5)
+    try:
+        db.row_factory = sqlite3.Row
+        return [dict(row) for row in db.execute("SELECT * FROM products ORDER BY rowid")]
+    finally:
+        db.close()
+
+
+def keywords(product):
+    """Search terms of a product: words of its id, name, description and keywords"""
+    extra = product.get('keywords') or ''
+    if not isinstance(extra, str):
+        extra = ' '.join(extra)
+    text = ' '.join((product['id'], product['name'], product['description'], extra))
+    return set(WORD.findall(text.lower()))
+
+
+class _Index:
+    """Immutable lookup structures for one version of the catalog"""
+
+    def __init__(self, records):
+        self.products = {}
+        for record in records:
+            product = normalize_product(record)
+            if product['id'] in self.products:
+                raise ValueError(f"Duplicate product ID {product['id']!r}")
+            self.products[product['id']] = product
+        if not self.products:
+            raise ValueError("The catalog has no products")
+
+        # Price order (ties keep catalog order); listings come back in this order
+        ordered = sorted(self.products.values(), key=lambda p: p['price'])
+        self.ids = [p['id'] for p in ordered]
+        self.prices = [p['price'] for p in ordered]
+        self.rank = {pid: position for position, pid in enumerate(self.ids)}
+
+        self.by_currency = {}  # currency -> ([price, ...], [id, ...]) in price order
+        self.by_keyword = {}  # word -> {id, ...}
+        for product in ordered:
+            prices, ids = self.by_currency.setdefault(product['currency'], ([], []))
+            prices.append(product['price'])
+            ids.append(product['id'])
+            for word in keywords(product):
+                self.by_keyword.setdefault(word, set()).add(product['id'])
+
+
+class Catalog(Mapping):
+    """Read-only mapping of product ID -> product, with indexed queries
+
+    Reloading swaps in a complete new index, so readers never see a half-built
+    catalog.  `on_change` callbacks run after each reload that changed the
+    products.
+    """
+
+    def __init__(self, products=None, source=None, reload_interval=5, clock=time.monotonic):
+        self.source = source
+        self.reload_interval = reload_interval
+        self._clock = clock
+        self._reload_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._derived = {}  # name -> (version, value)
+        self._signature = self._source_signature()
+        self._index = _Index(products if source is None else read_products(source))
+        self._checked_at = clock()
+        self.version = 1
+        self.stats = {"searches": 0, "reloads": 0, "reload_errors": 0}
+
+    def __getitem__(self, product_id):
+        return self._index.products[product_id]
+
+    def __iter__(self):
+        return iter(self._index.products)
+
+    def __len__(self):
+        return len(self._index.products)
+
+    @property
+    def currencies(self):
+        return sorted(self._index.by_currency)
+
+    def price_range(self):
+        """(lowest, highest) price across the catalog"""
+        index = self._index
+        return index.prices[0], index.prices[-1]
+
+    def search(self, query=None, min_price=None, max_price=None, currency=None, offset=0, limit=20):
+        """One page of matching products in price order, and the total match count
+
+        `query` words must all appear in a product's id, name, description or
+        keywords; price bounds are inclusive.
+        """
+        index = self._index
+        with self._lock:
+            self.stats["searches"] += 1
+
+        if currency is not None:
+            prices, ids = index.by_currency.get(str(currency).upper(), ([], []))
+        else:
+            prices, ids = index.prices, index.ids
+        low = bisect.bisect_left(prices, min_price) if min_price is not None else 0
+        high = bisect.bisect_right(prices, max_price) if max_price is not None else len(prices)
+
+        allowed = None
+        for word in WORD.findall((query or '').lower()):
+            matches = index.by_keyword.get(word, set())
+            allowed = matches if allowed is None else allowed & matches
+            if not allowed:
+                return [], 0
+
+        if allowed is None:
+            matched = ids[low:high]
+        elif len(allowed) < high - low:
+            # Fewer keyword hits than products in range: filter the hits instead
+            bounds = (min_price if min_price is not None else float('-inf'),
+                      max_price if max_price is not None else float('inf'))
+            matched = sorted(
+                (pid for pid in allowed
+                 if bounds[0] <= index.products[pid]['price'] <= bounds[1]
+                 and (currency is None or index.products[pid]['currency'] == str(currency).upper())),
+                key=index.rank.__getitem__
+            )
+        else:
+            matched = [pid for pid in ids[low:high] if pid in allowed]
+        return [index.products[pid] for pid in matched[offset:offset + limit]], len(matched)
+
+    def nearest(self, amount, currency=None):
+        """ID of the product whose price is closest to `amount` (ties go to the dearer one)"""
+        index = self._index
+        prices, ids = index.by_currency.get(currency.upper(), ([], [])) if currency else (index.prices, index.ids)
+        if not ids:
+            return None
+        position = bisect.bisect_left(prices, amount)
+        if position == len(prices):
+            return ids[-1]
+        if position and amount - prices[position - 1] < prices[position] - amount:
+            return ids[position - 1]
+        return ids[position]
+
+    def derived(self, name, build):
+        """`build(catalog)`, cached until the catalog changes"""
+        version = self.version
+        with self._lock:
+            cached = self._derived.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        value = build(self)
+        with self._lock:
+            self._derived[name] = (version, value)
+        return value
+
+    def on_change(self, callback):
+        """Call `callback(catalog)` after every reload that changed the products"""
+        self._listeners.append(callback)
+
+    def _source_signature(self):
+        """Modification time and size of the source (and its WAL), to spot edits cheaply"""
+        if self.source is None:
+            return None
+        signature = []
+        for path in (self.source, self.source + '-wal'):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def refresh(self):
+        """Reload if the source changed; checks at most every `reload_interval` seconds
+
+        Cheap enough to call per request.  Returns True if the catalog changed.
+        """
+        if self.source is None or not self.reload_interval:
+            return False
+        if self._clock() - self._checked_at < self.reload_interval:
+            return False
+        # One request does the check; the others carry on with the current catalog
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            self._checked_at = self._clock()
+            signature = self._source_signature()
+            if signature == self._signature:
+                return False
+            self._signature = signature
+            return self._reload()
+        finally:
+            self._reload_lock.release()
+
+    def reload(self):
+        """Re-read the source now; returns True if the catalog changed"""
+        if self.source is None:
+            return False
+        with self._reload_lock:
+            self._signature = self._source_signature()
+            return self._reload()
+
+    def _reload(self):
+        try:
+            index = _Index(read_products(self.source))
+        except (OSError, ValueError, KeyError, TypeError, sqlite3.Error) as e:
+            # Keep serving the last good catalog
+            with self._lock:
+                self.stats["reload_errors"] += 1
+            log.error("Catalog reload failed", extra={"source": self.source, "error": str(e)})
+            return False
+        if index.products == self._index.products:
+            return False
+        with self._lock:
+            self._index = index
+            self.version += 1
+            self.stats["reloads"] += 1
+        log.info("Catalog reloaded", extra={"source": self.source, "products": len(index.products),
+                                            "version": self.version})
+        for callback in self._listeners:
+            callback(self)
+        return True
+
+    def snapshot(self):
+        index = self._index
+        with self._lock:
+            return {
+                "source": self.source or 'built-in',
+                "products": len(index.products),
+                "currencies": sorted(index.by_currency),
+                "version": self.version,
+                **self.stats,
+            }
@@ -0,0 +1,160 @@
+"""
+Circuit breakers for upstream APIs
+A breaker watches the outcome and latency of recent calls to one upstream.
+When too many of them fail or are slow it opens, and calls fail immediately
+instead of tying up a worker on an upstream that is down.  After a cool-off
+it lets a few probe calls through (half-open) and closes again once they
+succeed.
+"""
+
+import threading
+import time
+from collections import deque
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose breaker is open"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable (circuit open), retry after {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over the calls of the last `window` seconds
+
+    It opens when at least `min_calls` calls were made in the window and
+    `error_rate` of them failed, or `slow_call_rate` of them took longer than
+    `slow_call_seconds`.  After `open_seconds` up to `half_open_calls` probes
+    are let through at a time; that many successes close it, and any failed
+    or slow probe opens it again.  `enabled=False` only records statistics.
+    """
+
+    def __init__(self, name, window=30, min_calls=20, error_rate=0.5, slow_call_seconds=10,
+                 slow_call_rate=0.5, open_seconds=15, half_open_calls=3, enabled=True, clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = max(1, min_calls)
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+        self.enabled = enabled
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._calls = deque()  # (finished_at, failed, slow) within the window
+        self._failed = 0
+        self._slow = 0
+        self._probes = 0  # probes in flight
+        self._probe_successes = 0
+        self.stats = {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = self._probe_successes = 0
+        return self._state
+
+    def allow(self):
+        """Check before calling; returns a ticket for record() or release(), or raises CircuitOpen"""
+        if not self.enabled:
+            return CLOSED
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return CLOSED
+            if state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return HALF_OPEN
+            self.stats["rejected"] += 1
+            retry_after = max(0.0, self._opened_at + self.open_seconds - self._clock())
+        raise CircuitOpen(self.name, retry_after)
+
+    def record(self, ticket, failed, seconds):
+        """Report the outcome of a call allowed with `ticket`"""
+        slow = seconds >= self.slow_call_seconds
+        with self._lock:
+            now = self._clock()
+            self.stats["calls"] += 1
+            self.stats["failures"] += failed
+            self.stats["slow_calls"] += slow
+            if not self.enabled:
+                return
+            if ticket == HALF_OPEN:
+                if self._state != HALF_OPEN:
+                    return
+                self._probes -= 1
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._close()
+                return
+            if self._state != CLOSED:
+                # Started before the breaker opened; the probes decide now
+                return
+            self._calls.append((now, failed, slow))
+            self._failed += failed
+            self._slow += slow
+            self._expire(now)
+            count = len(self._calls)
+            if count >= self.min_calls and (self._failed >= self.error_rate * count
+                                            or self._slow >= self.slow_call_rate * count):
+                self._open(now)
+
+    def release(self, ticket):
+        """Give back a ticket whose call never finished (e.g. it was cancelled)
+
+        A half-open probe frees its slot without counting as a success or a
+        failure; other tickets hold nothing.
+        """
+        if ticket != HALF_OPEN:
+            return
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def _expire(self, now):
+        while self._calls and now - self._calls[0][0] > self.window:
+            _, failed, slow = self._calls.popleft()
+            self._failed -= failed
+            self._slow -= slow
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+        self.stats["opened"] += 1
+
+    def _close(self):
+        self._state = CLOSED
+        self._calls.clear()
+        self._failed = self._slow = 0
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state()
+            self._expire(self._clock())
+            count = len(self._calls)
+            return {
+                "state": state if self.enabled else 'disabled',
+                "window_calls": count,
+                "window_error_rate": round(self._failed / count, 3) if count else 0.0,
+                "window_slow_rate": round(self._slow / count, 3) if count else 0.0,
+                "retry_after": round(max(0.0, self._opened_at + self.open_seconds - self._clock()), 1)
+                if state == OPEN else 0.0,
+                **self.stats,
+            }
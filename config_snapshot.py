@@ -0,0 +1,59 @@
+"""
+Environment loading at boot, from .env or a prebuilt snapshot of it
+Every worker used to import python-dotenv and search for and parse .env when
+it imported the app.  `python -m config_snapshot` does that once, e.g. while
+building the image, and writes the resolved variables to a flat JSON file;
+workers started with CONFIG_SNAPSHOT pointing at it read that instead and
+never import dotenv.  As with .env, variables already set in the
+environment take precedence.
+
+Usage: python -m config_snapshot [--output config.snapshot.json]
+"""
+
+import argparse
+import json
+import os
+
+
+def load_environment(snapshot=None):
+    """Add the snapshot's (or else .env's) variables to os.environ
+
+    Returns the snapshot path used, or None when .env was read.
+    """
+    snapshot = snapshot or os.getenv('CONFIG_SNAPSHOT')
+    if snapshot:
+        # A missing snapshot is a deployment error, not a reason to boot without settings
+        with open(snapshot) as f:
+            for name, value in json.load(f).items():
+                os.environ.setdefault(name, value)
+        return snapshot
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    return None
+
+
+def write_snapshot(path):
+    """Resolve .env (with its ${VAR} references expanded) into a JSON snapshot at `path`
+
+    Returns the number of variables written.  The file holds the same
+    secrets as .env, so it is only readable by its owner.
+    """
+    from dotenv import dotenv_values, find_dotenv
+    values = {name: value for name, value in dotenv_values(find_dotenv()).items() if value is not None}
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(values, f, indent=2, sort_keys=True)
+    return len(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', default='config.snapshot.json', help='snapshot file to write')
+    args = parser.parse_args()
+    count = write_snapshot(args.output)
+    print(f"Wrote {count} variables to {args.output}; start workers with CONFIG_SNAPSHOT={args.output}")
+
+
+if __name__ == '__main__':
+    main()
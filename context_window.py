@@ -0,0 +1,162 @@
+"""
+Token-budgeted context windowing for Perplexity calls
+Recent turns are sent verbatim; older turns are folded into a short summary
+that is cached per session and extended incrementally as the window moves.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from session_store import estimate_tokens
+
+
+def split_turns(messages):
+    """Group messages into turns, each starting at a user message
+
+    Assistant tool calls and their tool results always share a turn.
+    """
+    turns = []
+    for message in messages:
+        if message.get('role') == 'user' or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def summarize_messages(messages):
+    """Describe messages as short summary lines, without calling the LLM"""
+    lines = []
+    for message in messages:
+        role = message.get('role')
+        content = (message.get('content') or '').strip()
+        if role == 'user' and content:
+            lines.append(f"User said: {shorten(content, 120)}")
+        elif role == 'assistant':
+            for call in message.get('tool_calls') or []:
+                function = call.get('function') or {}
+                lines.append(f"Assistant called {function.get('name')}({shorten(function.get('arguments') or '', 80)})")
+            if content:
+                lines.append(f"Assistant replied: {shorten(content, 120)}")
+        elif role == 'tool':
+            lines.append(f"Tool result: {summarize_tool_result(content)}")
+    return lines
+
+
+def summarize_tool_result(content):
+    try:
+        result = json.loads(content)
+    except (TypeError, ValueError):
+        return shorten(content or '', 80)
+    if not isinstance(result, dict):
+        return shorten(content, 80)
+    if 'error' in result:
+        return f"error: {shorten(str(result['error']), 80)}"
+    if 'order_id' in result:
+        return f"PayPal order {result['order_id']} created"
+    if 'products' in result:
+        return f"listed {len(result['products'])} gift cards"
+    return shorten(content, 80)
+
+
+def shorten(text, limit):
+    text = ' '.join(text.split())
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+
+class ContextWindow:
+    """Fit a session's history into a token budget
+
+    Keeps the last `keep_turns` turns (fewer if they exceed `max_tokens`, but
+    never less than the current turn) and folds everything older into a
+    summary of at most `summary_max_chars`.  Summaries are cached per session
+    and only the newly folded messages are summarized on later turns.
+    """
+
+    def __init__(self, keep_turns=6, max_tokens=1500, summary_max_chars=800, max_cached=10000):
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        self.summary_max_chars = summary_max_chars
+        self.max_cached = max_cached
+        self._summaries = OrderedDict()  # session_id -> (folded_count, first, last, lines, text)
+        self._lock = threading.Lock()
+        self.stats = {
+            "windows": 0,
+            "folded_messages": 0,
+            "summary_hits": 0,
+            "summary_misses": 0,
+        }
+
+    def fit(self, session_id, history):
+        """Return (messages_to_send, summary_or_None) for one completion"""
+        if not self.keep_turns:
+            return history, None
+
+        turns = split_turns(history)
+        kept = turns[-self.keep_turns:]
+        while len(kept) > 1 and estimate_tokens([m for turn in kept for m in turn]) > self.max_tokens:
+            kept = kept[1:]
+
+        window = [m for turn in kept for m in turn]
+        folded = history[:len(history) - len(window)]
+        with self._lock:
+            self.stats["windows"] += 1
+            self.stats["folded_messages"] += len(folded)
+        if not folded:
+            return window, None
+        return window, self._summary(session_id, folded)
+
+    def _summary(self, session_id, folded):
+        first, last = fingerprint(folded[0]), fingerprint(folded[-1])
+        with self._lock:
+            cached = self._summaries.get(session_id)
+            if cached is not None:
+                self._summaries.move_to_end(session_id)
+
+        if cached is not None and cached[1] == first and cached[0] <= len(folded) \
+                and fingerprint(folded[cached[0] - 1]) == cached[2]:
+            if cached[0] == len(folded):
+                with self._lock:
+                    self.stats["summary_hits"] += 1
+                return cached[4]
+            # Same prefix as last time: only summarize what was folded since
+            lines = cached[3] + summarize_messages(folded[cached[0]:])
+            counter = "summary_hits"
+        else:
+            lines = summarize_messages(folded)
+            counter = "summary_misses"
+
+        text = self._render(lines)
+        with self._lock:
+            self.stats[counter] += 1
+            self._summaries[session_id] = (len(folded), first, last, lines, text)
+            while len(self._summaries) > self.max_cached:
+                self._summaries.popitem(last=False)
+        return text
+
+    def _render(self, lines):
+        # Most recent facts matter most; drop the oldest lines past the limit
+        kept, size = [], 0
+        for line in reversed(lines):
+            size += len(line) + 1
+            if size > self.summary_max_chars:
+                break
+            kept.append(line)
+        omitted = len(lines) - len(kept)
+        header = "Summary of the earlier conversation"
+        if omitted:
+            header += f" ({omitted} older items omitted)"
+        return header + ":\n" + "\n".join(reversed(kept))
+
+    def forget(self, session_id):
+        with self._lock:
+            self._summaries.pop(session_id, None)
+
+    def snapshot(self):
+        with self._lock:
+            return {"cached_summaries": len(self._summaries), **self.stats}
+
+
+def fingerprint(message):
+    """Cheap identity for a stored message (history is rebuilt on every load)"""
+    return (message.get('role'), message.get('tool_call_id'), (message.get('content') or '')[:64])
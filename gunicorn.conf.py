@@ -0,0 +1,59 @@
+"""
+Production server: N pre-forked workers sharing sessions, the PayPal token
+and the capture queue through SQLite files
+
+Run with: gunicorn -c gunicorn.conf.py
+Requires: pip install gunicorn (plus uvicorn for SERVER_MODE=async)
+
+Each worker imports the app itself (no preloading, so its threads, pools and
+database connections are its own) and warms up before accepting connections.
+On SIGTERM workers stop accepting, finish in-flight requests within
+GRACEFUL_TIMEOUT seconds and then stop their background threads.
+"""
+
+import multiprocessing
+import os
+import sys
+
+# 'sync': the Flask app on threaded workers; 'async': asgi_app on uvicorn workers
+SERVER_MODE = os.getenv('SERVER_MODE', 'sync')
+
+wsgi_app = 'app:app' if SERVER_MODE == 'sync' else 'asgi_app:app'
+worker_class = 'gthread' if SERVER_MODE == 'sync' else 'uvicorn.workers.UvicornWorker'
+bind = os.getenv('BIND', '0.0.0.0:5000')
+# One worker per core by default
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Requests in flight per sync worker; most of their time is spent waiting on upstreams
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+backlog = 1024
+keepalive = 5
+# Worker heartbeat timeout, longer than a slow Perplexity completion
+timeout = int(os.getenv('WORKER_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+preload_app = False
+
+# State every worker must see. Workers read these when they import the app,
+# so the defaults are set here, in the master, before they fork.
+os.environ.setdefault('SESSION_BACKEND', 'sqlite')
+os.environ.setdefault('PAYPAL_TOKEN_CACHE_PATH', 'paypal_token.db')
+
+
+def post_worker_init(worker):
+    # Runs in the worker after the app is imported, before it accepts
+    # connections (async workers warm up in the ASGI lifespan instead)
+    if SERVER_MODE == 'sync':
+        from gunicorn.arbiter import Arbiter
+
+        from app import warm_up
+        try:
+            warm_up()
+        except RuntimeError as e:
+            # A boot error makes the master stop instead of respawning forever
+            worker.log.error("Worker failed to warm up: %s", e)
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+def worker_exit(server, worker):
+    # In-flight requests have finished (or GRACEFUL_TIMEOUT ran out)
+    from app import shut_down
+    shut_down(timeout=graceful_timeout)
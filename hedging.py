@@ -0,0 +1,185 @@
+"""
+Hedged requests for tail latency
+A call that hasn't answered by the `quantile` latency of recent calls gets
+a backup copy, and whichever copy answers first wins.  The delay means only
+the slowest few percent of calls are duplicated, and a budget caps backups
+at a fraction of all calls so a slow upstream doesn't get twice the load.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class HedgePolicy:
+    """When to send a backup copy of a call
+
+    Hedging starts once `min_samples` latencies have been seen; the delay is
+    their `quantile`, but at least `min_delay` seconds.  Each call earns
+    `max_ratio` of a backup, and up to `burst` unused backups are saved up.
+    """
+
+    def __init__(self, quantile=0.95, min_delay=0.05, min_samples=20, max_ratio=0.1, burst=10, samples=200):
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self._latencies = deque(maxlen=samples)
+        self._credit = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "over_budget": 0}
+
+    def observe(self, seconds):
+        """Record the latency of a successful call"""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self):
+        """Seconds to wait before hedging a new call, or None to send it alone"""
+        with self._lock:
+            self.stats["calls"] += 1
+            self._credit = min(self.burst, self._credit + self.max_ratio)
+            return self._delay()
+
+    def _delay(self):
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))])
+
+    def spend(self):
+        """Take one backup from the budget; False if it is used up"""
+        with self._lock:
+            if self._credit < 1:
+                self.stats["over_budget"] += 1
+                return False
+            self._credit -= 1
+            self.stats["hedged"] += 1
+            return True
+
+    def won(self):
+        with self._lock:
+            self.stats["hedge_wins"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            delay = self._delay()
+            return {
+                "quantile": self.quantile,
+                "delay_s": round(delay, 3) if delay is not None else None,
+                "budget": round(self._credit, 2),
+                **self.stats,
+            }
+
+
+class Hedger:
+    """Hedge blocking calls across threads
+
+    Both copies run on a pool of up to `max_workers` threads; when it is
+    busy, calls run unhedged in the caller's thread rather than queue.  A
+    result counts as an answer when `accept(result)` is true; if neither
+    copy gives one, the first copy's outcome is returned (or raised).
+    """
+
+    def __init__(self, policy, accept=lambda result: True, max_workers=64, name='hedge'):
+        self.policy = policy
+        self.accept = accept
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def call(self, function, *args, **kwargs):
+        delay = self.policy.delay()
+        if delay is None or not self._reserve(2):
+            return self._timed(function, *args, **kwargs)
+        primary = backup = None
+        try:
+            primary = self._executor.submit(self._timed, function, *args, **kwargs)
+            done, _ = wait([primary], timeout=delay)
+            if done or not self.policy.spend():
+                return primary.result()
+            backup = self._executor.submit(self._timed, function, *args, **kwargs)
+            pending = {primary, backup}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None and self.accept(future.result()):
+                        if future is backup:
+                            self.policy.won()
+                        return future.result()
+            return primary.result()
+        finally:
+            # The pool slots are held until the losing copy finishes
+            self._release_when_done(primary, backup)
+
+    def _reserve(self, slots):
+        with self._lock:
+            if self._running + slots > self.max_workers:
+                return False
+            self._running += slots
+            return True
+
+    def _release_when_done(self, primary, backup):
+        def release(_):
+            with self._lock:
+                self._running -= 1
+
+        for future in (primary, backup):
+            if future is None:
+                release(None)
+            else:
+                future.add_done_callback(release)
+
+    def _timed(self, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        if self.accept(result):
+            self.policy.observe(time.perf_counter() - start)
+        return result
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncHedger:
+    """asyncio counterpart of Hedger; the losing copy is cancelled"""
+
+    def __init__(self, policy, accept=lambda result: True):
+        self.policy = policy
+        self.accept = accept
+
+    async def call(self, function, *args, **kwargs):
+        delay = self.policy.delay()
+        if delay is None:
+            return await self._timed(function, *args, **kwargs)
+        primary = asyncio.ensure_future(self._timed(function, *args, **kwargs))
+        backup = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self.policy.spend():
+                return await primary
+            backup = asyncio.ensure_future(self._timed(function, *args, **kwargs))
+            pending = {primary, backup}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None and self.accept(future.result()):
+                        if future is backup:
+                            self.policy.won()
+                        return future.result()
+            return primary.result()
+        finally:
+            for future in (primary, backup):
+                if future is not None and not future.done():
+                    future.cancel()
+
+    async def _timed(self, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = await function(*args, **kwargs)
+        if self.accept(result):
+            self.policy.observe(time.perf_counter() - start)
+        return result
@@ -0,0 +1,199 @@
+"""
+Deterministic fast-path router for obvious catalog and purchase requests
+Patterns are compiled from the product catalog and the tool schema, so a
+high-confidence message is answered without any Perplexity call.
+"""
+
+import re
+import threading
+from collections import namedtuple
+
+Intent = namedtuple('Intent', ['tool', 'arguments', 'confidence'])
+
+PURCHASE_WORDS = re.compile(
+    r"\b(?:buy|purchase|get|take|want|like|need|grab|give me|check ?out|pay for|go with)\b"
+    # "order" only as a command ("order a $50 card"), not "order status of my $50 card"
+    r"|^order (?:a|an|the|one|me)\b"
+)
+CATALOG_WORDS = re.compile(
+    r"\b(?:what(?:'s| is| are)?\b.*\b(?:cards?|have|available|offer|sell)"
+    r"|(?:show|list|see)\b.*\b(?:cards?|options|products|catalog)"
+    r"|(?:which|what) (?:cards?|options|denominations|amounts)"
+    r"|(?:options|prices|catalog|menu)\b)"
+)
+# Anything that makes a purchase ambiguous is left to the LLM
+NEGATION = re.compile(r"\b(?:don'?t|do not|not|no|never|cancel|instead|refund|return)\b")
+HEDGE = re.compile(r"\b(?:should|recommend|maybe|versus|vs|compare|difference|why|how|if)\b")
+# Questions about a product ("is the $50 card refundable?") are never purchases
+QUESTION = re.compile(r"\?$|^(?:is|are|does|do|did|was|will|what(?:'s)?|whats|when|where|which|who|why|how|tell|explain)\b")
+QUANTITY = re.compile(
+    r"\b(?:two|three|four|five|six|seven|eight|nine|ten|couple|several|dozen|both|each|multiple|twice|thrice)\b"
+    r"|\bx\s?\d|\b\d+\s?x\b"
+    # A number before a plural is a count: "25 gift cards", "buy 3 cards"
+    r"|\b\d+\s?(?:gift\s?)?cards\b"
+)
+# A number is only a price with a currency ("$50", "50 dollars") or right
+# before a single card ("the 50 card"); any other number may be a quantity
+AMOUNT = re.compile(
+    r"\$\s?(\d{1,6})(?:\.00)?\b"
+    r"|\b(\d{1,6})(?:\.00)?\s?(?:dollars?|usd|bucks)\b"
+    r"|\b(\d{1,6})(?:\.00)?(?=\s?(?:gift\s?)?card\b)"
+)
+NUMBER = re.compile(r"\d")
+
+
+def money(value):
+    """Format a catalog price the way the system prompt does"""
+    return f"${value:,.2f}"
+
+
+class IntentRouter:
+    """Classify a user message as a catalog or purchase intent, or None
+
+    Built from the product catalog and the `create_paypal_checkout` enum so it
+    only ever routes to products the LLM could have chosen (every product
+    when the schema has no enum, as for catalogs too large to inline).
+    """
+
+    def __init__(self, products, tools, min_confidence=0.8):
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self.stats = {"routed_catalog": 0, "routed_purchase": 0, "fallthrough": 0}
+        self.load(products, tools)
+
+    def load(self, products, tools):
+        """(Re)build the patterns, e.g. after the catalog changed; stats are kept
+
+        `tools` may be a function returning the tool schema.  The patterns are
+        built by the first message classified after this call.
+        """
+        with self._lock:
+            self._source = (products, tools)
+            self._tables = None
+
+    def _current_tables(self):
+        tables = self._tables
+        if tables is not None:
+            return tables
+        with self._lock:
+            if self._tables is None:
+                products, tools = self._source
+                self._tables = self._build(products, tools() if callable(tools) else tools)
+            return self._tables
+
+    def _build(self, products, tools):
+        product_ids = self._tool_enum(tools, 'create_paypal_checkout', 'product_id')
+        product_ids = [pid for pid in product_ids if pid in products] if product_ids else list(products)
+
+        by_amount = {}
+        ambiguous = set()
+        for product_id in product_ids:
+            price = products[product_id]['price']
+            if float(price).is_integer():
+                if int(price) in by_amount:
+                    # Same denomination in several currencies or variants: let the LLM ask
+                    ambiguous.add(int(price))
+                by_amount[int(price)] = product_id
+        for amount in ambiguous:
+            del by_amount[amount]
+        by_lower_id = {pid.lower(): pid for pid in product_ids}
+        product_id_pattern = re.compile(
+            r"\b(" + "|".join(re.escape(pid) for pid in sorted(by_lower_id, key=len, reverse=True)) + r")\b"
+        ) if product_ids else None
+
+        # Swapped in as one tuple, so a concurrent classify() sees one catalog
+        return products, by_amount, by_lower_id, product_id_pattern
+
+    @staticmethod
+    def _tool_enum(tools, function_name, parameter):
+        for tool in tools:
+            function = tool.get('function', {})
+            if function.get('name') == function_name:
+                return list(function['parameters']['properties'][parameter].get('enum', []))
+        return []
+
+    def classify(self, message):
+        """Return the best Intent for `message` with its confidence, or None"""
+        text = ' '.join(message.lower().split())
+        if not text:
+            return None
+
+        product_ids, unknown_amount = self.products_mentioned(text)
+        purchase_verb = bool(PURCHASE_WORDS.search(text))
+
+        if product_ids:
+            if len(product_ids) > 1 or unknown_amount:
+                return None
+            if NEGATION.search(text) or HEDGE.search(text) or QUANTITY.search(text) or QUESTION.search(text):
+                return None
+            product_id = product_ids.pop()
+            # Without a purchase verb ("the $50 one", "$100 card") it may be a
+            # question or a remark, so it is left to the LLM
+            confidence = 0.95 if purchase_verb else 0.5
+            return Intent('create_paypal_checkout', {'product_id': product_id}, confidence)
+
+        if unknown_amount:
+            return None
+        if CATALOG_WORDS.search(text) and not (NEGATION.search(text) or HEDGE.search(text)):
+            return Intent('list_gift_cards', {}, 0.9 if not purchase_verb else 0.8)
+        return None
+
+    def route(self, message):
+        """Return an Intent confident enough to skip the LLM, or None"""
+        intent = self.classify(message)
+        with self._lock:
+            if intent is None or intent.confidence < self.min_confidence:
+                self.stats["fallthrough"] += 1
+                return None
+            self.stats["routed_catalog" if intent.tool == 'list_gift_cards' else "routed_purchase"] += 1
+        return intent
+
+    def products_mentioned(self, text):
+        """Product IDs referenced by id or denomination in lowercased `text`,
+        and whether another amount appeared"""
+        _, by_amount, by_lower_id, product_id_pattern = self._current_tables()
+        found = set()
+        if product_id_pattern is not None:
+            found.update(by_lower_id[pid] for pid in product_id_pattern.findall(text))
+        unknown_amount = False
+        text = product_id_pattern.sub(' ', text) if product_id_pattern else text
+        for match in AMOUNT.finditer(text):
+            amount = int(next(group for group in match.groups() if group))
+            if amount in by_amount:
+                found.add(by_amount[amount])
+            else:
+                unknown_amount = True
+        # A number that is not a price is probably a quantity
+        if NUMBER.search(AMOUNT.sub(' ', text)):
+            unknown_amount = True
+        return found, unknown_amount
+
+    def reply(self, intent, function_result):
+        """Templated assistant reply for a routed intent and its tool result"""
+        if 'error' in function_result:
+            return "Sorry, I couldn't complete that right now. Please try again in a moment."
+        if intent.tool == 'list_gift_cards':
+            products = function_result.get('products', [])
+            lines = [
+                f"- {p['name']} ({money(p['price'])} {p['currency']}): {p['description']}"
+                for p in products
+            ]
+            more = function_result.get('total', len(products)) - len(products)
+            if more > 0:
+                lines.append(f"...and {more} more. Tell me a price range or an occasion to narrow it down.")
+            return "Here are the gift cards we have:\n" + "\n".join(lines) + "\n\nWhich one would you like?"
+        products = self._current_tables()[0]
+        items = function_result.get('items') or [{"product_id": intent.arguments['product_id'], "quantity": 1}]
+        names = [
+            f"{item['quantity']} x {products[item['product_id']]['name']}" if item['quantity'] > 1
+            else products[item['product_id']]['name']
+            for item in items
+        ]
+        return (f"Great choice! I've set up checkout for the {' and '.join(names)}. "
+                f"Please click the PayPal button below to complete your purchase.")
+
+    def snapshot(self):
+        with self._lock:
+            routed = self.stats["routed_catalog"] + self.stats["routed_purchase"]
+            total = routed + self.stats["fallthrough"]
+            return {**self.stats, "hit_rate": round(routed / total, 3) if total else 0.0}
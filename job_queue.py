@@ -0,0 +1,262 @@
+"""
+Durable background job queue backed by a local SQLite file
+Jobs are keyed by an idempotency key (the PayPal order ID for captures), so
+enqueueing the same key twice is a no-op, unless the job ran out of
+attempts, in which case it is queued again.  Worker threads claim jobs under a
+lease, retry failures with exponential backoff and record the outcome for
+status polling.  Several worker processes can share one queue file.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+# Jobs a worker may pick up; 'running' jobs are only reclaimed once their lease expires
+CLAIMABLE = ('queued', 'retrying')
+
+log = logging.getLogger('giftcards.jobs')
+
+
+class PermanentJobError(Exception):
+    """The job can never succeed (e.g. the payment was declined); fail it without retrying"""
+
+
+class DeferJob(Exception):
+    """The job couldn't be tried (e.g. its upstream is known to be down); retry later without using an attempt"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """SQLite-backed job queue with a pool of worker threads
+
+    `handler(key, payload)` runs each job and returns a JSON-serializable
+    result.  Exceptions are retried up to `max_attempts` times, waiting
+    `backoff * 2 ** (attempt - 1)` seconds (at most `max_backoff`) in between;
+    PermanentJobError fails the job immediately, for good, and DeferJob puts
+    it back after its `retry_after` without counting the attempt.  A job
+    whose worker died is picked up again once its `lease` runs out.
+    """
+
+    def __init__(self, handler, path='jobs.db', workers=2, max_attempts=5, backoff=2.0,
+                 max_backoff=300, lease=120, poll_interval=1.0, clock=time.time):
+        self._handler = handler
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.stats = {
+            "enqueued": 0,
+            "requeued": 0,
+            "duplicates": 0,
+            "completed": 0,
+            "retried": 0,
+            "deferred": 0,
+            "failed": 0,
+        }
+        # The file is created by the first call that needs it, not on construction
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._create_schema(db)
+            self._local.db = db
+        return db
+
+    def _create_schema(self, db):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    " key TEXT PRIMARY KEY,"
+                    " payload TEXT NOT NULL,"
+                    " status TEXT NOT NULL,"
+                    " attempts INTEGER NOT NULL DEFAULT 0,"
+                    " run_at REAL NOT NULL,"
+                    " lease_until REAL,"
+                    " claim TEXT,"
+                    " result TEXT,"
+                    " error TEXT,"
+                    " permanent INTEGER NOT NULL DEFAULT 0,"
+                    " created_at REAL NOT NULL,"
+                    " updated_at REAL NOT NULL)"
+                )
+                columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)")]
+                if 'permanent' not in columns:
+                    # Queue files created before permanent failures were told apart
+                    db.execute("ALTER TABLE jobs ADD COLUMN permanent INTEGER NOT NULL DEFAULT 0")
+                db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at)")
+            self._schema_ready = True
+
+    def enqueue(self, key, payload=None):
+        """Queue a job unless one with this key exists; returns (job, queued)
+
+        A job that failed after running out of attempts (not one that failed
+        permanently) is queued again with a fresh set of attempts.
+        """
+        now = self._clock()
+        db = self._connection()
+        with db:
+            created = db.execute(
+                "INSERT OR IGNORE INTO jobs (key, payload, status, run_at, created_at, updated_at)"
+                " VALUES (?, ?, 'queued', ?, ?, ?)",
+                (key, json.dumps(payload or {}), now, now, now)
+            ).rowcount == 1
+            requeued = not created and db.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, run_at = ?, updated_at = ?"
+                " WHERE key = ? AND status = 'failed' AND permanent = 0",
+                (now, now, key)
+            ).rowcount == 1
+        with self._wakeup:
+            self.stats["enqueued" if created else "requeued" if requeued else "duplicates"] += 1
+            if created or requeued:
+                self._wakeup.notify()
+        return self.get(key), created or requeued
+
+    def get(self, key):
+        """Current state of a job, or None if it was never enqueued"""
+        row = self._connection().execute(
+            "SELECT key, status, attempts, result, error, created_at, updated_at FROM jobs WHERE key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "key": row[0],
+            "status": row[1],
+            "attempts": row[2],
+            "result": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+            "created_at": row[5],
+            "updated_at": row[6],
+        }
+
+    def work_once(self):
+        """Claim and run one due job; returns False if none was due"""
+        job = self._claim()
+        if job is None:
+            return False
+        key, payload, attempts = job
+        try:
+            result = self._handler(key, payload)
+        except PermanentJobError as e:
+            log.warning("Job failed permanently", extra={"job": key, "error": str(e)})
+            self._finish(key, 'failed', error=str(e), permanent=True)
+        except DeferJob as e:
+            log.info("Job deferred for %.1fs", e.retry_after, extra={"job": key, "error": str(e)})
+            self._finish(key, 'retrying', error=str(e), run_at=self._clock() + max(e.retry_after, 1.0),
+                         attempts=attempts - 1)
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                log.error("Job failed after %d attempts", attempts, extra={"job": key, "error": str(e)})
+                self._finish(key, 'failed', error=str(e))
+            else:
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+                log.warning("Job failed, retrying in %.1fs", delay, extra={"job": key, "error": str(e)})
+                self._finish(key, 'retrying', error=str(e), run_at=self._clock() + delay)
+        else:
+            self._finish(key, 'completed', result=result)
+        return True
+
+    def _claim(self):
+        now = self._clock()
+        claim = uuid.uuid4().hex
+        db = self._connection()
+        with db:
+            # A single UPDATE is atomic, so two workers can never claim the same row
+            db.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, claim = ?,"
+                " lease_until = ?, updated_at = ?"
+                " WHERE key = (SELECT key FROM jobs"
+                "  WHERE (status IN (?, ?) AND run_at <= ?) OR (status = 'running' AND lease_until < ?)"
+                "  ORDER BY run_at LIMIT 1)",
+                (claim, now + self.lease, now, *CLAIMABLE, now, now)
+            )
+        row = db.execute("SELECT key, payload, attempts FROM jobs WHERE claim = ?", (claim,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def _finish(self, key, status, result=None, error=None, run_at=None, attempts=None, permanent=False):
+        now = self._clock()
+        db = self._connection()
+        with db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, run_at = COALESCE(?, run_at),"
+                " attempts = COALESCE(?, attempts), permanent = ?,"
+                " claim = NULL, lease_until = NULL, updated_at = ? WHERE key = ?",
+                (status, json.dumps(result) if result is not None else None, error, run_at,
+                 attempts, int(permanent), now, key)
+            )
+        with self._wakeup:
+            if attempts is not None:
+                self.stats["deferred"] += 1
+            else:
+                self.stats["retried" if status == 'retrying' else status] += 1
+
+    def start(self):
+        """Start the worker threads"""
+        with self._wakeup:
+            if self._threads:
+                return
+            self._stopping = False
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        """Stop the workers after the jobs they are running finish"""
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout=timeout)
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            try:
+                ran = self.work_once()
+            except sqlite3.Error:
+                # Database busy or locked by another process; try again shortly
+                ran = False
+            if not ran:
+                with self._wakeup:
+                    if self._stopping:
+                        return
+                    # Woken early by enqueue(); the timeout covers retries and other processes
+                    self._wakeup.wait(self.poll_interval)
+
+    def snapshot(self):
+        """Job counts by status plus this process's counters"""
+        counts = dict(self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        with self._wakeup:
+            return {
+                "workers": len(self._threads),
+                "jobs": counts,
+                **self.stats,
+            }
@@ -0,0 +1,184 @@
+"""
+In-process latency histograms, per-request spans and Prometheus exposition
+Each request gets a trace of timed stages (LLM completions, token fetch,
+PayPal calls, ...). Every span also feeds a histogram, and the slowest
+requests can be logged with their full stage breakdown.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, spanning cache hits to slow LLM completions
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+HELP = {
+    "request_seconds": "Request latency by route and response status",
+    "stage_seconds": "Time spent in each stage of a request",
+    "upstream_seconds": "Upstream HTTP call latency by upstream and status code",
+}
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+slow_log = logging.getLogger('giftcards.slow')
+
+
+class Histogram:
+    """Cumulative-bucket histogram with quantiles interpolated from the buckets"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate the q-quantile, assuming values are spread evenly within a bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    # Beyond the last bucket all we know is the lower bound
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Trace:
+    """Stages timed during one request, in the order they finished"""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.spans = []
+
+
+class Metrics:
+    """Registry of labelled histograms plus the per-request trace
+
+    Requests slower than `slow_request_seconds` (0 disables it) are logged
+    with every span they recorded.
+    """
+
+    def __init__(self, namespace='giftcards', buckets=DEFAULT_BUCKETS, slow_request_seconds=0.0):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.slow_request_seconds = slow_request_seconds
+        self._series = {}  # (metric, ((label, value), ...)) -> Histogram
+        self._lock = threading.Lock()
+
+    def observe(self, metric, seconds, **labels):
+        key = (metric, tuple(sorted((name, str(value)) for name, value in labels.items())))
+        with self._lock:
+            histogram = self._series.get(key)
+            if histogram is None:
+                histogram = self._series[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def observe_upstream(self, upstream, status, seconds):
+        """Record one upstream HTTP call (status is the code, or 'error')"""
+        self.observe('upstream_seconds', seconds, upstream=upstream, status=status)
+
+    @contextmanager
+    def span(self, stage):
+        """Time a block as `stage`, adding it to the current request's trace"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('stage_seconds', elapsed, stage=stage)
+            trace = _trace.get()
+            if trace is not None:
+                trace.spans.append((stage, elapsed))
+
+    def start_trace(self, route):
+        _trace.set(Trace(route))
+
+    def finish_trace(self, status):
+        """Record the current request's total latency and log it if it was slow"""
+        trace = _trace.get()
+        if trace is None:
+            return
+        _trace.set(None)
+        total = time.perf_counter() - trace.started
+        self.observe('request_seconds', total, route=trace.route, status=status)
+        if self.slow_request_seconds and total >= self.slow_request_seconds:
+            slow_log.warning("Slow request", extra={
+                "route": trace.route,
+                "status": status,
+                "duration_ms": round(total * 1000, 1),
+                "spans": [{"stage": stage, "ms": round(elapsed * 1000, 1)} for stage, elapsed in trace.spans],
+            })
+
+    def snapshot(self):
+        """p50/p95/p99 (ms) and count for every series"""
+        with self._lock:
+            series = list(self._series.items())
+        result = {}
+        for (metric, labels), histogram in sorted(series):
+            name = ','.join(f"{label}={value}" for label, value in labels)
+            result.setdefault(metric, {})[name] = {
+                "count": histogram.count,
+                **{f"p{int(q * 100)}_ms": round(histogram.quantile(q) * 1000, 1) for q in QUANTILES},
+            }
+        return result
+
+    def render(self):
+        """All series in the Prometheus text exposition format
+
+        Each metric is exported as a histogram, plus a `<metric>_quantile`
+        gauge with the p50/p95/p99 estimated in-process.
+        """
+        with self._lock:
+            series = sorted(
+                (key, list(h.counts), h.sum, h.count, [h.quantile(q) for q in QUANTILES])
+                for key, h in self._series.items()
+            )
+        lines = []
+        for metric in sorted({key[0] for key, *_ in series}):
+            name = f"{self.namespace}_{metric}"
+            lines.append(f"# HELP {name} {HELP.get(metric, metric)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (_, labels), counts, total, count, _ in (s for s in series if s[0][0] == metric):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+            lines.append(f"# HELP {name}_quantile {HELP.get(metric, metric)} (in-process estimate)")
+            lines.append(f"# TYPE {name}_quantile gauge")
+            for (_, labels), _, _, _, quantiles in (s for s in series if s[0][0] == metric):
+                for q, value in zip(QUANTILES, quantiles):
+                    lines.append(f"{name}_quantile{format_labels(labels + (('quantile', str(q)),))} {round(value, 6)}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
@@ -0,0 +1,152 @@
+"""
+Pool of pre-created PayPal orders so checkout doesn't wait on order creation
+A background warmer keeps a few ready, unapproved orders per product and
+throws away any that get too close to the end of PayPal's approval window.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger('giftcards.order_pool')
+
+
+class OrderPool:
+    """Ready-to-use PayPal orders, refilled asynchronously
+
+    `create_order(product_id)` must return the checkout result dict
+    (``checkout_url``, ``order_id``) or raise.  Orders older than `max_age`
+    seconds are discarded instead of handed out, so the buyer still has most
+    of the approval window left.
+    """
+
+    def __init__(self, create_order, product_ids, depth=3, max_age=7200,
+                 check_interval=60, error_backoff=30, clock=time.monotonic):
+        self._create_order = create_order
+        self.depth = depth
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.error_backoff = error_backoff
+        self._clock = clock
+        self._orders = {product_id: deque() for product_id in product_ids}
+        # Bumped by set_products() so orders created for the old set are dropped
+        self._generation = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._retry_at = 0.0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "created": 0,
+            "expired": 0,
+            "flushed": 0,
+            "errors": 0,
+        }
+
+    def take(self, product_id):
+        """Hand out a pooled order for `product_id`, or None if none is ready"""
+        with self._condition:
+            orders = self._orders.get(product_id)
+            now = self._clock()
+            while orders:
+                created_at, result = orders.popleft()
+                if now - created_at < self.max_age:
+                    self.stats["hits"] += 1
+                    # Wake the warmer to replace what was just taken
+                    self._condition.notify()
+                    return result
+                self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            self._condition.notify()
+            return None
+
+    def set_products(self, product_ids):
+        """Keep orders ready for `product_ids` from now on, discarding every pooled order
+
+        Called when the catalog changes: a pooled order carries the price and
+        name it was created with, so none of them can be handed out any more.
+        """
+        with self._condition:
+            self.stats["flushed"] += sum(len(orders) for orders in self._orders.values())
+            self._orders = {product_id: deque() for product_id in product_ids}
+            self._generation += 1
+            self._retry_at = 0.0
+            self._condition.notify()
+
+    def start(self):
+        """Start the background warmer thread"""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='order-pool-warmer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def snapshot(self):
+        """Pool depth per product, hit rate, expiry and flush counts"""
+        with self._condition:
+            served = self.stats["hits"] + self.stats["misses"]
+            return {
+                "target_depth": self.depth,
+                "depth": {pid: len(orders) for pid, orders in self._orders.items()},
+                "hit_rate": round(self.stats["hits"] / served, 3) if served else 0.0,
+                **self.stats,
+            }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                self._discard_expired()
+                product_id = self._next_to_fill()
+                backoff = self._retry_at - self._clock()
+                if backoff > 0:
+                    self._condition.wait(min(self.check_interval, backoff))
+                    continue
+                if product_id is None:
+                    self._condition.wait(self.check_interval)
+                    continue
+                generation = self._generation
+
+            try:
+                result = self._create_order(product_id)
+            except Exception:
+                log.warning("Pre-creating an order failed; backing off %ss", self.error_backoff,
+                            extra={"product_id": product_id}, exc_info=True)
+                with self._condition:
+                    self.stats["errors"] += 1
+                    self._retry_at = self._clock() + self.error_backoff
+                continue
+
+            with self._condition:
+                self.stats["created"] += 1
+                if generation != self._generation:
+                    # The products changed while this order was being created
+                    self.stats["flushed"] += 1
+                    continue
+                self._orders[product_id].append((self._clock(), result))
+
+    def _next_to_fill(self):
+        # The emptiest product first so a burst on one product can't starve the rest
+        if not self._orders:
+            return None
+        product_id, orders = min(self._orders.items(), key=lambda item: len(item[1]))
+        return product_id if len(orders) < self.depth else None
+
+    def _discard_expired(self):
+        now = self._clock()
+        for orders in self._orders.values():
+            while orders and now - orders[0][0] >= self.max_age:
+                orders.popleft()
+                self.stats["expired"] += 1
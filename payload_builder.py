@@ -0,0 +1,149 @@
+"""
+Pre-encoded request bodies for Perplexity chat completions
+The static parts of every request (model parameters, tool schema, system
+prompts) are JSON-encoded once; each session keeps the encoded form of the
+messages it last sent, so a new request only encodes the messages appended
+since and splices the fragments into the body.  Uses orjson when installed.
+"""
+
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+# What build() returns: the request body plus what it was built from
+ChatPayload = namedtuple('ChatPayload', ['body', 'system_prompt', 'messages', 'summary'])
+
+
+def json_backend(name='auto'):
+    """Return (name, dumps) for 'orjson', 'json' or 'auto' (orjson if installed)
+
+    Both produce compact UTF-8 bytes.
+    """
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            raise RuntimeError("JSON_BACKEND=orjson but orjson is not installed")
+        return 'orjson', orjson.dumps
+    compact = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    return 'json', lambda value: compact(value).encode()
+
+
+class PayloadBuilder:
+    """Assemble chat completion bodies from cached encoded fragments
+
+    `params` (model, tools, temperature, ...), or a function returning them,
+    are encoded once, on the first build.  Session buffers hold the messages last sent for a session
+    and their encodings; messages are matched by identity first and equality
+    second (stores that deserialize history hand back new dicts), and any
+    mismatch simply re-encodes from that point.  At most `max_sessions`
+    buffers are kept, least recently used first out.
+    """
+
+    def __init__(self, params, backend='auto', max_sessions=10000):
+        self.backend, self._dumps = json_backend(backend)
+        self.max_sessions = max_sessions
+        self._system = {}  # system prompt text -> encoded system message
+        self._sessions = OrderedDict()  # session_id -> (messages, encoded)
+        self._lock = threading.Lock()
+        self._params_version = 0
+        self.set_params(params)
+        self.stats = {
+            "builds": 0,
+            "messages_reused": 0,
+            "messages_encoded": 0,
+            "bytes_built": 0,
+        }
+
+    def set_params(self, params):
+        """Replace the model parameters, e.g. after the tool schema changed
+
+        They are encoded by the next build; a function is only called then.
+        """
+        with self._lock:
+            self._params_source = params
+            self._params_version += 1
+            self._params = None
+
+    def encoded_params(self, stream=False):
+        """Encoded model parameters, '"model":...,"tools":[...],...' without braces"""
+        with self._lock:
+            encoded, source, version = self._params, self._params_source, self._params_version
+        if encoded is None:
+            body = self._dumps(source() if callable(source) else source)[1:-1]
+            encoded = (body, body + b',"stream":true')
+            with self._lock:
+                # Unless set_params() ran meanwhile, in which case the next build encodes again
+                if self._params_version == version:
+                    self._params = encoded
+        return encoded[1] if stream else encoded[0]
+
+    def system_message(self, content):
+        """Encoded system message; prompts are few and fixed, so they are kept forever"""
+        encoded = self._system.get(content)
+        if encoded is None:
+            encoded = self._system[content] = self._dumps({"role": "system", "content": content})
+        return encoded
+
+    def encode_messages(self, session_id, messages):
+        """Encoded `messages`, reusing the session's buffer for ones already sent"""
+        with self._lock:
+            cached = self._sessions.get(session_id)
+        reused = []
+        if cached is not None and messages:
+            previous, encoded = cached
+            # The window only ever slides forward, so the new messages start
+            # somewhere inside the previous ones
+            start = next((i for i, message in enumerate(previous) if message is messages[0]), None)
+            if start is None:
+                start = next((i for i, message in enumerate(previous) if message == messages[0]), None)
+            if start is not None:
+                for old, fragment, new in zip(previous[start:], encoded[start:], messages):
+                    if old is not new and old != new:
+                        break
+                    reused.append(fragment)
+        fresh = [self._dumps(message) for message in messages[len(reused):]]
+        fragments = reused + fresh
+        if session_id is not None:
+            with self._lock:
+                self._sessions.pop(session_id, None)
+                self._sessions[session_id] = (list(messages), fragments)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                self.stats["messages_reused"] += len(reused)
+                self.stats["messages_encoded"] += len(fresh)
+        return fragments
+
+    def build(self, system_prompt, messages, summary=None, session_id=None, stream=False):
+        """ChatPayload whose body is the encoded request
+
+        `summary` (from the context window) goes in a second system message,
+        as in app.build_chat_payload.
+        """
+        system = [self.system_message(system_prompt)]
+        if summary:
+            system.append(self._dumps({"role": "system", "content": summary}))
+        body = b''.join((
+            b'{"messages":[',
+            b','.join(system + self.encode_messages(session_id, messages)),
+            b'],',
+            self.encoded_params(stream),
+            b'}',
+        ))
+        with self._lock:
+            self.stats["builds"] += 1
+            self.stats["bytes_built"] += len(body)
+        return ChatPayload(body, system_prompt, messages, summary)
+
+    def snapshot(self):
+        with self._lock:
+            total = self.stats["messages_reused"] + self.stats["messages_encoded"]
+            return {
+                "backend": self.backend,
+                "sessions": len(self._sessions),
+                "reuse_rate": round(self.stats["messages_reused"] / total, 3) if total else 0.0,
+                **self.stats,
+            }
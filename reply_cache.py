@@ -0,0 +1,108 @@
+"""
+Cache for the assistant reply that follows a tool call
+Replies are keyed on what actually shapes them (system prompt, tool, arguments
+and the tool result minus its per-order fields) and stored as templates, so a
+cached checkout reply is re-rendered with the new order's URL and ID.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from string import Template
+
+
+class ReplyCache:
+    """Content-addressed LRU + TTL cache of follow-up replies
+
+    Only tools listed in `tools` are cached.  `fields` are the result keys
+    that change on every call (the PayPal order); their values are cut out of
+    the stored reply and filled back in from the current result on a hit.
+    Error results are never cached.
+    """
+
+    def __init__(self, tools=(), fields=('checkout_url', 'order_id'), max_entries=1000,
+                 ttl=3600, clock=time.monotonic):
+        self.tools = frozenset(tools)
+        self.fields = tuple(fields)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (template, stored_at)
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "stored": 0,
+            "evicted_lru": 0,
+            "evicted_ttl": 0,
+        }
+
+    def key(self, system_prompt, tool_name, arguments, function_response):
+        """Cache key for a tool result, or None if it shouldn't be cached"""
+        if tool_name not in self.tools:
+            return None
+        try:
+            result = json.loads(function_response)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(result, dict) or 'error' in result:
+            return None
+        shape = {name: (None if name in self.fields else value) for name, value in result.items()}
+        material = json.dumps(
+            [' '.join(system_prompt.split()), tool_name, arguments, shape],
+            sort_keys=True
+        )
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key, function_response):
+        """Rendered reply for `key`, or None on a miss"""
+        if key is None:
+            return None
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl:
+                del self._entries[key]
+                self.stats["evicted_ttl"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        result = json.loads(function_response)
+        return entry[0].safe_substitute({name: result.get(name) or '' for name in self.fields})
+
+    def put(self, key, function_response, reply):
+        """Store `reply` as a template for every later result with the same key"""
+        if key is None or not reply:
+            return
+        result = json.loads(function_response)
+        text = reply.replace('$', '$$')
+        # Longest first so a value contained in another (an ID inside a URL) isn't split
+        values = sorted(
+            ((name, str(result[name])) for name in self.fields if result.get(name)),
+            key=lambda item: len(item[1]), reverse=True
+        )
+        for name, value in values:
+            text = text.replace(value.replace('$', '$$'), '${' + name + '}')
+        now = self._clock()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (Template(text), now)
+            self.stats["stored"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evicted_lru"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                "tools": sorted(self.tools),
+                "entries": len(self._entries),
+                "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+                **self.stats,
+            }
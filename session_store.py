@@ -0,0 +1,261 @@
+"""
+Conversation history storage with LRU + TTL eviction and per-session caps
+MemorySessionStore keeps sessions in-process; SQLiteSessionStore shares them
+between worker processes through a local database file.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_message_chars(message):
+    """Approximate serialized size of one chat message, in characters"""
+    chars = len(message.get('content') or '') + 16
+    for call in message.get('tool_calls') or []:
+        function = call.get('function') or {}
+        chars += len(function.get('name') or '') + len(function.get('arguments') or '') + 32
+    return chars
+
+
+def estimate_tokens(messages):
+    """Rough token count for a list of chat messages (~4 characters per token)"""
+    return sum(estimate_message_chars(m) for m in messages) // 4
+
+
+def trim_history(messages, max_turns, max_tokens):
+    """Drop the oldest whole turns until the history fits both caps
+
+    A turn starts at a user message, so an assistant tool call is never
+    separated from its tool result.  The latest turn is always kept.
+    Returns (trimmed_messages, number_of_messages_dropped).
+    """
+    starts = [i for i, m in enumerate(messages) if m.get('role') == 'user']
+    if not starts:
+        return messages, 0
+
+    sizes = [estimate_message_chars(m) for m in messages]
+    chars = sum(sizes[starts[0]:])
+    turns = len(starts)
+    cut = starts[0]
+    for start in starts[1:]:
+        if turns <= max_turns and chars // 4 <= max_tokens:
+            break
+        chars -= sum(sizes[cut:start])
+        turns -= 1
+        cut = start
+    return messages[cut:], cut
+
+
+class MemorySessionStore:
+    """In-process session store
+
+    Sessions live in an OrderedDict kept in last-use order, so the least
+    recently used session is evicted first and expired sessions are always
+    at the front.
+    """
+
+    backend = 'memory'
+
+    def __init__(self, max_sessions=10000, ttl=3600, max_turns=20, max_tokens=4000,
+                 clock=time.monotonic):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self._clock = clock
+        self._sessions = OrderedDict()  # session_id -> [messages, touched, chars]
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "evicted_lru": 0,
+            "evicted_ttl": 0,
+            "trimmed_messages": 0,
+        }
+
+    def load(self, session_id):
+        """Return a copy of the session's history (empty if unknown or expired)"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return []
+            if self._clock() - entry[1] > self.ttl:
+                self._drop(session_id, 'evicted_ttl')
+                return []
+            return list(entry[0])
+
+    def save(self, session_id, messages):
+        """Store the session's history, applying caps and eviction"""
+        messages, dropped = trim_history(messages, self.max_turns, self.max_tokens)
+        chars = sum(estimate_message_chars(m) for m in messages)
+        now = self._clock()
+        with self._lock:
+            self.stats["trimmed_messages"] += dropped
+            old = self._sessions.pop(session_id, None)
+            if old is not None:
+                self._chars -= old[2]
+            self._sessions[session_id] = [list(messages), now, chars]
+            self._chars += chars
+            self._evict(now)
+
+    def delete(self, session_id):
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id, None)
+
+    def snapshot(self):
+        """Return session counts, approximate memory use and eviction counters"""
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "sessions": len(self._sessions),
+                "approx_bytes": self._chars,
+                **self.stats,
+            }
+
+    def _evict(self, now):
+        # Expired sessions sit at the front of the last-use ordering
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if now - entry[1] <= self.ttl:
+                break
+            self._drop(session_id, 'evicted_ttl')
+        while len(self._sessions) > self.max_sessions:
+            session_id = next(iter(self._sessions))
+            self._drop(session_id, 'evicted_lru')
+
+    def _drop(self, session_id, counter):
+        entry = self._sessions.pop(session_id)
+        self._chars -= entry[2]
+        if counter:
+            self.stats[counter] += 1
+
+
+class SQLiteSessionStore:
+    """Session store shared between worker processes via a SQLite file
+
+    Eviction sweeps run every `sweep_interval` saves, so the table can briefly
+    exceed `max_sessions` by up to that many rows.  Counters are per process.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path='sessions.db', max_sessions=10000, ttl=3600, max_turns=20,
+                 max_tokens=4000, sweep_interval=100, clock=time.time):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.sweep_interval = sweep_interval
+        self._clock = clock
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._saves = 0
+        self.stats = {
+            "evicted_lru": 0,
+            "evicted_ttl": 0,
+            "trimmed_messages": 0,
+        }
+        with self._connection() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY,"
+                " messages TEXT NOT NULL,"
+                " chars INTEGER NOT NULL,"
+                " touched REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS sessions_touched ON sessions (touched)")
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def load(self, session_id):
+        """Return the session's history (empty if unknown or expired)"""
+        db = self._connection()
+        row = db.execute(
+            "SELECT messages, touched FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return []
+        if self._clock() - row[1] > self.ttl:
+            with db:
+                db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._count('evicted_ttl', 1)
+            return []
+        return json.loads(row[0])
+
+    def save(self, session_id, messages):
+        """Store the session's history, applying caps and periodic eviction"""
+        messages, dropped = trim_history(messages, self.max_turns, self.max_tokens)
+        chars = sum(estimate_message_chars(m) for m in messages)
+        db = self._connection()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, messages, chars, touched) VALUES (?, ?, ?, ?)",
+                (session_id, json.dumps(messages), chars, self._clock())
+            )
+        with self._lock:
+            self.stats["trimmed_messages"] += dropped
+            self._saves += 1
+            sweep = self._saves % self.sweep_interval == 0
+        if sweep:
+            self.sweep()
+
+    def delete(self, session_id):
+        db = self._connection()
+        with db:
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def sweep(self):
+        """Delete expired sessions, then the least recently used beyond max_sessions"""
+        db = self._connection()
+        with db:
+            expired = db.execute(
+                "DELETE FROM sessions WHERE touched < ?", (self._clock() - self.ttl,)
+            ).rowcount
+            excess = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+            evicted = 0
+            if excess > 0:
+                evicted = db.execute(
+                    "DELETE FROM sessions WHERE session_id IN "
+                    "(SELECT session_id FROM sessions ORDER BY touched LIMIT ?)", (excess,)
+                ).rowcount
+        self._count('evicted_ttl', expired)
+        self._count('evicted_lru', evicted)
+
+    def snapshot(self):
+        """Return session counts, approximate storage use and eviction counters"""
+        sessions, chars = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(chars), 0) FROM sessions"
+        ).fetchone()
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "sessions": sessions,
+                "approx_bytes": chars,
+                **self.stats,
+            }
+
+    def _count(self, counter, amount):
+        if amount:
+            with self._lock:
+                self.stats[counter] += amount
+
+
+def create_session_store(backend='memory', **options):
+    """Build the session store selected by SESSION_BACKEND"""
+    if backend == 'memory':
+        options.pop('path', None)
+        return MemorySessionStore(**options)
+    if backend == 'sqlite':
+        return SQLiteSessionStore(**options)
+    raise ValueError(f"Unknown session backend: {backend}")
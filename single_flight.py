@@ -0,0 +1,106 @@
+"""
+Request coalescing ("single flight") for identical concurrent upstream calls
+The first caller for a key makes the call; callers that arrive with the same
+key while it is in flight wait for it and receive the same result (or the
+same exception) instead of making their own.
+"""
+
+import asyncio
+import threading
+
+
+class _Call:
+    """One in-flight call and its outcome"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls across threads
+
+    Nothing is cached: once a call finishes, the next caller with its key
+    starts a new one.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> _Call
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0}
+
+    def do(self, key, function, *args, **kwargs):
+        """Return `function(*args, **kwargs)`, sharing the call with concurrent callers of `key`"""
+        with self._lock:
+            self.stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["executed"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "coalesce_ratio": round(self.stats["coalesced"] / self.stats["calls"], 3) if self.stats["calls"] else 0.0,
+                **self.stats,
+            }
+
+
+class AsyncSingleFlight:
+    """asyncio counterpart of SingleFlight
+
+    The shared call runs as its own task, so a caller that is cancelled
+    (e.g. a client disconnect) doesn't cancel it for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0}
+
+    async def do(self, key, function, *args, **kwargs):
+        """Await `function(*args, **kwargs)`, sharing the call with concurrent callers of `key`"""
+        self.stats["calls"] += 1
+        task = self._calls.get(key)
+        if task is None:
+            self.stats["executed"] += 1
+            task = self._calls[key] = asyncio.ensure_future(function(*args, **kwargs))
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception retrieved even if every caller was cancelled
+            task.exception()
+
+    def snapshot(self):
+        return {
+            "in_flight": len(self._calls),
+            "coalesce_ratio": round(self.stats["coalesced"] / self.stats["calls"], 3) if self.stats["calls"] else 0.0,
+            **self.stats,
+        }
@@ -0,0 +1,167 @@
+"""
+Structured, leveled logging for the app
+Records are formatted as one JSON object per line and carry the correlation
+fields bound for the current request (request_id, session_id, order_id).
+Handlers run on a QueueListener thread so request threads never block on
+stdout, and DEBUG upstream dumps are sampled per request.
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import queue
+import sys
+import zlib
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Correlation fields for the current request, copied into every record
+_log_context = contextvars.ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else came from `extra=`
+STANDARD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'context'}
+
+_listener = None
+
+
+def bind_log_context(**fields):
+    """Attach correlation fields to every record logged from this request"""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+def clear_log_context(**fields):
+    """Start a new request's context with only `fields`"""
+    _log_context.set(dict(fields))
+
+
+class ContextFilter(logging.Filter):
+    """Copy the bound correlation fields onto the record
+
+    Runs in the caller's thread, before the record is queued, so it sees
+    that thread's (or task's) context.
+    """
+
+    def filter(self, record):
+        record.context = _log_context.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep DEBUG records for a `rate` fraction of requests
+
+    The decision is made per request_id, so a sampled request keeps its
+    whole debug trail. INFO and above always pass.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.threshold = int(max(0.0, min(1.0, rate)) * 10000)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        request_id = getattr(record, 'context', {}).get('request_id')
+        if request_id is None:
+            return self.threshold >= 10000
+        return zlib.crc32(str(request_id).encode()) % 10000 < self.threshold
+
+
+def record_fields(record):
+    """Correlation fields plus any `extra=` fields of a record"""
+    fields = dict(getattr(record, 'context', None) or {})
+    for name, value in vars(record).items():
+        if name not in STANDARD_ATTRIBUTES:
+            fields[name] = value
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **record_fields(record),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for local development, fields as key=value"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            line += '  ' + ' '.join(f"{name}={value}" for name, value in fields.items())
+        return line
+
+
+class PreparedQueueHandler(QueueHandler):
+    """QueueHandler that keeps the exception text and `extra=` fields
+
+    The stock prepare() formats the whole record into its message; here only
+    the message arguments and traceback are rendered, so the listener's
+    formatter still sees the structured fields.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(level='INFO', fmt='json', use_queue=True, debug_sample_rate=0.01,
+                      stream=None, logger_name='giftcards'):
+    """Set up the app's logger and return it
+
+    With `use_queue`, records are handed to a QueueListener thread and
+    written there; otherwise the handler writes in the caller's thread.
+    Safe to call again (e.g. from a benchmark) to reconfigure.
+    """
+    global _listener
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    if use_queue:
+        handler = PreparedQueueHandler(queue.SimpleQueue())
+        _listener = QueueListener(handler.queue, output)
+        _listener.start()
+    else:
+        handler = output
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(debug_sample_rate))
+    logger.addHandler(handler)
+    return logger
+
+
+@atexit.register
+def _flush_queue():
+    # Drain queued records on interpreter exit
+    if _listener is not None:
+        _listener.stop()
@@ -0,0 +1,399 @@
+"""
+Expiry-aware OAuth token cache
+Keeps a bearer token for its expires_in lifetime and refreshes it early.
+With a SQLiteTokenStore, worker processes share one token instead of each
+fetching their own.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+from single_flight import AsyncSingleFlight, SingleFlight
+
+# How often a process waiting on another's token fetch re-reads the store (seconds)
+SHARED_POLL_INTERVAL = 0.05
+
+
+class SQLiteTokenStore:
+    """Token shared between worker processes through a SQLite file
+
+    Tokens are stored under `key` (one per set of credentials) with wall-clock
+    expiry and refresh times, so any process can adopt a token another one
+    fetched.  A process about to fetch first claims a lease of
+    `lease_seconds`, so workers that start together make one fetch between
+    them.  The file holds a live bearer token and is created private.
+    Database errors are swallowed: without the store each process simply
+    keeps its own token.
+    """
+
+    def __init__(self, path='paypal_token.db', key='default', lease_seconds=10, clock=time.time):
+        self.path = path
+        self.key = key
+        self.lease_seconds = lease_seconds
+        self._clock = clock
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                " key TEXT PRIMARY KEY,"
+                " token TEXT NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " refresh_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS fetch_leases ("
+                " key TEXT PRIMARY KEY,"
+                " holder INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+        try:
+            os.chmod(self.path, 0o600)
+        except OSError:
+            pass
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def load(self):
+        """(token, expires_in, refresh_in) in seconds from now, or None if there's no live token"""
+        try:
+            row = self._connection().execute(
+                "SELECT token, expires_at, refresh_at FROM tokens WHERE key = ?", (self.key,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        now = self._clock()
+        if row is None or row[1] <= now:
+            return None
+        return row[0], row[1] - now, row[2] - now
+
+    def save(self, token, expires_in, refresh_in):
+        now = self._clock()
+        try:
+            db = self._connection()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO tokens (key, token, expires_at, refresh_at) VALUES (?, ?, ?, ?)",
+                    (self.key, token, now + expires_in, now + refresh_in)
+                )
+        except sqlite3.Error:
+            pass
+
+    def claim(self):
+        """Take the fetch lease; False while another process holds a live one"""
+        now = self._clock()
+        try:
+            db = self._connection()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute("SELECT holder, expires_at FROM fetch_leases WHERE key = ?", (self.key,)).fetchone()
+                if row is not None and row[0] != os.getpid() and row[1] > now:
+                    return False
+                db.execute(
+                    "INSERT OR REPLACE INTO fetch_leases (key, holder, expires_at) VALUES (?, ?, ?)",
+                    (self.key, os.getpid(), now + self.lease_seconds)
+                )
+        except sqlite3.Error:
+            pass
+        return True
+
+    def release(self):
+        try:
+            db = self._connection()
+            with db:
+                db.execute("DELETE FROM fetch_leases WHERE key = ? AND holder = ?", (self.key, os.getpid()))
+        except sqlite3.Error:
+            pass
+
+    def discard(self, token):
+        """Drop `token` if it is still the shared one (a newer token is kept)"""
+        try:
+            db = self._connection()
+            with db:
+                db.execute("DELETE FROM tokens WHERE key = ? AND token = ?", (self.key, token))
+        except sqlite3.Error:
+            pass
+
+
+class TokenCache:
+    """Cache an access token and refresh it before it expires
+
+    `fetch` is called with no arguments and must return a
+    ``(token, expires_in_seconds)`` tuple.  One cache serves one set of
+    credentials, and only one fetch for it runs at a time: callers that
+    arrive while a token is missing or expired share the in-flight fetch,
+    including its failure, instead of starting their own.  Once a token
+    enters its refresh window it is still served while a single background
+    thread fetches the replacement.
+
+    With a `store`, a token another process already fetched (or refreshed) is
+    adopted instead of fetching, and every fetched token is published there.
+    """
+
+    def __init__(self, fetch, refresh_margin=300, expiry_skew=30, retry_delay=10,
+                 clock=time.monotonic, store=None):
+        self._fetch = fetch
+        self._store = store
+        self._refresh_margin = refresh_margin
+        self._expiry_skew = expiry_skew
+        self._retry_delay = retry_delay
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._refreshing = False
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "fetches": 0,
+            "background_refreshes": 0,
+            "fetch_errors": 0,
+            "shared_hits": 0,
+        }
+
+    def get(self):
+        """Return a valid token, fetching one if needed"""
+        now = self._clock()
+        token = self._token
+        if token is not None and now < self._expires_at:
+            self.stats["hits"] += 1
+            if now >= self._refresh_at:
+                self._start_background_refresh()
+            return token
+
+        with self._lock:
+            # Another caller may have fetched while we were waiting
+            if self._token is not None and self._clock() < self._expires_at:
+                self.stats["hits"] += 1
+                return self._token
+            self.stats["misses"] += 1
+        return self._flight.do('token', self._refresh)
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after the upstream rejected it with a 401"""
+        with self._lock:
+            token, self._token = self._token, None
+            self._expires_at = 0.0
+            self._refresh_at = 0.0
+        if self._store is not None and token is not None:
+            self._store.discard(token)
+
+    def snapshot(self):
+        """Return cache state and counters for health/metrics output"""
+        now = self._clock()
+        return {
+            "cached": self._token is not None and now < self._expires_at,
+            "expires_in": max(0.0, round(self._expires_at - now, 1)) if self._token else 0.0,
+            "coalesced": self._flight.stats["coalesced"],
+            **self.stats,
+        }
+
+    def _refresh(self, force=False):
+        with self._lock:
+            # A fetch that finished just before this one started already did the work
+            if not force and self._token is not None and self._clock() < self._expires_at:
+                return self._token
+        if self._store is not None:
+            shared = self._shared_token(force)
+            if shared is not None:
+                with self._lock:
+                    self.stats["shared_hits"] += 1
+                    self._adopt(*shared)
+                return shared[0]
+        with self._lock:
+            self.stats["fetches"] += 1
+        try:
+            token, expires_in = self._fetch()
+        except Exception:
+            with self._lock:
+                self.stats["fetch_errors"] += 1
+            if self._store is not None:
+                self._store.release()
+            raise
+        lifetime = max(0.0, float(expires_in) - self._expiry_skew)
+        # Short-lived tokens refresh halfway through instead of immediately
+        refresh_in = max(lifetime - self._refresh_margin, lifetime / 2)
+        with self._lock:
+            self._adopt(token, lifetime, refresh_in)
+        if self._store is not None:
+            # Publish before releasing the lease, so waiters find the token
+            self._store.save(token, lifetime, refresh_in)
+            self._store.release()
+        return token
+
+    def _shared_token(self, force):
+        """The store's token, waiting while another process fetches one; None to fetch here"""
+        deadline = time.monotonic() + self._store.lease_seconds
+        while True:
+            # Claim before reading, or a holder could publish and release in between
+            claimed = self._store.claim()
+            shared = self._store.load()
+            # A background refresh only adopts a token that isn't due for refresh itself
+            if shared is not None and (not force or shared[2] > 0):
+                if claimed:
+                    self._store.release()
+                return shared
+            if claimed or time.monotonic() >= deadline:
+                return None
+            time.sleep(SHARED_POLL_INTERVAL)
+
+    def _adopt(self, token, lifetime, refresh_in):
+        now = self._clock()
+        self._token = token
+        self._expires_at = now + lifetime
+        self._refresh_at = now + refresh_in
+
+    def _start_background_refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._background_refresh, daemon=True)
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                if self._clock() < self._refresh_at:
+                    return
+                self.stats["background_refreshes"] += 1
+            try:
+                self._flight.do('token', self._refresh, True)
+            except Exception:
+                # Keep serving the current token until it actually expires
+                with self._lock:
+                    self._refresh_at = self._clock() + self._retry_delay
+        finally:
+            self._refreshing = False
+
+
+class AsyncTokenCache:
+    """asyncio counterpart of TokenCache for the ASGI pipeline
+
+    `fetch` is a coroutine function returning ``(token, expires_in_seconds)``.
+    Concurrent callers with an expired token share one fetch (and its
+    failure); tokens in their refresh window are served while a single
+    background task replaces them.  `store` works as in TokenCache (its
+    SQLite calls are local and short, so they run inline).
+    """
+
+    def __init__(self, fetch, refresh_margin=300, expiry_skew=30, retry_delay=10,
+                 clock=time.monotonic, store=None):
+        self._fetch = fetch
+        self._store = store
+        self._refresh_margin = refresh_margin
+        self._expiry_skew = expiry_skew
+        self._retry_delay = retry_delay
+        self._clock = clock
+        self._flight = AsyncSingleFlight()
+        self._refresh_task = None
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "fetches": 0,
+            "background_refreshes": 0,
+            "fetch_errors": 0,
+            "shared_hits": 0,
+        }
+
+    async def get(self):
+        """Return a valid token, fetching one if needed"""
+        now = self._clock()
+        if self._token is not None and now < self._expires_at:
+            self.stats["hits"] += 1
+            if now >= self._refresh_at and self._refresh_task is None:
+                self._refresh_task = asyncio.ensure_future(self._background_refresh())
+            return self._token
+
+        self.stats["misses"] += 1
+        return await self._flight.do('token', self._refresh)
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after the upstream rejected it with a 401"""
+        token, self._token = self._token, None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        if self._store is not None and token is not None:
+            self._store.discard(token)
+
+    def snapshot(self):
+        """Return cache state and counters for health/metrics output"""
+        now = self._clock()
+        return {
+            "cached": self._token is not None and now < self._expires_at,
+            "expires_in": max(0.0, round(self._expires_at - now, 1)) if self._token else 0.0,
+            "coalesced": self._flight.stats["coalesced"],
+            **self.stats,
+        }
+
+    async def _refresh(self, force=False):
+        # A fetch that finished just before this one started already did the work
+        if not force and self._token is not None and self._clock() < self._expires_at:
+            return self._token
+        if self._store is not None:
+            shared = await self._shared_token(force)
+            if shared is not None:
+                self.stats["shared_hits"] += 1
+                self._adopt(*shared)
+                return shared[0]
+        self.stats["fetches"] += 1
+        try:
+            token, expires_in = await self._fetch()
+        except Exception:
+            self.stats["fetch_errors"] += 1
+            if self._store is not None:
+                self._store.release()
+            raise
+        lifetime = max(0.0, float(expires_in) - self._expiry_skew)
+        refresh_in = max(lifetime - self._refresh_margin, lifetime / 2)
+        self._adopt(token, lifetime, refresh_in)
+        if self._store is not None:
+            # Publish before releasing the lease, so waiters find the token
+            self._store.save(token, lifetime, refresh_in)
+            self._store.release()
+        return token
+
+    async def _shared_token(self, force):
+        deadline = time.monotonic() + self._store.lease_seconds
+        while True:
+            claimed = self._store.claim()
+            shared = self._store.load()
+            if shared is not None and (not force or shared[2] > 0):
+                if claimed:
+                    self._store.release()
+                return shared
+            if claimed or time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+    def _adopt(self, token, lifetime, refresh_in):
+        now = self._clock()
+        self._token = token
+        self._expires_at = now + lifetime
+        self._refresh_at = now + refresh_in
+
+    async def _background_refresh(self):
+        try:
+            if self._clock() < self._refresh_at:
+                return
+            self.stats["background_refreshes"] += 1
+            try:
+                await self._flight.do('token', self._refresh, True)
+            except Exception:
+                # Keep serving the current token until it actually expires
+                self._refresh_at = self._clock() + self._retry_delay
+        finally:
+            self._refresh_task = None
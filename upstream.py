@@ -0,0 +1,243 @@
+"""
+Pooled keep-alive HTTP clients for the Perplexity and PayPal upstreams
+Each upstream gets one requests.Session so TCP/TLS connections are reused,
+behind a circuit breaker so a failing upstream is shed instead of waited on.
+requests is imported with the first session, not with this module, so
+asgi_app workers only load it once their capture threads use the PayPal client.
+"""
+
+import functools
+import os
+import threading
+import time
+
+from circuit_breaker import CircuitBreaker
+from single_flight import SingleFlight
+
+# Statuses worth retrying: rate limiting and transient gateway errors
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def failed_status(status):
+    """Whether a response status means the upstream itself is failing or overloaded"""
+    return status == 429 or status >= 500
+
+
+def _setting(prefix, name, default, cast):
+    """`<PREFIX>_<NAME>`, else the shared `UPSTREAM_<NAME>`, else `default`"""
+    value = os.getenv(f"{prefix}_{name}") or os.getenv(f"UPSTREAM_{name}") or default
+    return cast(value)
+
+
+def upstream_settings(prefix):
+    """Read pool/timeout/retry settings for an upstream from the environment
+
+    `<PREFIX>_POOL_SIZE` etc. override the shared `UPSTREAM_POOL_SIZE` defaults.
+    """
+    def setting(name, default, cast):
+        return _setting(prefix, name, default, cast)
+
+    return {
+        "pool_size": setting("POOL_SIZE", "20", int),
+        "connect_timeout": setting("CONNECT_TIMEOUT", "3.05", float),
+        "read_timeout": setting("READ_TIMEOUT", "30", float),
+        "max_retries": setting("MAX_RETRIES", "2", int),
+        "backoff_factor": setting("RETRY_BACKOFF", "0.3", float),
+    }
+
+
+def create_breaker(prefix, name):
+    """Circuit breaker for an upstream, configured like upstream_settings()
+
+    `<PREFIX>_BREAKER=off` (or `UPSTREAM_BREAKER=off`) keeps the statistics
+    but never opens it.
+    """
+    def setting(setting_name, default, cast):
+        return _setting(prefix, f"BREAKER_{setting_name}", default, cast)
+
+    return CircuitBreaker(
+        name,
+        window=setting("WINDOW", "30", float),
+        min_calls=setting("MIN_CALLS", "20", int),
+        error_rate=setting("ERROR_RATE", "0.5", float),
+        slow_call_seconds=setting("SLOW_SECONDS", "10", float),
+        slow_call_rate=setting("SLOW_RATE", "0.5", float),
+        open_seconds=setting("OPEN_SECONDS", "15", float),
+        half_open_calls=setting("HALF_OPEN_CALLS", "3", int),
+        enabled=_setting(prefix, "BREAKER", "on", str) != 'off',
+    )
+
+
+class UpstreamClient:
+    """Keep-alive session for a single upstream API
+
+    Connect failures are always retried (nothing reached the server).  Read
+    failures and retryable statuses are only retried for idempotent methods,
+    plus POST when `retry_post` is set for APIs that accept idempotency keys.
+
+    `observer(name, status, seconds)` is called after every request, with
+    status 'error' when no response came back.
+
+    Requests sent with a `coalesce_key` are single-flighted: concurrent
+    requests with the same key share one upstream call and its response.
+
+    With a `breaker`, requests raise CircuitOpen while it is open, and every
+    request's outcome (a connection error, 429 or 5xx counts as failed) and
+    latency is reported to it.  With a `hedger`, requests sent with
+    `hedge=True` get a backup copy when they run long (see hedging.py).
+    """
+
+    def __init__(self, name, pool_size=20, connect_timeout=3.05, read_timeout=30.0,
+                 max_retries=2, backoff_factor=0.3, retry_post=False, observer=None,
+                 breaker=None, hedger=None):
+        self.name = name
+        self.observer = observer
+        self.breaker = breaker
+        self.hedger = hedger
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_post = retry_post
+        self._session = None
+        self._adapter = None
+        self._session_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self.single_flight = SingleFlight()
+        self.stats = {"requests": 0, "errors": 0, "bytes_sent": 0}
+
+    @property
+    def session(self):
+        """The pooled requests.Session, created on first use"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        methods = set(Retry.DEFAULT_ALLOWED_METHODS)
+        if self.retry_post:
+            methods.add("POST")
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(methods),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", self._adapter)
+        session.mount("http://", self._adapter)
+        return session
+
+    def request(self, method, url, coalesce_key=None, hedge=False, **kwargs):
+        """Send a request through the pooled session with default timeouts
+
+        Only pass `coalesce_key` for requests whose whole response can be
+        shared (not streamed), keyed on everything that shapes the response.
+        The same goes for `hedge`, and the request must be safe to send twice.
+        """
+        send = self._send
+        if hedge and self.hedger is not None:
+            send = functools.partial(self.hedger.call, self._send)
+        if coalesce_key is not None:
+            return self.single_flight.do((method, url, coalesce_key), send, method, url, **kwargs)
+        return send(method, url, **kwargs)
+
+    def _send(self, method, url, **kwargs):
+        session = self.session
+        import requests  # loaded by self.session
+
+        kwargs.setdefault("timeout", self.timeout)
+        ticket = self.breaker.allow() if self.breaker is not None else None
+        with self._lock:
+            self.stats["requests"] += 1
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stats["errors"] += 1
+            if self.breaker is not None:
+                self.breaker.record(ticket, True, elapsed)
+            if self.observer is not None:
+                self.observer(self.name, 'error', elapsed)
+            raise
+        except BaseException:
+            # Interrupted (e.g. a hedge loser's thread shutting down); free a probe slot
+            if self.breaker is not None:
+                self.breaker.release(ticket)
+            raise
+        # For streamed responses this is the time to the response headers
+        elapsed = time.perf_counter() - start
+        if self.breaker is not None:
+            self.breaker.record(ticket, failed_status(response.status_code), elapsed)
+        if self.observer is not None:
+            self.observer(self.name, response.status_code, elapsed)
+        body = response.request.body
+        if body:
+            with self._lock:
+                self.stats["bytes_sent"] += len(body)
+        return response
+
+    def warm(self, url):
+        """Open a pooled connection to `url`'s host ahead of the first real request
+
+        Any HTTP response counts; returns False if the host couldn't be reached.
+        """
+        session = self.session
+        import requests  # loaded by self.session
+
+        try:
+            session.head(url, timeout=self.timeout, allow_redirects=False)
+        except requests.RequestException:
+            return False
+        return True
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def pool_stats(self):
+        """Connection reuse counters summed over this upstream's host pools
+
+        A pool hit is a request served on an already-open connection; a miss
+        had to open a new one (TCP + TLS handshake).
+        """
+        sent = opened = 0
+        pools = self._adapter.poolmanager.pools if self._adapter is not None else {}
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            sent += pool.num_requests
+            opened += pool.num_connections
+        return {
+            "pool_size": self.pool_size,
+            "requests": self.stats["requests"],
+            "errors": self.stats["errors"],
+            "bytes_sent": self.stats["bytes_sent"],
+            "pool_hits": max(0, sent - opened),
+            "pool_misses": opened,
+            "coalesced": self.single_flight.stats["coalesced"],
+        }
+
+    def close(self):
+        if self.hedger is not None:
+            self.hedger.shutdown()
+        if self._session is not None:
+            self._session.close()